@@ -0,0 +1,190 @@
+"""
+node API latency under dashboard load, with the API served by the dashboard's server (shared
+event loop) and by its own server (see separate_server, in the [api] section of configs).
+dashboard load is simulated: its event loop is kept busy 'render_ms' out of every 'period_ms',
+like page renders and chart updates for open browser tabs.
+reports latency percentiles of GET all-readings and POST actuators/fans, as sent by the API client.
+
+usage: python -m benchmarks.api_latency [--requests 2000] [--render-ms 20] [--period-ms 50]
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+import time
+import nicegui
+import uvicorn
+from internal.services import api
+from internal.services import api_client
+from internal.services import control_runtime
+from internal.services import history
+from internal.services import humidity_schedule
+from internal.services import percentiles
+from internal.services import readings
+from internal.services import throttling
+from . import simulation
+
+
+MODES = ("shared", "separate")
+LOCALHOST = "127.0.0.1"
+
+
+class LocalDiscovery:
+    """allows requests from this host only"""
+
+    allowed_ips = frozenset({LOCALHOST})
+
+
+def start_api(configs: simulation.SimulatedConfigs) -> api.API:
+    electrovalves = simulation.SimulatedElectrovalve()
+    fans = simulation.SimulatedFan()
+    host = [simulation.SimulatedHostInfo() for _ in range(4)]
+    sensors = [simulation.SimulatedSensor() for _ in range(4)]
+    local_readings = readings.LocalReadings(electrovalves, fans, *host, *sensors)
+    return api.API(
+        configs,
+        control_runtime.ControlRuntime(configs),
+        LocalDiscovery(),
+        history.History(configs),
+        humidity_schedule.HumiditySchedule(configs),
+        local_readings,
+        readings.ReadingsChanges(configs, local_readings),
+        None,
+        electrovalves,
+        fans,
+        *host,
+        *sensors,
+    )
+
+
+async def dashboard_load(render_secs: float, period_secs: float):
+    while True:
+        start = time.perf_counter()
+        while time.perf_counter() - start < render_secs:
+            pass
+        await asyncio.sleep(max(0.0, period_secs - render_secs))
+
+
+def start_dashboard(port: int, render_secs: float, period_secs: float):
+    """nicegui's app, with simulated load. without lifespan events, that need ui.run"""
+    server = uvicorn.Server(
+        uvicorn.Config(
+            nicegui.app,
+            port=port,
+            lifespan="off",
+            log_level="warning",
+            access_log=False,
+        )
+    )
+
+    async def serve():
+        load = asyncio.create_task(dashboard_load(render_secs, period_secs))
+        await server.serve()
+        load.cancel()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+
+
+def wait_for_api(client: api_client.APIClient):
+    for _ in range(100):
+        try:
+            client.get_all_readings(LOCALHOST)
+            return
+        except Exception:
+            time.sleep(0.1)
+    raise TimeoutError("api didn't start")
+
+
+def latencies(request, count: int) -> dict:
+    durations = list()
+    for i in range(count):
+        start = time.perf_counter()
+        request(i)
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return {
+        "p50_ms": percentiles.percentile(durations, 0.5) * 1000,
+        "p99_ms": percentiles.percentile(durations, 0.99) * 1000,
+        "max_ms": durations[-1] * 1000,
+    }
+
+
+def run_mode(mode: str, count: int, render_secs: float, period_secs: float) -> dict:
+    """runs in its own process, routes are registered on nicegui's app once per process"""
+    configs = simulation.SimulatedConfigs(
+        {
+            "api": {"separate_server": str(mode == "separate")},
+            # a single client, as fast as it can: measures serving, not rate limits
+            "rate_limits": {
+                name: "1000000, 1000000" for name in throttling.LIMITED_CLASSES
+            },
+        }
+    )
+    node_api = start_api(configs)
+    dashboard_port = configs["api"].getint("port")
+    if node_api.separate_server:
+        dashboard_port = configs["api"].getint("dashboard_port")
+        threading.Thread(target=node_api.serve, daemon=True).start()
+    start_dashboard(dashboard_port, render_secs, period_secs)
+
+    client = api_client.APIClient(configs)
+    wait_for_api(client)
+    return {
+        "all_readings": latencies(lambda i: client.get_all_readings(LOCALHOST), count),
+        "set_fans": latencies(
+            lambda i: client.set_fans_state(LOCALHOST, float(i % 100)), count
+        ),
+    }
+
+
+def run(count: int, render_ms: float, period_ms: float) -> dict:
+    results = {"requests": count, "render_ms": render_ms, "period_ms": period_ms}
+    for mode in MODES:
+        child = subprocess.run(
+            [sys.executable, "-m", __spec__.name, "--mode", mode]
+            + ["--requests", str(count)]
+            + ["--render-ms", str(render_ms), "--period-ms", str(period_ms)],
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+        results[mode] = json.loads(child.stdout)
+    for endpoint in ("all_readings", "set_fans"):
+        results[f"shared_to_separate_{endpoint}_p99_ratio"] = (
+            results["shared"][endpoint]["p99_ms"]
+            / results["separate"][endpoint]["p99_ms"]
+        )
+    return results
+
+
+def main():
+    cli = argparse.ArgumentParser(description="node api latency under dashboard load")
+    cli.add_argument("--requests", type=int, default=2000, help="requests per endpoint")
+    cli.add_argument(
+        "--render-ms", type=float, default=20, help="busy time per period (dashboard)"
+    )
+    cli.add_argument(
+        "--period-ms", type=float, default=50, help="dashboard load period"
+    )
+    cli.add_argument("--mode", choices=MODES, help="measure one mode only")
+    cli.add_argument("--output", help="write results to this json file")
+    args = cli.parse_args()
+
+    if args.mode is not None:
+        results = run_mode(
+            args.mode, args.requests, args.render_ms / 1000, args.period_ms / 1000
+        )
+    else:
+        results = run(args.requests, args.render_ms, args.period_ms)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
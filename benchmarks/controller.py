@@ -0,0 +1,238 @@
+"""
+offline controller benchmark.
+replays a recorded (or synthetic) sensor trace through the fan, electrovalve and humidity cycle
+controllers, in accelerated time, and writes the results to a json file.
+
+usage: python -m benchmarks.controller [--trace trace.csv] [--set fan.predictive=true]
+                                       [--output results.json] [--baseline previous.json]
+"""
+
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from internal.services import actuators_controller
+from internal.services import configurations
+from internal.services import control_runtime
+from internal.services import humidity_schedule
+from internal.services import percentiles
+from . import simulation
+
+
+START = datetime(2024, 1, 1)  # trace time 0. set humidity cycles relative to this date
+
+# the synthetic trace stays well above the default target humidity (23 %RH), so the pumps
+# would never open: a target it crosses, and a cycle raising it on the second day
+HUMIDITY_CONFIGS = {
+    "electrovalve": {
+        "humidity_target": "40",
+        "humidity_cycle": "['2024-01-02']",
+        "humidity_cycle_targets": "{'2024-01-02': 46}",
+    }
+}
+
+# lower is better. (path in results, absolute slack) checked against a baseline
+REGRESSION_METRICS = (
+    (("decision_latency_us", "p99"), 50.0),
+    (("outside_target_secs", "temperature"), 60.0),
+    (("outside_target_secs", "co2"), 60.0),
+    (("outside_target_secs", "nh3"), 60.0),
+    (("outside_target_secs", "humidity"), 60.0),
+    (("fan_energy_full_speed_secs",), 60.0),
+    (("electrovalve_open_secs",), 60.0),
+    (("fan_changes",), 10.0),
+    (("electrovalve_changes",), 10.0),
+)
+
+
+def simulate(
+    trace: simulation.Trace,
+    configs: simulation.SimulatedConfigs,
+    humidity_band: float = 5.0,
+) -> dict:
+    """
+    runs all control tasks once per control tick, over the whole trace.
+    humidity is outside target when more than 'humidity_band' %RH away from the target
+    """
+    tick_secs = configs["controller"].getfloat("tick_secs")
+    runtime = control_runtime.ControlRuntime(configs)
+    schedule = humidity_schedule.HumiditySchedule(configs)
+    electrovalves = simulation.SimulatedElectrovalve()
+    fans = simulation.SimulatedFan()
+    controller = actuators_controller.ActuatorsController(
+        configs,
+        runtime,
+        schedule,
+        electrovalves,
+        fans,
+        simulation.SimulatedSensor(),
+        simulation.SimulatedSensor(),
+        simulation.SimulatedSensor(),
+        simulation.SimulatedSensor(),
+    )
+    controller.add_control_tasks()
+    enclosure = simulation.Enclosure(trace)
+
+    limits = {
+        "temperature": configs["fan"].getfloat("temperature_full_speed"),
+        "co2": configs["fan"].getfloat("co2_full_speed"),
+        "nh3": configs["fan"].getfloat("nh3_full_speed"),
+    }
+    outside_target_secs = {metric: 0.0 for metric in (*limits, "humidity")}
+    latencies: list[float] = list()
+    fan_duty_secs = 0.0
+    fan_energy = 0.0
+    electrovalve_enabled_secs = 0.0
+    electrovalve_open_secs = 0.0
+
+    wall_start = time.perf_counter()
+    ticks = int(trace.duration / tick_secs)
+    for tick_number in range(ticks):
+        snapshot = control_runtime.SensorSnapshot(
+            taken_at=START + timedelta(seconds=enclosure.seconds),
+            co2=enclosure.co2,
+            humidity=enclosure.humidity,
+            nh3=enclosure.nh3,
+            temperature=enclosure.temperature,
+        )
+
+        for metric, limit in limits.items():
+            if getattr(snapshot, metric) >= limit:
+                outside_target_secs[metric] += tick_secs
+        target_humidity = schedule.target_at(snapshot.taken_at)
+        if abs(snapshot.humidity - target_humidity) > humidity_band:
+            outside_target_secs["humidity"] += tick_secs
+
+        tick_start = time.perf_counter()
+        runtime.tick(snapshot, tick_number)
+        latencies.append(time.perf_counter() - tick_start)
+
+        fan = fans.get() / 100.0
+        fan_duty_secs += fan * tick_secs
+        fan_energy += fan**3 * tick_secs  # fan power grows with the cube of its speed
+
+        # pumps burst while enabled (see adapters.actuators.electrovalve)
+        pumps_open_fraction = 0.0
+        if electrovalves.is_on():
+            pumps_open_fraction = min(
+                1.0,
+                configs["electrovalve"].getfloat("burst_opened_for_secs")
+                / configs["electrovalve"].getfloat("burst_every_secs"),
+            )
+            electrovalve_enabled_secs += tick_secs
+            electrovalve_open_secs += pumps_open_fraction * tick_secs
+
+        enclosure.step(tick_secs, fans.get(), pumps_open_fraction)
+
+    wall_secs = time.perf_counter() - wall_start
+    latencies.sort()
+    runtime_stats = runtime.statistics()
+
+    return {
+        "ticks": ticks,
+        "simulated_secs": ticks * tick_secs,
+        "wall_secs": wall_secs,
+        "decision_latency_us": {
+            "mean": sum(latencies) / len(latencies) * 1e6 if ticks > 0 else 0.0,
+            "p50": percentiles.percentile(latencies, 0.50) * 1e6,
+            "p99": percentiles.percentile(latencies, 0.99) * 1e6,
+            "max": latencies[-1] * 1e6 if ticks > 0 else 0.0,
+        },
+        "tasks": {
+            task.name: {
+                "runs": task.runs,
+                "failures": task.failures,
+                "mean_us": task.mean_duration * 1e6,
+                "max_us": task.max_duration * 1e6,
+            }
+            for task in runtime_stats.tasks
+        },
+        "fan_changes": fans.changes,
+        "electrovalve_changes": electrovalves.changes,
+        "outside_target_secs": outside_target_secs,
+        "fan_duty_secs": fan_duty_secs,
+        "fan_energy_full_speed_secs": fan_energy,
+        "electrovalve_enabled_secs": electrovalve_enabled_secs,
+        "electrovalve_open_secs": electrovalve_open_secs,
+    }
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """metrics worse than the baseline by more than the tolerance (fraction) plus slack"""
+    found: list[str] = list()
+    for path, slack in REGRESSION_METRICS:
+        current, previous = results, baseline
+        for key in path:
+            current, previous = current[key], previous[key]
+
+        if current > previous * (1 + tolerance) + slack:
+            found.append(f"{'.'.join(path)}: {previous:.2f} -> {current:.2f}")
+    return found
+
+
+def benchmark_configs(
+    overrides: None | dict[str, dict[str, str]] = None
+) -> simulation.SimulatedConfigs:
+    """default configs, with HUMIDITY_CONFIGS, then the given overrides"""
+    configs = simulation.SimulatedConfigs(HUMIDITY_CONFIGS)
+    if overrides is not None:
+        configs.read_dict(overrides)
+    return configs
+
+
+def load_trace(args: argparse.Namespace) -> simulation.Trace:
+    if args.trace:
+        return simulation.Trace.from_csv(args.trace)
+    return simulation.Trace.synthetic(args.hours, seed=args.seed)
+
+
+def add_trace_arguments(cli: argparse.ArgumentParser):
+    cli.add_argument("--trace", help="csv trace (seconds,co2,humidity,nh3,temperature)")
+    cli.add_argument("--hours", type=float, default=72, help="synthetic trace length")
+    cli.add_argument("--seed", type=int, default=0, help="synthetic trace seed")
+
+
+def main():
+    cli = argparse.ArgumentParser(description="offline controller benchmark")
+    add_trace_arguments(cli)
+    cli.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="SECTION.OPTION=VALUE",
+        help="overrides a config from default_configs.ini or HUMIDITY_CONFIGS (repeatable)",
+    )
+    cli.add_argument(
+        "--humidity-band", type=float, default=5.0, help="allowed %%RH off target"
+    )
+    cli.add_argument("--output", default="benchmark_results.json", help="json results")
+    cli.add_argument("--baseline", help="json results to check for regressions")
+    cli.add_argument(
+        "--tolerance", type=float, default=0.1, help="allowed regression fraction"
+    )
+    args = cli.parse_args()
+
+    results = simulate(
+        load_trace(args),
+        benchmark_configs(configurations.parse_overrides(args.set)),
+        args.humidity_band,
+    )
+    results["configs"] = args.set
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            found = regressions(results, json.load(baseline_file), args.tolerance)
+
+        for regression in found:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if len(found) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+all-readings encodings, as served by the API and parsed by the API client:
+json (pydantic models) against the binary snapshot (see readings.encode).
+reports encode and decode time per response, and body size.
+
+usage: python -m benchmarks.encoding [--iterations 20000]
+"""
+
+import argparse
+import json
+import random
+import time
+import requests
+from internal.services import api
+from internal.services import api_client
+from internal.services import readings
+from . import simulation
+
+
+def random_readings() -> readings.Readings:
+    return readings.Readings(
+        electrovalves=random.random() < 0.5,
+        fans=random.choice((0.0, 33.0, 66.0, 100.0)),
+        host_cpu=random.uniform(0, 100),
+        host_disk=random.uniform(0, 100),
+        host_ram=random.uniform(0, 100),
+        host_temperature=random.uniform(30, 80),
+        co2=random.uniform(400, 5000),
+        humidity=random.uniform(20, 90),
+        nh3=random.uniform(0, 50),
+        sensor_temperature=random.uniform(15, 40),
+    )
+
+
+def encode_json(r: readings.Readings) -> bytes:
+    """as API.get_all_readings"""
+    return (
+        api.AllReadings(
+            electrovalves=api.State(opened=r.electrovalves),
+            fans=api.Percentage(percent=r.fans),
+            host_cpu=api.Percentage(percent=r.host_cpu),
+            host_disk=api.Percentage(percent=r.host_disk),
+            host_ram=api.Percentage(percent=r.host_ram),
+            host_temperature=api.TemperatureMeasurement(degrees=r.host_temperature),
+            co2=api.GasMeasurement(ppm=r.co2),
+            humidity=api.Percentage(percent=r.humidity),
+            nh3=api.GasMeasurement(ppm=r.nh3),
+            sensor_temperature=api.TemperatureMeasurement(degrees=r.sensor_temperature),
+        )
+        .json()
+        .encode()
+    )
+
+
+def encode_binary(r: readings.Readings) -> bytes:
+    return readings.encode(r, time.time())
+
+
+def response(body: bytes, media_type: str) -> requests.Response:
+    r = requests.Response()
+    r.status_code = 200
+    r.headers["Content-Type"] = media_type
+    r._content = body
+    return r
+
+
+def measure(
+    samples: list[readings.Readings],
+    encode,
+    media_type: str,
+    client: api_client.APIClient,
+) -> dict:
+    start = time.perf_counter()
+    bodies = [encode(r) for r in samples]
+    encode_secs = time.perf_counter() - start
+
+    responses = [response(body, media_type) for body in bodies]
+    start = time.perf_counter()
+    for r in responses:
+        client._parse_readings(r)
+    decode_secs = time.perf_counter() - start
+
+    return {
+        "encode_us": encode_secs / len(samples) * 1e6,
+        "decode_us": decode_secs / len(samples) * 1e6,
+        "body_bytes": sum(len(body) for body in bodies) / len(bodies),
+    }
+
+
+def run(iterations: int) -> dict:
+    client = api_client.APIClient(simulation.SimulatedConfigs())
+    samples = [random_readings() for _ in range(iterations)]
+
+    results = {
+        "iterations": iterations,
+        "json": measure(samples, encode_json, "application/json", client),
+        "binary": measure(samples, encode_binary, readings.MEDIA_TYPE, client),
+    }
+    for metric in ("encode_us", "decode_us", "body_bytes"):
+        results[f"json_to_binary_{metric}_ratio"] = (
+            results["json"][metric] / results["binary"][metric]
+        )
+    return results
+
+
+def main():
+    cli = argparse.ArgumentParser(description="all-readings encodings benchmark")
+    cli.add_argument(
+        "--iterations", type=int, default=20000, help="responses encoded and decoded"
+    )
+    cli.add_argument("--output", help="write results to this json file")
+    args = cli.parse_args()
+
+    results = run(args.iterations)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
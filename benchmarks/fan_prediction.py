@@ -0,0 +1,57 @@
+"""
+compares reactive and predictive fan control on a replayed (or synthetic) sensor trace.
+reports time over each full speed threshold and fan energy.
+
+usage: python -m benchmarks.fan_prediction [--trace trace.csv] [--hours 72] [--output results.json]
+"""
+
+import argparse
+import json
+from . import controller
+from . import simulation
+
+
+def run(trace: simulation.Trace, predictive: bool) -> dict[str, float]:
+    results = controller.simulate(
+        trace, controller.benchmark_configs({"fan": {"predictive": str(predictive)}})
+    )
+    return {
+        "temperature_over_threshold_secs": results["outside_target_secs"][
+            "temperature"
+        ],
+        "co2_over_threshold_secs": results["outside_target_secs"]["co2"],
+        "nh3_over_threshold_secs": results["outside_target_secs"]["nh3"],
+        "fan_duty_secs": results["fan_duty_secs"],
+        "fan_energy_full_speed_secs": results["fan_energy_full_speed_secs"],
+        "fan_changes": results["fan_changes"],
+        "mean_fans_decision_us": results["tasks"]["fans"]["mean_us"],
+    }
+
+
+def main():
+    cli = argparse.ArgumentParser(description="reactive vs predictive fan control")
+    controller.add_trace_arguments(cli)
+    cli.add_argument("--output", help="write results to this json file")
+    args = cli.parse_args()
+
+    trace = controller.load_trace(args)
+    results = {
+        "reactive": run(trace, predictive=False),
+        "predictive": run(trace, predictive=True),
+    }
+
+    print(f"{'':<32}{'reactive':>14}{'predictive':>14}")
+    for metric in results["reactive"]:
+        print(
+            f"{metric:<32}"
+            f"{results['reactive'][metric]:>14.2f}"
+            f"{results['predictive'][metric]:>14.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+membership protocol on simulated nodes, each bound to its own loopback address (127.0.x.y).
+reports time for all nodes to know each other, traffic per node, false removals
+(with packet loss) and time for all nodes to remove a stopped node.
+
+usage: python -m benchmarks.gossip [--nodes 50] [--loss 0.05] [--seconds 30]
+"""
+
+import argparse
+import json
+import logging
+import random
+import socket
+import threading
+import time
+from internal.services import discovery
+from . import simulation
+
+
+class LossyDiscovery(discovery.Discovery):
+    """drops sent packets at random"""
+
+    loss = 0.0
+
+    def _send(self, sock: socket.socket, data: bytes, address: tuple[str, int]):
+        if random.random() >= self.loss:
+            super()._send(sock, data, address)
+
+
+def address(i: int) -> str:
+    return f"127.0.{i // 250}.{i % 250 + 1}"
+
+
+def start_nodes(
+    count: int, loss: float, probe_interval: float
+) -> list[tuple[LossyDiscovery, threading.Thread]]:
+    """node 0 is the seed all the others join through"""
+    nodes = list()
+    for i in range(count):
+        configs = simulation.SimulatedConfigs(
+            {
+                "discovery": {
+                    "bind_address": address(i),
+                    # multicast doesn't reach other loopback addresses
+                    "multicast_group": "",
+                    "seeds": address(0) if i > 0 else "",
+                    "peers_file": "",
+                    "probe_interval": str(probe_interval),
+                    "probe_timeout": str(probe_interval / 2),
+                }
+            }
+        )
+        node = LossyDiscovery(configs)
+        node.loss = loss
+        thread = threading.Thread(target=node.run, daemon=True)
+        thread.start()
+        nodes.append((node, thread))
+    return nodes
+
+
+def wait_for(condition, timeout: float) -> None | float:
+    """seconds until condition() is true, None on timeout"""
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if condition():
+            return time.monotonic() - start
+        time.sleep(0.1)
+    return None
+
+
+def run(count: int, loss: float, seconds: float, probe_interval: float) -> dict:
+    nodes = start_nodes(count, loss, probe_interval)
+    running = [node for node, _ in nodes]
+
+    convergence_secs = wait_for(
+        lambda: all(len(n.known_nodes()) == count - 1 for n in running),
+        timeout=120,
+    )
+
+    # steady state traffic
+    sent_packets = [n.sent_packets for n in running]
+    sent_bytes = [n.sent_bytes for n in running]
+    time.sleep(seconds)
+    packets_per_sec = [
+        (n.sent_packets - before) / seconds for n, before in zip(running, sent_packets)
+    ]
+    bytes_per_sec = [
+        (n.sent_bytes - before) / seconds for n, before in zip(running, sent_bytes)
+    ]
+    false_removals = sum(count - 1 - len(n.known_nodes()) for n in running)
+
+    # failure detection
+    stopped = running.pop(random.randrange(1, count))
+    stopped.stop()
+    stopped_ip = stopped.own_ip()
+    detection_secs = wait_for(
+        lambda: all(stopped_ip not in n.known_nodes() for n in running),
+        timeout=120,
+    )
+
+    for node in running:
+        node.stop()
+    for _, thread in nodes:
+        thread.join()
+
+    return {
+        "nodes": count,
+        "loss": loss,
+        "convergence_secs": convergence_secs,
+        "sent_packets_per_node_sec": {
+            "mean": sum(packets_per_sec) / count,
+            "max": max(packets_per_sec),
+        },
+        "sent_bytes_per_node_sec": {
+            "mean": sum(bytes_per_sec) / count,
+            "max": max(bytes_per_sec),
+        },
+        "false_removals": false_removals,
+        "failure_detection_secs": detection_secs,
+    }
+
+
+def main():
+    cli = argparse.ArgumentParser(description="membership protocol simulation")
+    cli.add_argument("--nodes", type=int, default=50, help="simulated nodes")
+    cli.add_argument("--loss", type=float, default=0.0, help="sent packets dropped")
+    cli.add_argument(
+        "--seconds", type=float, default=30, help="steady state measurement time"
+    )
+    cli.add_argument(
+        "--probe-interval", type=float, default=1.0, help="seconds between probes"
+    )
+    cli.add_argument("--output", help="write results to this json file")
+    args = cli.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args.nodes, args.loss, args.seconds, args.probe_interval)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
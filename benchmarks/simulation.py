@@ -0,0 +1,226 @@
+"""
+simulated configs, sensors, actuators and enclosure to run controllers offline, in accelerated time.
+paths in relation to the repository root folder (run benchmarks with 'python -m benchmarks.<name>')
+"""
+
+import bisect
+import csv
+import math
+import random
+from dataclasses import dataclass
+from internal.adapters import interfaces
+from internal.services import configurations
+
+
+DEFAULT_CONFIGS_FILE = "default_configs.ini"
+
+
+class SimulatedConfigs(configurations.InMemoryConfigurations):
+    """configs read from default_configs.ini, with overrides"""
+
+    def __init__(self, overrides: None | dict[str, dict[str, str]] = None):
+        super().__init__()
+        self.read(DEFAULT_CONFIGS_FILE)
+        if overrides is not None:
+            self.read_dict(overrides)
+
+
+class SimulatedSensor(interfaces.Sensor):
+    def __init__(self):
+        self.value = 0.0
+
+    def read(self) -> float:
+        return self.value
+
+
+class SimulatedHostInfo(interfaces.HostInfo):
+    def __init__(self):
+        self.value = 0.0
+
+    def get(self) -> float:
+        return self.value
+
+
+class SimulatedFan(interfaces.ActuatorPercentage):
+    def __init__(self):
+        self.value = 0.0
+        self.changes = 0
+
+    def get(self) -> float:
+        return self.value
+
+    def set(self, percent: float):
+        if percent != self.value:
+            self.changes += 1
+            self.value = percent
+
+
+class SimulatedElectrovalve(interfaces.ActuatorOnOff):
+    def __init__(self):
+        self.value = False
+        self.changes = 0
+
+    def on(self):
+        if not self.value:
+            self.changes += 1
+            self.value = True
+
+    def off(self):
+        if self.value:
+            self.changes += 1
+            self.value = False
+
+    def is_on(self) -> bool:
+        return self.value
+
+
+@dataclass
+class TraceSample:
+    seconds: float
+    co2: float
+    humidity: float
+    nh3: float
+    temperature: float
+
+
+class Trace(list[TraceSample]):
+    """sensor readings over time, as the enclosure would read with fans off and pumps closed"""
+
+    fields = ("seconds", "co2", "humidity", "nh3", "temperature")
+    _seconds: list[float] = list()  # sample times, for lookups
+
+    @classmethod
+    def from_csv(cls, path: str) -> "Trace":
+        """csv with a header row and the columns: seconds,co2,humidity,nh3,temperature"""
+        trace = cls()
+        with open(path, newline="") as csv_file:
+            for row in csv.DictReader(csv_file):
+                trace.append(TraceSample(**{f: float(row[f]) for f in cls.fields}))
+        trace.sort(key=lambda sample: sample.seconds)
+        return trace
+
+    @classmethod
+    def synthetic(cls, hours: float, step_secs: float = 5.0, seed: int = 0) -> "Trace":
+        """daily cycles plus random feeding (co2, nh3) and heat events, with sensor noise"""
+        rng = random.Random(seed)
+        day = 24 * 60 * 60
+
+        events: list[tuple[float, float, float]] = list()  # (start, duration, strength)
+        seconds = 0.0
+        while seconds < hours * 60 * 60:
+            seconds += rng.expovariate(1 / (3 * 60 * 60))  # every ~3h
+            events.append((seconds, rng.uniform(20, 60) * 60, rng.uniform(0.5, 1.5)))
+
+        def event_level(t: float) -> float:
+            """ramps up for the event duration, then decays"""
+            level = 0.0
+            for start, duration, strength in events:
+                if t < start:
+                    break
+                if t < start + duration:
+                    level += strength * (t - start) / duration
+                else:
+                    level += strength * math.exp(-(t - start - duration) / (30 * 60))
+            return level
+
+        trace = cls()
+        for i in range(int(hours * 60 * 60 / step_secs) + 1):
+            t = i * step_secs
+            daily = math.sin(2 * math.pi * t / day)
+            event = event_level(t)
+            trace.append(
+                TraceSample(
+                    seconds=t,
+                    co2=900 + 300 * daily + 1800 * event + rng.gauss(0, 20),
+                    humidity=45 - 8 * daily - 5 * event + rng.gauss(0, 0.5),
+                    nh3=0.15 + 0.05 * daily + 0.9 * event + rng.gauss(0, 0.01),
+                    temperature=24 + 4 * daily + 8 * event + rng.gauss(0, 0.2),
+                )
+            )
+        return trace
+
+    def at(self, seconds: float) -> TraceSample:
+        """linear interpolation between samples"""
+        if len(self._seconds) != len(self):
+            self._seconds = [sample.seconds for sample in self]
+
+        i = bisect.bisect_right(self._seconds, seconds)
+        if i == 0:
+            return self[0]
+        if i == len(self):
+            return self[-1]
+
+        before, after = self[i - 1], self[i]
+        progress = (seconds - before.seconds) / (after.seconds - before.seconds)
+        return TraceSample(
+            *(
+                getattr(before, f) + (getattr(after, f) - getattr(before, f)) * progress
+                for f in self.fields
+            )
+        )
+
+    @property
+    def duration(self) -> float:
+        return self[-1].seconds - self[0].seconds if len(self) > 0 else 0.0
+
+
+class Enclosure:
+    """
+    Crickets enclosure model.
+
+    Each reading lags behind its equilibrium value with a first order response.
+    Without fans the equilibrium is the trace. Fans shrink its difference to outside air,
+    proportionally to fan speed, and open pumps raise the humidity equilibrium.
+    """
+
+    outside_co2 = 420.0
+    outside_humidity = 35.0
+    outside_nh3 = 0.0
+    outside_temperature = 18.0
+
+    # at full speed, fans divide the difference to outside air by (1 + effectiveness)
+    co2_fan_effectiveness = 1.0
+    humidity_fan_effectiveness = 0.5
+    nh3_fan_effectiveness = 1.0
+    temperature_fan_effectiveness = 0.5
+
+    humidity_from_pumps = 40.0  # %RH added to the equilibrium with pumps always open
+
+    response_secs = 10 * 60  # time constant of the enclosure air
+
+    def __init__(self, trace: Trace):
+        self._trace = trace
+        self.seconds = trace[0].seconds
+        first = trace[0]
+        self.co2 = first.co2
+        self.humidity = first.humidity
+        self.nh3 = first.nh3
+        self.temperature = first.temperature
+
+    def step(self, secs: float, fan_percentage: float, pumps_open_fraction: float):
+        """advances time, with the given fan speed and fraction of time with pumps open"""
+        self.seconds += secs
+        trace = self._trace.at(self.seconds)
+        fan = fan_percentage / 100.0
+        response = min(1.0, secs / self.response_secs)
+
+        def equilibrium(value: float, outside: float, effectiveness: float) -> float:
+            return outside + (value - outside) / (1 + effectiveness * fan)
+
+        co2 = equilibrium(trace.co2, self.outside_co2, self.co2_fan_effectiveness)
+        humidity = equilibrium(
+            trace.humidity + self.humidity_from_pumps * pumps_open_fraction,
+            self.outside_humidity,
+            self.humidity_fan_effectiveness,
+        )
+        nh3 = equilibrium(trace.nh3, self.outside_nh3, self.nh3_fan_effectiveness)
+        temperature = equilibrium(
+            trace.temperature,
+            self.outside_temperature,
+            self.temperature_fan_effectiveness,
+        )
+
+        self.co2 += (co2 - self.co2) * response
+        self.humidity += (min(100.0, humidity) - self.humidity) * response
+        self.nh3 += (nh3 - self.nh3) * response
+        self.temperature += (temperature - self.temperature) * response
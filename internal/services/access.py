@@ -0,0 +1,218 @@
+import collections
+import logging
+import time
+import typing
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from starlette.responses import Response
+from . import configurations
+from . import percentiles
+from . import throttling
+
+
+@dataclass
+class EndpointStatistics:
+    """latencies in seconds, until the response starts (so streams count their first event)"""
+
+    endpoint: str
+    requests: int = 0
+    statuses: dict[int, int] = field(default_factory=dict)  # status code -> responses
+    total_latency: float = 0.0
+    max_latency: float = 0.0
+    p99_latency: float = 0.0
+
+    @property
+    def mean_latency(self) -> float:
+        return self.total_latency / self.requests if self.requests > 0 else 0.0
+
+
+@dataclass
+class AccessStatistics:
+    unauthorized: int = 0
+    logged: int = 0  # access log lines written at info level
+    suppressed: int = 0  # requests left out of the access log
+    endpoints: list[EndpointStatistics] = field(default_factory=list)
+
+
+class AccessLog:
+    """
+    Per endpoint request counters and latencies, and a sampled access log: the first request
+    from a client to an endpoint is logged, then at most one every 'access_log_interval' seconds,
+    with the number of requests left out since the last one. Server errors are always logged.
+    Every request is logged when logging at debug level.
+    """
+
+    def __init__(self, configs: configurations.Configurations):
+        self._logger = logging.getLogger("services." + self.__class__.__name__)
+        self._interval = configs["api"].getfloat("access_log_interval")
+        self._max_sampled = 1024  # (client, endpoint) pairs, forgotten all at once
+        self._sampled: dict[tuple[str, str], tuple[float, int]] = dict()
+        self._stats = AccessStatistics()
+        self._endpoints: dict[str, EndpointStatistics] = dict()
+        self._recent_latencies: dict[str, collections.deque[float]] = dict()
+
+    def record(
+        self, method: str, client: str, endpoint: str, status: int, latency: float
+    ):
+        stats = self._endpoints.get(endpoint)
+        if stats is None:
+            stats = self._endpoints[endpoint] = EndpointStatistics(endpoint)
+            self._recent_latencies[endpoint] = collections.deque(maxlen=1000)
+        stats.requests += 1
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        stats.total_latency += latency
+        stats.max_latency = max(stats.max_latency, latency)
+        self._recent_latencies[endpoint].append(latency)
+
+        self._log(
+            logging.WARNING if status >= 500 else logging.INFO,
+            client,
+            endpoint,
+            "%s %s %s %d %.1fms",
+            method,
+            client,
+            endpoint,
+            status,
+            latency * 1000,
+        )
+
+    def unauthorized(self, client: str, endpoint: str):
+        self._stats.unauthorized += 1
+        self._log(
+            logging.INFO,
+            client,
+            "",  # one line per client, whatever the endpoint
+            "unauthorized access to %s from %s",
+            endpoint,
+            client,
+        )
+
+    def throttled(self, client: str, endpoint_class: str, status: int):
+        self._log(
+            logging.INFO,
+            client,
+            endpoint_class,
+            "throttled %s request from %s with %d",
+            endpoint_class,
+            client,
+            status,
+        )
+
+    def statistics(self) -> AccessStatistics:
+        return AccessStatistics(
+            unauthorized=self._stats.unauthorized,
+            logged=self._stats.logged,
+            suppressed=self._stats.suppressed,
+            endpoints=[
+                EndpointStatistics(
+                    endpoint=stats.endpoint,
+                    requests=stats.requests,
+                    statuses=dict(stats.statuses),
+                    total_latency=stats.total_latency,
+                    max_latency=stats.max_latency,
+                    p99_latency=percentiles.percentile(
+                        self._recent_latencies[stats.endpoint], 0.99
+                    ),
+                )
+                for stats in self._endpoints.values()
+            ],
+        )
+
+    def _log(self, level: int, client: str, endpoint: str, message: str, *args):
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.log(level, message, *args)
+            return
+        if not self._logger.isEnabledFor(level):
+            return
+
+        now = time.monotonic()
+        key = (client, endpoint)
+        last_logged, suppressed = self._sampled.get(key, (-self._interval, 0))
+        if level < logging.WARNING and now - last_logged < self._interval:
+            self._sampled[key] = (last_logged, suppressed + 1)
+            self._stats.suppressed += 1
+            return
+
+        if len(self._sampled) >= self._max_sampled and key not in self._sampled:
+            self._sampled.clear()
+        self._sampled[key] = (now, 0)
+        self._stats.logged += 1
+        if suppressed > 0:
+            self._logger.log(level, message + " (%d more)", *args, suppressed)
+        else:
+            self._logger.log(level, message, *args)
+
+
+class AccessMiddleware:
+    """
+    ASGI middleware for requests under base_url: rejects clients that aren't allowed,
+    throttles the others (see throttling.Throttling) and records them in the access log.
+    Other requests go straight through.
+
+    The access log and throttling are only used from the server's event loop, through this
+    middleware, so neither of them locks.
+    """
+
+    def __init__(
+        self,
+        app,
+        base_url: str,
+        is_allowed: typing.Callable[[str], bool],
+        access_log: AccessLog,
+        throttling: throttling.Throttling,
+    ):
+        self._app = app
+        self._base_url = base_url
+        self._is_allowed = is_allowed
+        self._access_log = access_log
+        self._throttling = throttling
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self._base_url):
+            await self._app(scope, receive, send)
+            return
+
+        client = scope["client"][0] if scope.get("client") else ""
+        if not self._is_allowed(client):
+            self._access_log.unauthorized(client, scope["path"][len(self._base_url) :])
+            await Response(status_code=HTTPStatus.UNAUTHORIZED)(scope, receive, send)
+            return
+
+        endpoint_class = self._throttling.endpoint_class(
+            scope["method"], scope["path"][len(self._base_url) :]
+        )
+        throttled = self._throttling.admit(client, endpoint_class)
+        if throttled is not None:
+            status, retry_after = throttled
+            self._access_log.throttled(client, endpoint_class, status)
+            await Response(
+                status_code=status, headers={"Retry-After": str(retry_after)}
+            )(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = HTTPStatus.INTERNAL_SERVER_ERROR
+        latency = None
+
+        async def send_timed(message):
+            nonlocal status, latency
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                latency = time.perf_counter() - start
+            await send(message)
+
+        try:
+            await self._app(scope, receive, send_timed)
+        finally:
+            # the route template (ex: history/{metric}) once routed, so paths with
+            # parameters share counters
+            path = getattr(scope.get("route"), "path", "")
+            if not path.startswith(self._base_url):
+                path = scope["path"]
+            self._access_log.record(
+                scope["method"],
+                client,
+                path[len(self._base_url) :],
+                status,
+                latency if latency is not None else time.perf_counter() - start,
+            )
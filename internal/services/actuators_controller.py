@@ -1,10 +1,10 @@
-import concurrent.futures
 import logging
-import time
 from datetime import datetime
 from typing import TYPE_CHECKING
 from . import configurations
-from .dates import Dates, DateCycleTarget
+from . import control_runtime
+from . import humidity_schedule
+from . import trends
 from ..adapters import interfaces
 
 if TYPE_CHECKING:
@@ -17,6 +17,8 @@ class ActuatorsController:
     def __init__(
         self,
         configs: configurations.Configurations,
+        control_runtime: control_runtime.ControlRuntime,
+        humidity_schedule: humidity_schedule.HumiditySchedule,
         electrovalves: interfaces.ActuatorOnOff,
         fans: interfaces.ActuatorPercentage,
         sensor_co2: interfaces.Sensor,
@@ -26,99 +28,142 @@ class ActuatorsController:
     ):
         self._logger = logging.getLogger("services." + self.__class__.__name__)
         self._configs = configs
+        self._control_runtime = control_runtime
+        self._humidity_schedule = humidity_schedule
         self._electrovalves = electrovalves
         self._fans = fans
         self._sensor_co2 = sensor_co2
         self._sensor_humidity = sensor_humidity
         self._sensor_nh3 = sensor_nh3
         self._sensor_temperature = sensor_temperature
-        self._humidity_settings_data: "HumiditySettings"  # set by frontend
+        # set by frontend
+        self._humidity_settings_data: "None | HumiditySettings" = None
 
         self.fan_turned_off = 0.0
         self.fan_1_third_speed = 33.33
         self.fan_2_third_speed = 66.66
         self.fan_full_speed = 100.0
 
-    def handle_fans(self):
-        """calculates fan speed for all sensors and target speed, always keeping the fastest speed"""
-        while True:
-            time.sleep(5)
+        # latest decisions, for comparisons with other controllers
+        self.fan_speed_decision = self.fan_turned_off
+        self.electrovalves_decision = False
 
-            fan_speed = 0.0
+        # reading history for predictive fan control
+        trend_window_secs = self._configs["fan"].getfloat("trend_window_secs")
+        self._temperature_trend = trends.Trend(trend_window_secs)
+        self._co2_trend = trends.Trend(trend_window_secs)
+        self._nh3_trend = trends.Trend(trend_window_secs)
 
-            if (speed := self._fans_temperature_speed()) > fan_speed:
-                fan_speed = speed
+    def handle_fans(self, snapshot: control_runtime.SensorSnapshot):
+        """
+        calculates fan speed for all sensors and target speed, always keeping the fastest speed.
+        in predictive mode, each reading is replaced by its expected value a few moments from now,
+        if higher, so fans speed up before a threshold is crossed
+        """
+        temperature = snapshot.temperature
+        co2 = snapshot.co2
+        nh3 = snapshot.nh3
 
-            if (speed := self._fans_co2_speed()) > fan_speed:
-                fan_speed = speed
+        timestamp = snapshot.taken_at.timestamp()
+        self._temperature_trend.add(timestamp, temperature)
+        self._co2_trend.add(timestamp, co2)
+        self._nh3_trend.add(timestamp, nh3)
 
-            if (speed := self._fans_nh3_speed()) > fan_speed:
-                fan_speed = speed
+        if self._configs["fan"].getboolean("predictive"):
+            temperature = self._predicted(self._temperature_trend, temperature)
+            co2 = self._predicted(self._co2_trend, co2)
+            nh3 = self._predicted(self._nh3_trend, nh3)
 
-            self._fans.set(fan_speed)
+        fan_speed = 0.0
 
-    def handle_electrovalves(self):
-        """basic on/off if humidity is above/below target humidity"""
-        while True:
-            time.sleep(5)
+        if (speed := self._fans_temperature_speed(temperature)) > fan_speed:
+            fan_speed = speed
 
-            current_humidity = self._sensor_humidity.read()
-            target_humidity = self._configs["electrovalve"].getfloat("humidity_target")
+        if (speed := self._fans_co2_speed(co2)) > fan_speed:
+            fan_speed = speed
 
-            if current_humidity < target_humidity:
-                self._electrovalves.on()
-            else:
-                self._electrovalves.off()
+        if (speed := self._fans_nh3_speed(nh3)) > fan_speed:
+            fan_speed = speed
 
-    def handle_humidity_cycles(self):
-        """
-        increments target humidity based on defined date intervals
-        assumes all humidity cycle date intervals end in the future
-        """
-        while True:
-            time.sleep(60 * 60 * 12)  # half a day
+        self.fan_speed_decision = fan_speed
+        self._fans.set(fan_speed)
 
-            now = datetime.now()
-            cycles = self._configs["electrovalve"].get("humidity_cycle")
-            target = self._configs["electrovalve"].getfloat("humidity_target")
-            cycle_targets = self._configs["electrovalve"].get("humidity_cycle_targets")
+    def handle_electrovalves(self, snapshot: control_runtime.SensorSnapshot):
+        """basic on/off if humidity is above/below target humidity"""
+        target_humidity = self._humidity_schedule.target_at(snapshot.taken_at)
 
-            date_intervals = Dates(cycles)
-            date_targets = DateCycleTarget(cycle_targets)
-            for date_from, date_to in date_intervals:
-                target_for_date_interval = date_targets.humidity_for(date_from, date_to)
-                if target_for_date_interval is None:
-                    target_for_date_interval = self._humidity_settings_data.target
+        self.electrovalves_decision = snapshot.humidity < target_humidity
+        if self.electrovalves_decision:
+            self._electrovalves.on()
+        else:
+            self._electrovalves.off()
 
-                if date_from <= now <= date_to:
-                    today = datetime(now.year, now.month, now.day)
+    def handle_humidity_cycles(self, snapshot: control_runtime.SensorSnapshot):
+        """
+        target humidity follows the humidity schedule continuously (see handle_electrovalves).
+        cycles that already ended are folded into the target humidity config
+        """
+        completed = self._humidity_schedule.completed(snapshot.taken_at)
+        if completed is None:
+            return
 
-                    halfDays = (date_to - today).days * 2
-                    differenceInTargets = target_for_date_interval - target
-                    if differenceInTargets == 0:
-                        continue
+        new_target, cycles, cycle_targets = completed
+        self._logger.info(
+            "humidity cycle ended. setting target humidity to %s", new_target
+        )
 
-                    step = differenceInTargets / halfDays
+        if self._humidity_settings_data is not None:
+            self._humidity_settings_data.target = new_target
+            self._humidity_settings_data.cycle = str(cycles)
+            self._humidity_settings_data.cycle_targets = str(cycle_targets)
+
+        self._configs.set_multiple(
+            (
+                ("electrovalve", "humidity_target", str(new_target)),
+                ("electrovalve", "humidity_cycle", str(cycles)),
+                ("electrovalve", "humidity_cycle_targets", str(cycle_targets)),
+            )
+        )
 
-                    new_target = self._humidity_settings_data.target + step
-                    self._humidity_settings_data.target = new_target
-                    self._configs.set(
-                        "electrovalve", "humidity_target", str(new_target)
-                    )
+    def snapshot(self) -> control_runtime.SensorSnapshot:
+        """reads all sensors once"""
+        return control_runtime.SensorSnapshot(
+            taken_at=datetime.now(),
+            co2=self._sensor_co2.read(),
+            humidity=self._sensor_humidity.read(),
+            nh3=self._sensor_nh3.read(),
+            temperature=self._sensor_temperature.read(),
+        )
 
     def start(self):
         """
         starts all actuators controllers.
-        analyses sensor data and determines what to do to the actuators
+        analyses sensor data and determines what to do to the actuators, once per control tick
         """
         self._logger.info("starting actuators controllers...")
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            executor.submit(self.handle_fans)
-            executor.submit(self.handle_electrovalves)
-            executor.submit(self.handle_humidity_cycles)
+        self.add_control_tasks()
+        self._control_runtime.run(self.snapshot)
+
+    def add_control_tasks(self):
+        """registers all actuators controllers in the control runtime"""
+        self._control_runtime.add_task("fans", self.handle_fans)
+        self._control_runtime.add_task("electrovalves", self.handle_electrovalves)
+        self._control_runtime.add_task(
+            "humidity_cycles", self.handle_humidity_cycles, every_secs=60
+        )
+
+    def _predicted(self, trend: trends.Trend, current: float) -> float:
+        """reading expected after the prediction horizon, never lower than the current one"""
+        trend.window_secs = self._configs["fan"].getfloat("trend_window_secs")
+        predicted = trend.predict(
+            self._configs["fan"].getfloat("prediction_horizon_secs")
+        )
+        if predicted is None:
+            return current
+        return max(current, predicted)
 
-    def _fans_temperature_speed(self) -> float:
+    def _fans_temperature_speed(self, current_temperature: float) -> float:
         target_temperature_1_third_speed = self._configs["fan"].getint(
             "temperature_1_third_speed"
         )
@@ -128,7 +173,6 @@ class ActuatorsController:
         target_temperature_full_speed = self._configs["fan"].getint(
             "temperature_full_speed"
         )
-        current_temperature = self._sensor_temperature.read()
 
         if current_temperature >= target_temperature_full_speed:
             return self.fan_full_speed
@@ -141,11 +185,10 @@ class ActuatorsController:
 
         return self.fan_turned_off
 
-    def _fans_co2_speed(self) -> float:
+    def _fans_co2_speed(self, current_co2: float) -> float:
         target_co2_1_third_speed = self._configs["fan"].getint("co2_1_third_speed")
         target_co2_2_third_speed = self._configs["fan"].getint("co2_2_third_speed")
         target_co2_full_speed = self._configs["fan"].getint("co2_full_speed")
-        current_co2 = self._sensor_co2.read()
 
         if current_co2 >= target_co2_full_speed:
             return self.fan_full_speed
@@ -158,11 +201,10 @@ class ActuatorsController:
 
         return self.fan_turned_off
 
-    def _fans_nh3_speed(self) -> float:
+    def _fans_nh3_speed(self, current_nh3: float) -> float:
         target_nh3_1_third_speed = self._configs["fan"].getfloat("nh3_1_third_speed")
         target_nh3_2_third_speed = self._configs["fan"].getfloat("nh3_2_third_speed")
         target_nh3_full_speed = self._configs["fan"].getfloat("nh3_full_speed")
-        current_nh3 = self._sensor_nh3.read()
 
         if current_nh3 >= target_nh3_full_speed:
             return self.fan_full_speed
@@ -1,17 +1,37 @@
+import asyncio
+import collections
+import json
 import logging
+import time
+import typing
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
 from http import HTTPStatus
+import fastapi
 import nicegui
 import pydantic
-from fastapi import HTTPException
-from starlette.responses import Response
+import uvicorn
+from fastapi import Header, HTTPException, Query, Request
+from starlette.responses import Response, StreamingResponse
+from . import access
 from . import configurations
+from . import control_runtime
 from . import discovery
+from . import history
+from . import humidity_schedule
+from . import readings
+from . import shadow_controller
+from . import throttling
 from ..adapters import interfaces
 
 
 ALL_READINGS_ENDPOINT = "all-readings"
+READINGS_STREAM_ENDPOINT = "readings/stream"
+READINGS_CHANGES_ENDPOINT = "readings/changes"
+HISTORY_ENDPOINT = "history"
 ELECTROVALVE_ENDPOINT = "actuators/electrovalves"
 FANS_ENDPOINT = "actuators/fans"
+ACTUATORS_BATCH_ENDPOINT = "actuators/batch"
 CPU_ENDPOINT = "host/cpu"
 DISK_ENDPOINT = "host/disk"
 RAM_ENDPOINT = "host/ram"
@@ -21,6 +41,18 @@ HUMIDITY_ENDPOINT = "sensors/humidity"
 NH3_ENDPOINT = "sensors/nh3"
 SENSOR_TEMPERATURE_ENDPOINT = "sensors/temperature"
 CONFIGS_ENDPOINT = "configs"
+HUMIDITY_SCHEDULE_ENDPOINT = "schedules/humidity"
+CONTROL_RUNTIME_ENDPOINT = "controller/runtime"
+SHADOW_CONTROLLER_ENDPOINT = "controller/shadow"
+DISCOVERY_EVENTS_ENDPOINT = "discovery/events"
+DISCOVERY_LINKS_ENDPOINT = "discovery/links"
+ACCESS_ENDPOINT = "_/access"
+THROTTLING_ENDPOINT = "_/throttling"
+MAX_SCHEDULE_POINTS = 2000
+MAX_HISTORY_POINTS = 5000
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+STREAM_KEEPALIVE_SECS = 15  # idle readings streams get a comment line this often
+STREAM_RETRY_AFTER_SECS = 60  # sent to subscribers over max_stream_subscribers
 
 
 class Percentage(pydantic.BaseModel):
@@ -81,13 +113,211 @@ class Configs(pydantic.BaseModel):
     fan: FanConfigs
 
 
+class ActuatorCommand(pydantic.BaseModel):
+    actuator: typing.Literal["electrovalves", "fans"]
+    opened: None | bool = None  # electrovalves
+    percent: None | float = None  # fans
+
+
+class ActuatorsBatch(pydantic.BaseModel):
+    commands: list[ActuatorCommand]
+
+
+class AppliedBatch(pydantic.BaseModel):
+    applied: list[ActuatorCommand]  # the last command for each actuator, in order
+    coalesced: int  # commands replaced by a later one for the same actuator
+    replayed: bool  # already applied, with the same idempotency key
+
+
+class ReadingsChange(pydantic.BaseModel):
+    sequence: int
+    timestamp: float
+    readings: dict[str, bool | float]  # only the readings that changed
+
+
+class ReadingsChanges(pydantic.BaseModel):
+    sequence: int  # of the latest change
+    reset: bool  # 'since' is too old (or unknown): the only change holds all readings
+    more: bool  # limited, ask again from the last change
+    changes: list[ReadingsChange]
+
+
+class HistoryPoint(pydantic.BaseModel):
+    timestamp: float
+    value: float
+
+
+class MetricHistory(pydantic.BaseModel):
+    metric: str
+    step: float
+    agg: str
+    points: list[HistoryPoint]
+
+
+class TargetPoint(pydantic.BaseModel):
+    timestamp: float
+    target: float
+
+
+class Trajectory(pydantic.BaseModel):
+    current: float
+    points: list[TargetPoint]
+
+
+class TaskTimings(pydantic.BaseModel):
+    name: str
+    runs: int
+    failures: int
+    mean_duration_ms: float
+    max_duration_ms: float
+    mean_cpu_ms: float
+
+
+class ControlRuntimeStats(pydantic.BaseModel):
+    tick_secs: float
+    ticks: int
+    overruns: int
+    skipped_ticks: int
+    last_duration_ms: float
+    mean_duration_ms: float
+    max_duration_ms: float
+    mean_cpu_ms: float
+    p99_duration_ms: float
+    last_lateness_ms: float
+    mean_lateness_ms: float
+    max_lateness_ms: float
+    p99_lateness_ms: float
+    tasks: list[TaskTimings]
+
+
+class ShadowDecision(pydantic.BaseModel):
+    timestamp: float
+    live_fan_speed: float
+    candidate_fan_speed: float
+    live_electrovalves: bool
+    candidate_electrovalves: bool
+    live_cpu_us: float
+    candidate_cpu_us: float
+
+
+class ShadowStats(pydantic.BaseModel):
+    ticks: int
+    fan_divergent_ticks: int
+    fan_mean_abs_difference: float
+    fan_max_abs_difference: float
+    candidate_faster_fan_ticks: int
+    electrovalves_divergent_ticks: int
+    live_mean_cpu_us: float
+    candidate_mean_cpu_us: float
+    candidate_max_cpu_us: float
+    decisions: list[ShadowDecision]
+
+
+class DiscoveryEventsStats(pydantic.BaseModel):
+    queue_depth: int
+    max_queue_depth: int
+    queued: int
+    dispatched: int
+    coalesced: int
+    failures: int
+    last_latency_ms: float
+    mean_latency_ms: float
+    max_latency_ms: float
+
+
+class PeerLinkStats(pydantic.BaseModel):
+    ip: str
+    sent: int
+    received: int
+    loss_rate: float
+    last_rtt_ms: None | float
+    srtt_ms: None | float
+    rttvar_ms: float
+    rto_ms: None | float
+    clock_offset_ms: None | float
+    clock_offset_error_ms: float
+    # counts per jitter bucket, upper bounds 1, 2, 5, 10, 20, 50, 100, 200, 500 ms and overflow
+    jitter_histogram: list[int]
+    # announced by the node, None (and no capabilities) until its first announcement
+    version: None | int
+    api_port: None | int
+    capabilities: list[str]
+
+
+class EndpointAccessStats(pydantic.BaseModel):
+    endpoint: str
+    requests: int
+    statuses: dict[int, int]
+    mean_latency_ms: float
+    max_latency_ms: float
+    p99_latency_ms: float
+
+
+class AccessStats(pydantic.BaseModel):
+    unauthorized: int
+    logged: int
+    suppressed: int
+    endpoints: list[EndpointAccessStats]
+
+
+class ThrottlingClassStats(pydantic.BaseModel):
+    name: str
+    admitted: int
+    limited: int
+    shed: int
+
+
+class ThrottlingStats(pydantic.BaseModel):
+    cpu_percent: float
+    shedding: bool
+    clients: int
+    classes: list[ThrottlingClassStats]
+
+
+@dataclass
+class _Encoded:
+    """response body, and the values it was built from"""
+
+    values: typing.Any
+    sequence: int  # incremented each time the values change
+    body: None | bytes  # None for binary snapshots, timestamped when sent
+
+
+class _Uncompressed:
+    """
+    ASGI middleware that keeps responses to the given paths from being compressed, whatever
+    the client accepts: the gzip middleware (added by nicegui) only sends compressed data as
+    its buffer fills, which holds server-sent events back
+    """
+
+    def __init__(self, app, paths: frozenset[str]):
+        self._app = app
+        self._paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self._paths:
+            scope = dict(scope)
+            scope["headers"] = [
+                (name, value)
+                for name, value in scope["headers"]
+                if name != b"accept-encoding"
+            ]
+        await self._app(scope, receive, send)
+
+
 class API:
     """API to interact with sensors, actuators, configs, etc"""
 
     def __init__(
         self,
         configs: configurations.Configurations,
+        control_runtime: control_runtime.ControlRuntime,
         discovery: discovery.Discovery,
+        readings_history: history.History,
+        humidity_schedule: humidity_schedule.HumiditySchedule,
+        local_readings: readings.LocalReadings,
+        readings_changes: readings.ReadingsChanges,
+        shadow_controller: None | shadow_controller.ShadowController,
         electrovalves: interfaces.ActuatorOnOff,
         fans: interfaces.ActuatorPercentage,
         host_cpu: interfaces.HostInfo,
@@ -101,7 +331,13 @@ class API:
     ):
         super().__init__()
         self._logger = logging.getLogger("services." + self.__class__.__name__)
+        self._control_runtime = control_runtime
         self._discovery = discovery
+        self._readings_history = readings_history
+        self._humidity_schedule = humidity_schedule
+        self._local_readings = local_readings
+        self._readings_changes = readings_changes
+        self._shadow_controller = shadow_controller
         self._electrovalves = electrovalves
         self._fans = fans
         self._host_cpu = host_cpu
@@ -114,119 +350,478 @@ class API:
         self._sensor_temperature = sensor_temperature
         self.base_url = configs["api"].get("base_path")
 
-        @nicegui.app.middleware("http")
-        async def verify_request_origin(request, call_next):
-            if (
-                request.url.path.startswith(self.base_url)
-                and request.client.host not in self._discovery.known_nodes()
-            ):
-                endpoint = request.url.path.split(self.base_url, 1)[-1]
-                self._logger.info(
-                    "unauthorized access to %s from %s", endpoint, request.client.host
-                )
-                return Response(status_code=HTTPStatus.UNAUTHORIZED)
-
-            response = await call_next(request)
-            return response
-
-        @nicegui.app.middleware("http")
-        async def log_request(request, call_next):
-            if request.url.path.startswith(self.base_url):
-                endpoint = request.url.path.split(self.base_url, 1)[-1]
-                self._logger.info(
-                    "INCOMING REQUEST: %s %s %s",
-                    request.method,
-                    request.client.host,
-                    endpoint,
-                )
-            response = await call_next(request)
-            return response
+        # served with the dashboard, or on its own event loop (see serve), so page renders
+        # and many open browser tabs don't delay requests from other nodes
+        self._port = configs["api"].getint("port")
+        self.separate_server = configs["api"].getboolean("separate_server")
+        self.app = fastapi.FastAPI() if self.separate_server else nicegui.app
+        app = self.app
+
+        # readings responses, encoded once per change. ETags are "<epoch>-<sequence>",
+        # the epoch keeps ETags from before a restart from matching
+        self._encoded: dict[str, _Encoded] = dict()  # "endpoint media type" -> response
+        self._epoch = int(time.time())
 
-        @nicegui.app.get(self.base_url + "_/health", status_code=HTTPStatus.OK)
+        # applied actuator batches, by (client ip, idempotency key), least recently used first
+        self._applied_batches: collections.OrderedDict[
+            tuple[str, str], tuple[list[ActuatorCommand], AppliedBatch]
+        ] = collections.OrderedDict()
+        self._max_applied_batches = 256
+
+        # readings streams. subscribers get at most one event every stream_interval seconds
+        self._stream_interval = configs["api"].getfloat("stream_interval")
+        self._max_stream_subscribers = configs["api"].getint("max_stream_subscribers")
+        self._stream_subscribers = 0
+        app.add_middleware(
+            _Uncompressed, paths=frozenset({self.base_url + READINGS_STREAM_ENDPOINT})
+        )
+
+        # allowed nodes only, rate limited, logged and counted per endpoint
+        self._access_log = access.AccessLog(configs)
+        self._throttling = throttling.Throttling(configs, host_cpu)
+        app.add_middleware(
+            access.AccessMiddleware,
+            base_url=self.base_url,
+            is_allowed=lambda ip: ip in self._discovery.allowed_ips,
+            access_log=self._access_log,
+            throttling=self._throttling,
+        )
+
+        @app.get(self.base_url + "_/health", status_code=HTTPStatus.OK)
         async def health():
             pass
 
+        @app.get(self.base_url + ACCESS_ENDPOINT)
+        async def get_access():
+            """requests, statuses and latencies per endpoint, since startup"""
+            stats = self._access_log.statistics()
+            return AccessStats(
+                unauthorized=stats.unauthorized,
+                logged=stats.logged,
+                suppressed=stats.suppressed,
+                endpoints=[
+                    EndpointAccessStats(
+                        endpoint=endpoint.endpoint,
+                        requests=endpoint.requests,
+                        statuses=endpoint.statuses,
+                        mean_latency_ms=endpoint.mean_latency * 1000,
+                        max_latency_ms=endpoint.max_latency * 1000,
+                        p99_latency_ms=endpoint.p99_latency * 1000,
+                    )
+                    for endpoint in stats.endpoints
+                ],
+            )
+
+        @app.get(self.base_url + THROTTLING_ENDPOINT)
+        async def get_throttling():
+            """requests admitted, rate limited and shed per endpoint class, since startup"""
+            stats = self._throttling.statistics()
+            return ThrottlingStats(
+                cpu_percent=stats.cpu_percent,
+                shedding=stats.shedding,
+                clients=stats.clients,
+                classes=[
+                    ThrottlingClassStats(
+                        name=endpoint_class.name,
+                        admitted=endpoint_class.admitted,
+                        limited=endpoint_class.limited,
+                        shed=endpoint_class.shed,
+                    )
+                    for endpoint_class in stats.classes
+                ],
+            )
+
         # all readings (actuators, host and sensors)
 
-        @nicegui.app.get(self.base_url + ALL_READINGS_ENDPOINT)
-        async def get_all_readings():
-            return AllReadings(
-                electrovalves=State(opened=self._electrovalves.is_on()),
-                fans=Percentage(percent=self._fans.get()),
-                host_cpu=Percentage(percent=self._host_cpu.get()),
-                host_disk=Percentage(percent=self._host_disk.get()),
-                host_ram=Percentage(percent=self._host_ram.get()),
-                host_temperature=TemperatureMeasurement(
-                    degrees=self._host_temperature.get()
-                ),
-                co2=GasMeasurement(ppm=self._sensor_co2.read()),
-                humidity=Percentage(percent=self._sensor_humidity.read()),
-                nh3=GasMeasurement(ppm=self._sensor_nh3.read()),
-                sensor_temperature=TemperatureMeasurement(
-                    degrees=self._sensor_temperature.read()
+        @app.get(self.base_url + ALL_READINGS_ENDPOINT, response_model=AllReadings)
+        async def get_all_readings(request: Request):
+            """json, or binary (see readings.encode) if it's in the Accept header"""
+            return self._readings_response(
+                request,
+                ALL_READINGS_ENDPOINT,
+                self._local_readings.read(),
+                lambda r: AllReadings(
+                    electrovalves=State(opened=r.electrovalves),
+                    fans=Percentage(percent=r.fans),
+                    host_cpu=Percentage(percent=r.host_cpu),
+                    host_disk=Percentage(percent=r.host_disk),
+                    host_ram=Percentage(percent=r.host_ram),
+                    host_temperature=TemperatureMeasurement(degrees=r.host_temperature),
+                    co2=GasMeasurement(ppm=r.co2),
+                    humidity=Percentage(percent=r.humidity),
+                    nh3=GasMeasurement(ppm=r.nh3),
+                    sensor_temperature=TemperatureMeasurement(
+                        degrees=r.sensor_temperature
+                    ),
                 ),
+                lambda r: readings.encode(r, time.time()),
+            )
+
+        @app.get(self.base_url + READINGS_STREAM_ENDPOINT)
+        async def stream_readings(request: Request):
+            """
+            server-sent 'readings' events, with the readings that changed since the previous
+            event (all of them in the first one). never compressed, so events aren't held back
+            """
+            if self._stream_subscribers >= self._max_stream_subscribers:
+                raise HTTPException(
+                    status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+                    detail="too many readings streams",
+                    headers={"Retry-After": str(STREAM_RETRY_AFTER_SECS)},
+                )
+
+            return StreamingResponse(
+                self._readings_events(request),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache"},
+            )
+
+        @app.get(self.base_url + READINGS_CHANGES_ENDPOINT)
+        async def get_readings_changes(since: int = 0, limit: int = 1000):
+            """changes to the readings after the 'since' sequence number, oldest first"""
+            reset, more, changes = self._readings_changes.since(since, limit)
+            return ReadingsChanges(
+                sequence=self._readings_changes.sequence,
+                reset=reset,
+                more=more,
+                changes=[
+                    ReadingsChange(
+                        sequence=change.sequence,
+                        timestamp=change.timestamp,
+                        readings=change.readings,
+                    )
+                    for change in changes
+                ],
+            )
+
+        @app.get(self.base_url + HISTORY_ENDPOINT + "/{metric}")
+        async def get_history(
+            metric: str,
+            from_: None | float = Query(None, alias="from"),
+            to: None | float = None,
+            step: float = 0,
+            agg: str = "mean",
+            points: int = 500,
+        ):
+            """
+            samples of a reading between 'from' and 'to' (unix seconds, default the last hour),
+            aggregated ('agg': mean, min, max or last) into one per 'step' seconds, if given,
+            and reduced to 'points' points
+            """
+            if metric not in history.METRICS:
+                raise HTTPException(
+                    status_code=HTTPStatus.NOT_FOUND,
+                    detail=f"metric '{metric}' not found",
+                )
+            if agg not in history.AGGREGATES:
+                raise HTTPException(
+                    status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+                    detail=f"'agg' must be one of {', '.join(history.AGGREGATES)}",
+                )
+            if step < 0 or not 3 <= points <= MAX_HISTORY_POINTS:
+                raise HTTPException(
+                    status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+                    detail=f"'step' can't be negative, and 'points' must be between 3 and {MAX_HISTORY_POINTS}",
+                )
+
+            to = time.time() if to is None else to
+            from_ = to - 60 * 60 if from_ is None else from_
+            samples = self._readings_history.query(metric, from_, to, step, agg, points)
+            return MetricHistory(
+                metric=metric,
+                step=step,
+                agg=agg,
+                points=[
+                    HistoryPoint(timestamp=timestamp, value=value)
+                    for timestamp, value in samples
+                ],
             )
 
         # actuators
 
-        @nicegui.app.get(self.base_url + ELECTROVALVE_ENDPOINT)
-        async def get_electrovalves_state():
-            return State(opened=self._electrovalves.is_on())
+        @app.get(self.base_url + ELECTROVALVE_ENDPOINT, response_model=State)
+        async def get_electrovalves_state(request: Request):
+            return self._readings_response(
+                request,
+                ELECTROVALVE_ENDPOINT,
+                self._electrovalves.is_on(),
+                lambda v: State(opened=v),
+            )
 
-        @nicegui.app.post(self.base_url + ELECTROVALVE_ENDPOINT)
+        @app.post(self.base_url + ELECTROVALVE_ENDPOINT)
         async def set_electrovalves_state(state: State):
             if state.opened:
                 self._electrovalves.on()
             else:
                 self._electrovalves.off()
 
-        @nicegui.app.get(self.base_url + FANS_ENDPOINT)
-        async def get_fans_state():
-            return Percentage(percent=self._fans.get())
+        @app.get(self.base_url + FANS_ENDPOINT, response_model=Percentage)
+        async def get_fans_state(request: Request):
+            return self._readings_response(
+                request,
+                FANS_ENDPOINT,
+                self._fans.get(),
+                lambda v: Percentage(percent=v),
+            )
 
-        @nicegui.app.post(self.base_url + FANS_ENDPOINT)
+        @app.post(self.base_url + FANS_ENDPOINT)
         async def set_fans_state(percentage: Percentage):
             self._fans.set(percentage.percent)
 
+        @app.post(self.base_url + ACTUATORS_BATCH_ENDPOINT)
+        async def apply_actuators_batch(
+            batch: ActuatorsBatch,
+            request: Request,
+            idempotency_key: None | str = Header(None, alias=IDEMPOTENCY_KEY_HEADER),
+        ) -> AppliedBatch:
+            """
+            applies all commands or none, only the last one for each actuator. requests retried
+            with the same Idempotency-Key header get the first result, without applying again
+            """
+            key = (request.client.host, idempotency_key)
+            if idempotency_key is not None and key in self._applied_batches:
+                commands, applied = self._applied_batches[key]
+                if commands != batch.commands:
+                    raise HTTPException(
+                        status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+                        detail=f"'{idempotency_key}' was used for other commands",
+                    )
+                self._applied_batches.move_to_end(key)
+                return AppliedBatch(
+                    applied=applied.applied, coalesced=applied.coalesced, replayed=True
+                )
+
+            applied = self._apply_batch(batch.commands)
+            if idempotency_key is not None:
+                self._applied_batches[key] = (batch.commands, applied)
+                if len(self._applied_batches) > self._max_applied_batches:
+                    self._applied_batches.popitem(last=False)
+            return applied
+
         # host
 
-        @nicegui.app.get(self.base_url + CPU_ENDPOINT)
-        async def get_cpu():
-            return Percentage(percent=self._host_cpu.get())
+        @app.get(self.base_url + CPU_ENDPOINT, response_model=Percentage)
+        async def get_cpu(request: Request):
+            return self._readings_response(
+                request,
+                CPU_ENDPOINT,
+                self._host_cpu.get(),
+                lambda v: Percentage(percent=v),
+            )
 
-        @nicegui.app.get(self.base_url + DISK_ENDPOINT)
-        async def get_disk():
-            return Percentage(percent=self._host_disk.get())
+        @app.get(self.base_url + DISK_ENDPOINT, response_model=Percentage)
+        async def get_disk(request: Request):
+            return self._readings_response(
+                request,
+                DISK_ENDPOINT,
+                self._host_disk.get(),
+                lambda v: Percentage(percent=v),
+            )
 
-        @nicegui.app.get(self.base_url + RAM_ENDPOINT)
-        async def get_ram():
-            return Percentage(percent=self._host_ram.get())
+        @app.get(self.base_url + RAM_ENDPOINT, response_model=Percentage)
+        async def get_ram(request: Request):
+            return self._readings_response(
+                request,
+                RAM_ENDPOINT,
+                self._host_ram.get(),
+                lambda v: Percentage(percent=v),
+            )
 
-        @nicegui.app.get(self.base_url + HOST_TEMPERATURE_ENDPOINT)
-        async def get_host_temperature():
-            return TemperatureMeasurement(degrees=self._host_temperature.get())
+        @app.get(
+            self.base_url + HOST_TEMPERATURE_ENDPOINT,
+            response_model=TemperatureMeasurement,
+        )
+        async def get_host_temperature(request: Request):
+            return self._readings_response(
+                request,
+                HOST_TEMPERATURE_ENDPOINT,
+                self._host_temperature.get(),
+                lambda v: TemperatureMeasurement(degrees=v),
+            )
 
         # sensors
 
-        @nicegui.app.get(self.base_url + CO2_ENDPOINT)
-        async def get_co2():
-            return GasMeasurement(ppm=self._sensor_co2.read())
+        @app.get(self.base_url + CO2_ENDPOINT, response_model=GasMeasurement)
+        async def get_co2(request: Request):
+            return self._readings_response(
+                request,
+                CO2_ENDPOINT,
+                self._sensor_co2.read(),
+                lambda v: GasMeasurement(ppm=v),
+            )
+
+        @app.get(self.base_url + HUMIDITY_ENDPOINT, response_model=Percentage)
+        async def get_humidity(request: Request):
+            return self._readings_response(
+                request,
+                HUMIDITY_ENDPOINT,
+                self._sensor_humidity.read(),
+                lambda v: Percentage(percent=v),
+            )
+
+        @app.get(self.base_url + NH3_ENDPOINT, response_model=GasMeasurement)
+        async def get_nh3(request: Request):
+            return self._readings_response(
+                request,
+                NH3_ENDPOINT,
+                self._sensor_nh3.read(),
+                lambda v: GasMeasurement(ppm=v),
+            )
+
+        @app.get(
+            self.base_url + SENSOR_TEMPERATURE_ENDPOINT,
+            response_model=TemperatureMeasurement,
+        )
+        async def get_sensor_temperature(request: Request):
+            return self._readings_response(
+                request,
+                SENSOR_TEMPERATURE_ENDPOINT,
+                self._sensor_temperature.read(),
+                lambda v: TemperatureMeasurement(degrees=v),
+            )
+
+        # schedules
 
-        @nicegui.app.get(self.base_url + HUMIDITY_ENDPOINT)
-        async def get_humidity():
-            return Percentage(percent=self._sensor_humidity.read())
+        @app.get(self.base_url + HUMIDITY_SCHEDULE_ENDPOINT)
+        async def get_humidity_schedule(hours: float = 24 * 7, step_secs: float = 3600):
+            """upcoming target relative humidity trajectory"""
+            if hours <= 0 or step_secs <= 0:
+                raise HTTPException(
+                    status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+                    detail="'hours' and 'step_secs' must be positive",
+                )
+            step_secs = max(step_secs, hours * 60 * 60 / MAX_SCHEDULE_POINTS)
 
-        @nicegui.app.get(self.base_url + NH3_ENDPOINT)
-        async def get_nh3():
-            return GasMeasurement(ppm=self._sensor_nh3.read())
+            now = datetime.now()
+            points = self._humidity_schedule.trajectory(
+                now, now + timedelta(hours=hours), step_secs
+            )
+            return Trajectory(
+                current=self._humidity_schedule.target_at(now),
+                points=[
+                    TargetPoint(timestamp=timestamp, target=target)
+                    for timestamp, target in points
+                ],
+            )
 
-        @nicegui.app.get(self.base_url + SENSOR_TEMPERATURE_ENDPOINT)
-        async def get_sensor_temperature():
-            return TemperatureMeasurement(degrees=self._sensor_temperature.read())
+        # controller
+
+        @app.get(self.base_url + CONTROL_RUNTIME_ENDPOINT)
+        async def get_control_runtime():
+            stats = self._control_runtime.statistics()
+            return ControlRuntimeStats(
+                tick_secs=stats.tick_secs,
+                ticks=stats.ticks,
+                overruns=stats.overruns,
+                skipped_ticks=stats.skipped_ticks,
+                last_duration_ms=stats.last_duration * 1000,
+                mean_duration_ms=stats.mean_duration * 1000,
+                max_duration_ms=stats.max_duration * 1000,
+                mean_cpu_ms=stats.mean_cpu * 1000,
+                p99_duration_ms=stats.p99_duration * 1000,
+                last_lateness_ms=stats.last_lateness * 1000,
+                mean_lateness_ms=stats.mean_lateness * 1000,
+                max_lateness_ms=stats.max_lateness * 1000,
+                p99_lateness_ms=stats.p99_lateness * 1000,
+                tasks=[
+                    TaskTimings(
+                        name=task.name,
+                        runs=task.runs,
+                        failures=task.failures,
+                        mean_duration_ms=task.mean_duration * 1000,
+                        max_duration_ms=task.max_duration * 1000,
+                        mean_cpu_ms=task.mean_cpu * 1000,
+                    )
+                    for task in stats.tasks
+                ],
+            )
+
+        @app.get(self.base_url + SHADOW_CONTROLLER_ENDPOINT)
+        async def get_shadow_controller(last: int = 0):
+            """divergence between live and candidate controllers, with the 'last' decisions"""
+            if self._shadow_controller is None:
+                raise HTTPException(
+                    status_code=HTTPStatus.NOT_FOUND,
+                    detail="shadow controller not enabled",
+                )
+
+            stats = self._shadow_controller.statistics()
+            return ShadowStats(
+                ticks=stats.ticks,
+                fan_divergent_ticks=stats.fan_divergent_ticks,
+                fan_mean_abs_difference=stats.fan_mean_abs_difference,
+                fan_max_abs_difference=stats.fan_max_abs_difference,
+                candidate_faster_fan_ticks=stats.candidate_faster_fan_ticks,
+                electrovalves_divergent_ticks=stats.electrovalves_divergent_ticks,
+                live_mean_cpu_us=stats.live_mean_cpu * 1e6,
+                candidate_mean_cpu_us=stats.candidate_mean_cpu * 1e6,
+                candidate_max_cpu_us=stats.candidate_max_cpu * 1e6,
+                decisions=[
+                    ShadowDecision(
+                        timestamp=decision.timestamp,
+                        live_fan_speed=decision.live_fan_speed,
+                        candidate_fan_speed=decision.candidate_fan_speed,
+                        live_electrovalves=decision.live_electrovalves,
+                        candidate_electrovalves=decision.candidate_electrovalves,
+                        live_cpu_us=decision.live_cpu * 1e6,
+                        candidate_cpu_us=decision.candidate_cpu * 1e6,
+                    )
+                    for decision in self._shadow_controller.decisions(last)
+                ],
+            )
+
+        # discovery
+
+        @app.get(self.base_url + DISCOVERY_EVENTS_ENDPOINT)
+        async def get_discovery_events():
+            """node added/removed events queued for and delivered to subscribers"""
+            stats = self._discovery.dispatcher.statistics()
+            return DiscoveryEventsStats(
+                queue_depth=stats.queue_depth,
+                max_queue_depth=stats.max_queue_depth,
+                queued=stats.queued,
+                dispatched=stats.dispatched,
+                coalesced=stats.coalesced,
+                failures=stats.failures,
+                last_latency_ms=stats.last_latency * 1000,
+                mean_latency_ms=stats.mean_latency * 1000,
+                max_latency_ms=stats.max_latency * 1000,
+            )
+
+        @app.get(self.base_url + DISCOVERY_LINKS_ENDPOINT)
+        async def get_discovery_links():
+            """
+            round trip times, loss and clock offsets, from pinging each node.
+            with the version, API port and capabilities each node announced
+            """
+            links = list()
+            for link in self._discovery.link_stats():
+                metadata = self._discovery.node_metadata(link.ip)
+                links.append(
+                    PeerLinkStats(
+                        ip=link.ip,
+                        sent=link.sent,
+                        received=link.received,
+                        loss_rate=link.loss_rate,
+                        last_rtt_ms=_ms(link.last_rtt),
+                        srtt_ms=_ms(link.srtt),
+                        rttvar_ms=link.rttvar * 1000,
+                        rto_ms=_ms(link.rto),
+                        clock_offset_ms=_ms(link.clock_offset),
+                        clock_offset_error_ms=link.clock_offset_error * 1000,
+                        jitter_histogram=link.jitter_histogram,
+                        version=None if metadata is None else metadata.version,
+                        api_port=None if metadata is None else metadata.api_port,
+                        capabilities=(
+                            list() if metadata is None else metadata.capabilities
+                        ),
+                    )
+                )
+            return links
 
         # configs
 
-        @nicegui.app.get(self.base_url + CONFIGS_ENDPOINT + "/{section}")
+        @app.get(self.base_url + CONFIGS_ENDPOINT + "/{section}")
         async def get_configs(section: str):
             try:
                 return configs[section]
@@ -235,7 +830,7 @@ class API:
                     status_code=404, detail="config section '{section}' not found"
                 )
 
-        @nicegui.app.get(self.base_url + CONFIGS_ENDPOINT + "/{section}/{option}")
+        @app.get(self.base_url + CONFIGS_ENDPOINT + "/{section}/{option}")
         async def get_config(section: str, option: str):
             try:
                 return Config(value=configs[section].get(option))
@@ -244,7 +839,7 @@ class API:
                     status_code=404, detail="config section '{section}' not found"
                 )
 
-        @nicegui.app.post(self.base_url + CONFIGS_ENDPOINT)
+        @app.post(self.base_url + CONFIGS_ENDPOINT)
         async def set_configs(value: Configs):
             return configs.set_multiple(
                 (
@@ -302,6 +897,134 @@ class API:
                 )
             )
 
-        @nicegui.app.post(self.base_url + CONFIGS_ENDPOINT + "/{section}/{option}")
+        @app.post(self.base_url + CONFIGS_ENDPOINT + "/{section}/{option}")
         async def set_config(section: str, option: str, value: Config):
             return configs.set(section, option, value.value)
+
+    def serve(self):
+        """serves the API on its own event loop (with separate_server). blocks"""
+        uvicorn.run(
+            self.app,
+            host="0.0.0.0",
+            port=self._port,
+            log_level=logging.WARNING,
+            access_log=False,  # see access.AccessLog
+        )
+
+    def _apply_batch(self, commands: list[ActuatorCommand]) -> AppliedBatch:
+        """
+        runs on the event loop, so other requests can't change actuators halfway through.
+        if an actuator fails, the ones already changed are set back
+        """
+        latest: dict[str, ActuatorCommand] = dict()
+        for command in commands:
+            latest.pop(command.actuator, None)  # ordered by the last command
+            latest[command.actuator] = command
+
+        for command in latest.values():
+            value = (
+                command.opened
+                if command.actuator == "electrovalves"
+                else command.percent
+            )
+            if value is None:
+                raise HTTPException(
+                    status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+                    detail=f"missing value for '{command.actuator}'",
+                )
+
+        opened = self._electrovalves.is_on()
+        percent = self._fans.get()
+        try:
+            for command in latest.values():
+                if command.actuator == "fans":
+                    self._fans.set(command.percent)
+                elif command.opened:
+                    self._electrovalves.on()
+                else:
+                    self._electrovalves.off()
+        except Exception:
+            self._logger.exception("actuators batch failed, setting actuators back")
+            self._fans.set(percent)
+            if opened:
+                self._electrovalves.on()
+            else:
+                self._electrovalves.off()
+            raise HTTPException(
+                status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+                detail="actuators batch failed, nothing was applied",
+            )
+
+        return AppliedBatch(
+            applied=list(latest.values()),
+            coalesced=len(commands) - len(latest),
+            replayed=False,
+        )
+
+    def _readings_response(
+        self,
+        request: Request,
+        endpoint: str,
+        values: typing.Any,
+        build: typing.Callable[[typing.Any], pydantic.BaseModel],
+        build_binary: None | typing.Callable[[typing.Any], bytes] = None,
+    ) -> Response:
+        """
+        json response (or binary, if build_binary is given and the client accepts it), only
+        encoded again if the values changed since the last request. binary snapshots carry the
+        time they're sent, so they're encoded for each request (they're small and cheap to pack).
+        304 without a body if the client already has these values (If-None-Match)
+        """
+        binary = (
+            build_binary is not None
+            and readings.MEDIA_TYPE in request.headers.get("accept", "")
+        )
+        media_type = readings.MEDIA_TYPE if binary else "application/json"
+        key = f"{endpoint} {media_type}"
+
+        encoded = self._encoded.get(key)
+        if encoded is None or encoded.values != values:
+            sequence = 1 if encoded is None else encoded.sequence + 1
+            body = None if binary else build(values).json().encode()
+            encoded = _Encoded(values, sequence, body)
+            self._encoded[key] = encoded
+
+        etag = f'"{self._epoch}-{encoded.sequence}{"b" if binary else ""}"'
+        headers = {"ETag": etag, "Vary": "Accept"}
+        if etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+        body = build_binary(values) if binary else encoded.body
+        return Response(body, media_type=media_type, headers=headers)
+
+    async def _readings_events(self, request: Request) -> typing.AsyncIterator[str]:
+        """
+        one per subscriber. readings are only read again after the previous event was sent,
+        so slow subscribers get fewer (merged) events instead of a growing backlog
+        """
+        self._stream_subscribers += 1
+        try:
+            sent: dict[str, typing.Any] = dict()
+            idle_secs = 0.0
+            while not await request.is_disconnected():
+                current = asdict(self._local_readings.read())
+                changed = {
+                    name: value
+                    for name, value in current.items()
+                    if name not in sent or sent[name] != value
+                }
+                if len(changed) > 0:
+                    sent = current
+                    idle_secs = 0.0
+                    yield f"event: readings\ndata: {json.dumps(changed)}\n\n"
+                elif idle_secs >= STREAM_KEEPALIVE_SECS:
+                    idle_secs = 0.0
+                    yield ": keepalive\n\n"
+
+                await asyncio.sleep(self._stream_interval)
+                idle_secs += self._stream_interval
+        finally:
+            self._stream_subscribers -= 1
+
+
+def _ms(seconds: None | float) -> None | float:
+    return None if seconds is None else seconds * 1000
@@ -1,8 +1,16 @@
+import asyncio
+import json
 import logging
+import time
 import typing
+import uuid
+from dataclasses import dataclass
+from http import HTTPStatus
+import aiohttp
 import requests
 from . import api
 from . import configurations
+from . import readings
 
 
 class APIClient:
@@ -13,12 +21,102 @@ class APIClient:
         self._base_api_url = configs["api"].get("base_path")
         self._port = configs["api"].getint("port")
         self._sessions_by_ip: dict[str, requests.Session] = dict()
+        # (ip, endpoint, accept) -> (ETag, parsed response) of the latest readings,
+        # sent back in conditional requests
+        self._cached_readings: dict[
+            tuple[str, str, str], tuple[str, typing.Any]
+        ] = dict()
+        self._request_timeout = configs["api"].getfloat("request_timeout")  # seconds
+        self._round_trip_timeouts: None | typing.Callable[[str], None | float] = None
+        self._api_ports: None | typing.Callable[[str], None | int] = None
+
+    def set_round_trip_timeouts(self, source: typing.Callable[[str], None | float]):
+        """source of the measured round trip timeout (seconds) to each node ip, None if unknown"""
+        self._round_trip_timeouts = source
+
+    def set_api_ports(self, source: typing.Callable[[str], None | int]):
+        """source of the API port announced by each node ip, None to use this node's port"""
+        self._api_ports = source
 
     # all readings (actuators, host and sensors)
 
     def get_all_readings(self, ip: str) -> api.AllReadings:
         return self._get_all_readings(ip, api.ALL_READINGS_ENDPOINT)
 
+    def get_readings(self, ip: str) -> readings.Readings:
+        """
+        all readings, in the compact binary encoding (see readings.encode).
+        nodes running older versions answer with json instead
+        """
+        return self._get_if_changed(
+            ip,
+            api.ALL_READINGS_ENDPOINT,
+            self._parse_readings,
+            accept=f"{readings.MEDIA_TYPE}, application/json;q=0.5",
+        )
+
+    def get_readings_changes(
+        self, ip: str, since: int, limit: int = 1000
+    ) -> api.ReadingsChanges:
+        """
+        changes to the node's readings after the 'since' sequence number (see
+        readings.ReadingsChanges). pass the last change's sequence to catch up after a gap
+        """
+        session = self._get_session(ip)
+        endpoint = api.READINGS_CHANGES_ENDPOINT
+        self._log_call("GET", endpoint, ip)
+
+        response = session.get(
+            self._url(ip, endpoint),
+            params={"since": since, "limit": limit},
+            timeout=self._timeout(ip),
+        )
+        response.raise_for_status()
+
+        json = response.json()
+        return api.ReadingsChanges(
+            sequence=json["sequence"],
+            reset=json["reset"],
+            more=json["more"],
+            changes=[
+                api.ReadingsChange(
+                    sequence=change["sequence"],
+                    timestamp=change["timestamp"],
+                    readings=change["readings"],
+                )
+                for change in json["changes"]
+            ],
+        )
+
+    def stream_readings(self, ip: str) -> typing.Iterator[dict[str, typing.Any]]:
+        """
+        readings (see readings.Readings) that changed since the previous item, all of them first,
+        as the node pushes them. blocks until the next change, ends with the connection
+        """
+        session = self._get_session(ip)
+        endpoint = api.READINGS_STREAM_ENDPOINT
+        self._log_call("GET", endpoint, ip)
+
+        connect_timeout, _ = self._timeout(ip)
+        with session.get(
+            self._url(ip, endpoint),
+            stream=True,
+            # nodes running older versions compress the stream if allowed, holding events back
+            headers={"Accept-Encoding": "identity"},
+            # missing 2 keepalives means the connection is gone
+            timeout=(connect_timeout, 2 * api.STREAM_KEEPALIVE_SECS),
+        ) as response:
+            response.raise_for_status()
+
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:") :].strip()
+                elif line.startswith("data:") and event == "readings":
+                    yield json.loads(line[len("data:") :])
+                elif line == "":
+                    event = None
+
     # actuators
 
     def get_electrovalves_state(self, ip: str) -> api.State:
@@ -33,6 +131,52 @@ class APIClient:
     def set_fans_state(self, ip: str, percentage: float):
         self._set_percentage(ip, api.FANS_ENDPOINT, percentage)
 
+    def apply_batch(
+        self,
+        ip: str,
+        commands: list[api.ActuatorCommand],
+        idempotency_key: None | str = None,
+        retries: int = 1,
+    ) -> api.AppliedBatch:
+        """
+        applies all commands on the node, or none (see api.ActuatorsBatch), in a single request.
+        requests that fail to get an answer are retried with the same idempotency key,
+        so the node doesn't apply them twice
+        """
+        session = self._get_session(ip)
+        endpoint = api.ACTUATORS_BATCH_ENDPOINT
+        if idempotency_key is None:
+            idempotency_key = uuid.uuid4().hex
+
+        for attempt in range(retries + 1):
+            self._log_call("POST", endpoint, ip)
+            try:
+                response = session.post(
+                    self._url(ip, endpoint),
+                    data=api.ActuatorsBatch(commands=commands).json(),
+                    headers={api.IDEMPOTENCY_KEY_HEADER: idempotency_key},
+                    timeout=self._timeout(ip),
+                )
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == retries:
+                    raise
+        response.raise_for_status()
+
+        json = response.json()
+        return api.AppliedBatch(
+            applied=[
+                api.ActuatorCommand(
+                    actuator=command["actuator"],
+                    opened=command["opened"],
+                    percent=command["percent"],
+                )
+                for command in json["applied"]
+            ],
+            coalesced=json["coalesced"],
+            replayed=json["replayed"],
+        )
+
     # host
 
     def get_cpu(self, ip: str) -> api.Percentage:
@@ -61,6 +205,31 @@ class APIClient:
     def get_sensor_temperature(self, ip: str) -> api.TemperatureMeasurement:
         return self._get_temperature_measurement(ip, api.SENSOR_TEMPERATURE_ENDPOINT)
 
+    # schedules
+
+    def get_humidity_schedule(
+        self, ip: str, hours: float = 24 * 7, step_secs: float = 3600
+    ) -> api.Trajectory:
+        session = self._get_session(ip)
+        endpoint = api.HUMIDITY_SCHEDULE_ENDPOINT
+        self._log_call("GET", endpoint, ip)
+
+        response = session.get(
+            self._url(ip, endpoint),
+            params={"hours": hours, "step_secs": step_secs},
+            timeout=self._timeout(ip),
+        )
+        response.raise_for_status()
+
+        json = response.json()
+        return api.Trajectory(
+            current=json["current"],
+            points=[
+                api.TargetPoint(timestamp=point["timestamp"], target=point["target"])
+                for point in json["points"]
+            ],
+        )
+
     # configs
 
     def get_configs(self, ip: str, section: str) -> typing.Dict[str, str]:
@@ -69,7 +238,8 @@ class APIClient:
         self._log_call("GET", endpoint, ip)
 
         response = session.get(
-            f"http://{ip}:{self._port}{self._base_api_url}{endpoint}"
+            self._url(ip, endpoint),
+            timeout=self._timeout(ip),
         )
         response.raise_for_status()
         return response.json()
@@ -80,7 +250,8 @@ class APIClient:
         self._log_call("GET", endpoint, ip)
 
         response = session.get(
-            f"http://{ip}:{self._port}{self._base_api_url}{endpoint}"
+            self._url(ip, endpoint),
+            timeout=self._timeout(ip),
         )
         response.raise_for_status()
         return api.Config(value=response.json()["value"])
@@ -91,8 +262,9 @@ class APIClient:
         self._log_call("POST", endpoint, ip)
 
         response = session.post(
-            f"http://{ip}:{self._port}{self._base_api_url}{endpoint}",
+            self._url(ip, endpoint),
             data=value.json(),
+            timeout=self._timeout(ip),
         )
         response.raise_for_status()
 
@@ -102,23 +274,16 @@ class APIClient:
         self._log_call("POST", endpoint, ip)
 
         response = session.post(
-            f"http://{ip}:{self._port}{self._base_api_url}{endpoint}",
+            self._url(ip, endpoint),
             data=api.Config(value=value).json(),
+            timeout=self._timeout(ip),
         )
         response.raise_for_status()
 
     # helpers
 
     def _get_all_readings(self, ip: str, endpoint: str) -> api.AllReadings:
-        session = self._get_session(ip)
-        self._log_call("GET", endpoint, ip)
-
-        response = session.get(
-            f"http://{ip}:{self._port}{self._base_api_url}{endpoint}"
-        )
-        response.raise_for_status()
-
-        json = response.json()
+        json = self._get_if_changed(ip, endpoint)
         return api.AllReadings(
             electrovalves=api.State(opened=json["electrovalves"]["opened"]),
             fans=api.Percentage(percent=json["fans"]["percent"]),
@@ -136,54 +301,30 @@ class APIClient:
             ),
         )
 
-    def _get_state(self, ip: str, endpoint: str) -> api.State:
-        session = self._get_session(ip)
-        self._log_call("GET", endpoint, ip)
-
-        response = session.get(
-            f"http://{ip}:{self._port}{self._base_api_url}{endpoint}"
-        )
-        response.raise_for_status()
+    def _parse_readings(self, response: requests.Response) -> readings.Readings:
+        try:
+            return _parse_readings(
+                response.headers.get("Content-Type", ""), response.content
+            )
+        except ValueError as e:
+            raise requests.HTTPError(str(e), response=response)
 
-        json = response.json()
+    def _get_state(self, ip: str, endpoint: str) -> api.State:
+        json = self._get_if_changed(ip, endpoint)
         return api.State(opened=json["opened"])
 
     def _get_percentage(self, ip: str, endpoint: str) -> api.Percentage:
-        session = self._get_session(ip)
-        self._log_call("GET", endpoint, ip)
-
-        response = session.get(
-            f"http://{ip}:{self._port}{self._base_api_url}{endpoint}"
-        )
-        response.raise_for_status()
-
-        json = response.json()
+        json = self._get_if_changed(ip, endpoint)
         return api.Percentage(percent=json["percent"])
 
     def _get_temperature_measurement(
         self, ip: str, endpoint: str
     ) -> api.TemperatureMeasurement:
-        session = self._get_session(ip)
-        self._log_call("GET", endpoint, ip)
-
-        response = session.get(
-            f"http://{ip}:{self._port}{self._base_api_url}{endpoint}"
-        )
-        response.raise_for_status()
-
-        json = response.json()
+        json = self._get_if_changed(ip, endpoint)
         return api.TemperatureMeasurement(degrees=json["degrees"])
 
     def _get_gas_measurement(self, ip: str, endpoint: str) -> api.GasMeasurement:
-        session = self._get_session(ip)
-        self._log_call("GET", endpoint, ip)
-
-        response = session.get(
-            f"http://{ip}:{self._port}{self._base_api_url}{endpoint}"
-        )
-        response.raise_for_status()
-
-        json = response.json()
+        json = self._get_if_changed(ip, endpoint)
         return api.GasMeasurement(ppm=json["ppm"])
 
     def _set_state(self, ip: str, endpoint: str, opened: bool):
@@ -191,8 +332,9 @@ class APIClient:
         session = self._get_session(ip)
 
         response = session.post(
-            f"http://{ip}:{self._port}{self._base_api_url}{endpoint}",
+            self._url(ip, endpoint),
             data=api.State(opened=opened).json(),
+            timeout=self._timeout(ip),
         )
         response.raise_for_status()
 
@@ -201,11 +343,55 @@ class APIClient:
         self._log_call("POST", endpoint, ip)
 
         response = session.post(
-            f"http://{ip}:{self._port}{self._base_api_url}{endpoint}",
+            self._url(ip, endpoint),
             data=api.Percentage(percent=percentage).json(),
+            timeout=self._timeout(ip),
         )
         response.raise_for_status()
 
+    def _url(self, ip: str, endpoint: str) -> str:
+        return _url(ip, self._port, self._api_ports, self._base_api_url + endpoint)
+
+    def _timeout(self, ip: str) -> tuple[float, float]:
+        """(connect, read) seconds"""
+        round_trip_timeout = None
+        if self._round_trip_timeouts is not None:
+            round_trip_timeout = self._round_trip_timeouts(ip)
+        return _timeout(self._request_timeout, round_trip_timeout)
+
+    def _get_if_changed(
+        self,
+        ip: str,
+        endpoint: str,
+        parse: typing.Callable[
+            [requests.Response], typing.Any
+        ] = requests.Response.json,
+        accept: str = "application/json",
+    ) -> typing.Any:
+        """parsed readings endpoint response. only transferred if changed since the last request"""
+        session = self._get_session(ip)
+        self._log_call("GET", endpoint, ip)
+
+        headers = {"Accept": accept}
+        cached = self._cached_readings.get((ip, endpoint, accept))
+        if cached is not None:
+            headers["If-None-Match"] = cached[0]
+
+        response = session.get(
+            self._url(ip, endpoint),
+            headers=headers,
+            timeout=self._timeout(ip),
+        )
+        response.raise_for_status()
+        if response.status_code == HTTPStatus.NOT_MODIFIED and cached is not None:
+            return cached[1]
+
+        parsed = parse(response)
+        etag = response.headers.get("ETag")
+        if etag is not None:
+            self._cached_readings[(ip, endpoint, accept)] = (etag, parsed)
+        return parsed
+
     def _get_session(self, ip: str):
         if ip not in self._sessions_by_ip:
             self._sessions_by_ip[ip] = requests.Session()
@@ -213,3 +399,202 @@ class APIClient:
 
     def _log_call(self, method: str, endpoint: str, host: str):
         self._logger.info("OUTGOING REQUEST: %s %s %s", method, host, endpoint)
+
+
+@dataclass
+class NodeResult:
+    """result of a request to a node, sent with AsyncAPIClient.gather"""
+
+    ip: str
+    value: typing.Any = None
+    error: None | Exception = None  # the request failed
+    duration: float = 0.0  # seconds
+
+
+class AsyncAPIClient:
+    """
+    API client to send the same request to many nodes at once (see gather), from its own
+    event loop thread. Each node gets a pool of at most 'connections_per_node' keep-alive
+    connections, created on first use
+    """
+
+    def __init__(self, configs: configurations.Configurations):
+        self._logger = logging.getLogger("services." + self.__class__.__name__)
+        self._base_api_url = configs["api"].get("base_path")
+        self._port = configs["api"].getint("port")
+        self._connections_per_node = configs["api"].getint("connections_per_node")
+        self._request_timeout = configs["api"].getfloat("request_timeout")  # seconds
+        self._round_trip_timeouts: None | typing.Callable[[str], None | float] = None
+        self._api_ports: None | typing.Callable[[str], None | int] = None
+
+        self._loop = asyncio.new_event_loop()
+        # created and closed on self._loop
+        self._sessions_by_ip: dict[str, aiohttp.ClientSession] = dict()
+
+    def set_round_trip_timeouts(self, source: typing.Callable[[str], None | float]):
+        """source of the measured round trip timeout (seconds) to each node ip, None if unknown"""
+        self._round_trip_timeouts = source
+
+    def set_api_ports(self, source: typing.Callable[[str], None | int]):
+        """source of the API port announced by each node ip, None to use this node's port"""
+        self._api_ports = source
+
+    def run(self):
+        """runs the event loop requests are sent from, until stopped. blocks"""
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._close_sessions())
+        self._loop.close()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def gather(
+        self,
+        ips: typing.Iterable[str],
+        request: typing.Callable[[str], typing.Awaitable[typing.Any]],
+    ) -> list[NodeResult]:
+        """
+        runs request(ip) (ex: lambda ip: client.set_configs(ip, configs)) for all ips at once,
+        and waits for all of them. results are in the same order as ips.
+        thread safe, but not to be called from the client's own event loop
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self._gather(list(ips), request), self._loop
+        ).result()
+
+    # requests, to run with gather
+
+    async def get_readings(self, ip: str) -> readings.Readings:
+        """all readings, in the compact binary encoding (see APIClient.get_readings)"""
+        async with self._request(
+            ip,
+            "GET",
+            api.ALL_READINGS_ENDPOINT,
+            headers={"Accept": f"{readings.MEDIA_TYPE}, application/json;q=0.5"},
+        ) as response:
+            return _parse_readings(response.content_type, await response.read())
+
+    async def set_configs(self, ip: str, value: api.Configs):
+        async with self._request(ip, "POST", api.CONFIGS_ENDPOINT, data=value.json()):
+            pass
+
+    async def apply_batch(
+        self,
+        ip: str,
+        commands: list[api.ActuatorCommand],
+        idempotency_key: None | str = None,
+    ) -> api.AppliedBatch:
+        """see APIClient.apply_batch. not retried, callers can retry with the same key"""
+        async with self._request(
+            ip,
+            "POST",
+            api.ACTUATORS_BATCH_ENDPOINT,
+            data=api.ActuatorsBatch(commands=commands).json(),
+            headers={api.IDEMPOTENCY_KEY_HEADER: idempotency_key or uuid.uuid4().hex},
+        ) as response:
+            return api.AppliedBatch(**await response.json())
+
+    async def _gather(
+        self,
+        ips: list[str],
+        request: typing.Callable[[str], typing.Awaitable[typing.Any]],
+    ) -> list[NodeResult]:
+        async def timed(ip: str) -> NodeResult:
+            result = NodeResult(ip)
+            start = time.perf_counter()
+            try:
+                result.value = await request(ip)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                result.error = e
+            result.duration = time.perf_counter() - start
+            return result
+
+        return await asyncio.gather(*(timed(ip) for ip in ips))
+
+    def _request(
+        self,
+        ip: str,
+        method: str,
+        endpoint: str,
+        data: None | str = None,  # json
+        headers: None | dict[str, str] = None,
+    ) -> typing.AsyncContextManager[aiohttp.ClientResponse]:
+        headers = dict(headers or dict())
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+        self._logger.info("OUTGOING REQUEST: %s %s %s", method, ip, endpoint)
+        round_trip_timeout = None
+        if self._round_trip_timeouts is not None:
+            round_trip_timeout = self._round_trip_timeouts(ip)
+        connect, read = _timeout(self._request_timeout, round_trip_timeout)
+
+        return self._get_session(ip).request(
+            method,
+            self._url(ip, endpoint),
+            data=data,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+            raise_for_status=True,
+        )
+
+    def _url(self, ip: str, endpoint: str) -> str:
+        return _url(ip, self._port, self._api_ports, self._base_api_url + endpoint)
+
+    def _get_session(self, ip: str) -> aiohttp.ClientSession:
+        if ip not in self._sessions_by_ip:
+            self._sessions_by_ip[ip] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._connections_per_node)
+            )
+        return self._sessions_by_ip[ip]
+
+    async def _close_sessions(self):
+        for session in self._sessions_by_ip.values():
+            await session.close()
+        self._sessions_by_ip.clear()
+
+
+def _url(
+    ip: str,
+    default_port: int,
+    api_ports: None | typing.Callable[[str], None | int],
+    path: str,
+) -> str:
+    """on the port the node announced, if any (ex: nodes serving the API on its own server)"""
+    port = None if api_ports is None else api_ports(ip)
+    return f"http://{ip}:{port or default_port}{path}"
+
+
+def _timeout(
+    request_timeout: float, round_trip_timeout: None | float
+) -> tuple[float, float]:
+    """
+    (connect, read) seconds. connecting takes a single round trip, so it doesn't wait
+    longer than one retransmitted SYN (1s) and a few round trips on links known to be fast
+    """
+    if round_trip_timeout is None:
+        return request_timeout, request_timeout
+    return min(request_timeout, 1 + 4 * round_trip_timeout), request_timeout
+
+
+def _parse_readings(content_type: str, content: bytes) -> readings.Readings:
+    """binary snapshot (see readings.encode) or json, as answered by older nodes"""
+    if content_type.startswith(readings.MEDIA_TYPE):
+        decoded = readings.decode(content)
+        if decoded is None:
+            raise ValueError("unsupported readings snapshot version")
+        return decoded[1]
+
+    values = json.loads(content)
+    return readings.Readings(
+        electrovalves=values["electrovalves"]["opened"],
+        fans=values["fans"]["percent"],
+        host_cpu=values["host_cpu"]["percent"],
+        host_disk=values["host_disk"]["percent"],
+        host_ram=values["host_ram"]["percent"],
+        host_temperature=values["host_temperature"]["degrees"],
+        co2=values["co2"]["ppm"],
+        humidity=values["humidity"]["percent"],
+        nh3=values["nh3"]["ppm"],
+        sensor_temperature=values["sensor_temperature"]["degrees"],
+    )
@@ -6,6 +6,27 @@ import threading
 import typing
 
 
+def parse_overrides(overrides: typing.Iterable[str]) -> dict[str, dict[str, str]]:
+    """['section.option=value', ...] -> {section: {option: value}}. skips blank overrides"""
+    parsed: dict[str, dict[str, str]] = dict()
+    for override in overrides:
+        if override.strip() == "":
+            continue
+
+        key, value = override.split("=", 1)
+        section, option = key.strip().split(".", 1)
+        parsed.setdefault(section, dict())[option] = value.strip()
+    return parsed
+
+
+class InMemoryConfigurations(configparser.ConfigParser):
+    """configs whose changes apply immediately and are never saved (ex: candidates, simulations)"""
+
+    def set_multiple(self, options: typing.Sequence[typing.Tuple[str, str, str]]):
+        for section, option, value in options:
+            self.set(section, option, value)
+
+
 class Configurations(configparser.ConfigParser):
     def __init__(self):
         super().__init__()
@@ -18,7 +39,8 @@ class Configurations(configparser.ConfigParser):
 
         self._logger.info("reading configs...")
         self._generate_config_file()
-        self.read(self.config_file)
+        # defaults first, so options added in newer versions exist in older config files
+        self.read((self._default_config_file, self.config_file))
 
     def set(self, section: str, option: str, value: str):
         threading.Thread(target=self._set, args=(section, option, value)).start()
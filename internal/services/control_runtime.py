@@ -0,0 +1,234 @@
+import collections
+import logging
+import math
+import threading
+import time
+import typing
+from dataclasses import dataclass, field
+from datetime import datetime
+from . import configurations
+from . import percentiles
+
+
+@dataclass
+class SensorSnapshot:
+    """sensor readings taken once per tick, shared by all control tasks"""
+
+    taken_at: datetime
+    co2: float
+    humidity: float
+    nh3: float
+    temperature: float
+
+
+@dataclass
+class TaskStatistics:
+    name: str
+    runs: int = 0
+    failures: int = 0
+    total_duration: float = 0.0
+    max_duration: float = 0.0
+    total_cpu: float = 0.0  # cpu time of the control thread
+
+    @property
+    def mean_duration(self) -> float:
+        return self.total_duration / self.runs if self.runs > 0 else 0.0
+
+    @property
+    def mean_cpu(self) -> float:
+        return self.total_cpu / self.runs if self.runs > 0 else 0.0
+
+
+@dataclass
+class RuntimeStatistics:
+    """durations and lateness in seconds"""
+
+    tick_secs: float
+    ticks: int = 0
+    overruns: int = 0
+    skipped_ticks: int = 0
+    last_duration: float = 0.0
+    mean_duration: float = 0.0
+    max_duration: float = 0.0
+    mean_cpu: float = 0.0  # cpu time of all tasks per tick
+    p99_duration: float = 0.0
+    last_lateness: float = 0.0
+    mean_lateness: float = 0.0
+    max_lateness: float = 0.0
+    p99_lateness: float = 0.0
+    tasks: list[TaskStatistics] = field(default_factory=list)
+
+
+@dataclass
+class _Task:
+    name: str
+    every_ticks: int
+    run: typing.Callable[[SensorSnapshot], None]
+
+
+class ControlRuntime:
+    """
+    Runs all control tasks from a single fixed-rate tick.
+
+    Tick deadlines are computed from the start time (not from the end of the previous tick),
+    so delays don't accumulate. Ticks that can't be met after an overrun are skipped.
+    """
+
+    def __init__(self, configs: configurations.Configurations):
+        self._logger = logging.getLogger("services." + self.__class__.__name__)
+        self.tick_secs = configs["controller"].getfloat("tick_secs")
+
+        self._tasks: list[_Task] = list()
+        self.last_tick_cpu = 0.0  # cpu time of all tasks in the last tick
+        self._tick_listeners: list[
+            typing.Callable[[SensorSnapshot, int], None]
+        ] = list()
+        self._stop = threading.Event()
+
+        self._stats_lock = threading.Lock()
+        self._stats = RuntimeStatistics(tick_secs=self.tick_secs)
+        self._task_stats: dict[str, TaskStatistics] = dict()
+        self._total_duration = 0.0
+        self._total_lateness = 0.0
+        self._total_cpu = 0.0
+        self._recent_durations: collections.deque[float] = collections.deque(
+            maxlen=1000
+        )
+        self._recent_lateness: collections.deque[float] = collections.deque(maxlen=1000)
+
+    def add_task(
+        self,
+        name: str,
+        task: typing.Callable[[SensorSnapshot], None],
+        every_secs: None | float = None,
+    ):
+        """registers a task to run every tick, or every 'every_secs' seconds (rounded to ticks)"""
+        every_ticks = 1
+        if every_secs is not None:
+            every_ticks = max(1, round(every_secs / self.tick_secs))
+
+        self._tasks.append(_Task(name=name, every_ticks=every_ticks, run=task))
+        with self._stats_lock:
+            self._task_stats[name] = TaskStatistics(name=name)
+
+    def add_tick_listener(self, listener: typing.Callable[[SensorSnapshot, int], None]):
+        """registers a function to call with each snapshot and tick number, after all tasks ran"""
+        self._tick_listeners.append(listener)
+
+    def run(self, take_snapshot: typing.Callable[[], SensorSnapshot]):
+        """runs ticks until stopped. blocks"""
+        self._logger.info(f"starting control loop, ticking every {self.tick_secs}s...")
+
+        start = time.monotonic()
+        tick_number = 0
+        while not self._stop.is_set():
+            deadline = start + tick_number * self.tick_secs
+            if self._stop.wait(max(0.0, deadline - time.monotonic())):
+                return
+
+            tick_start = time.monotonic()
+            snapshot = take_snapshot()
+            self.tick(snapshot, tick_number)
+            self._record_tick(
+                time.monotonic() - tick_start, tick_start - deadline, self.last_tick_cpu
+            )
+
+            for listener in self._tick_listeners:
+                try:
+                    listener(snapshot, tick_number)
+                except Exception:
+                    self._logger.exception("control tick listener failed")
+            tick_end = time.monotonic()
+
+            # next deadline in the future. missed deadlines are skipped, not run late
+            next_tick_number = math.floor((tick_end - start) / self.tick_secs) + 1
+            skipped = next_tick_number - tick_number - 1
+            if skipped > 0:
+                self._logger.warning(
+                    f"control tick {tick_number} overran, skipping {skipped} ticks"
+                )
+                with self._stats_lock:
+                    self._stats.overruns += 1
+                    self._stats.skipped_ticks += skipped
+
+            tick_number = next_tick_number
+
+    def stop(self):
+        self._stop.set()
+
+    def tick(self, snapshot: SensorSnapshot, tick_number: int):
+        """runs all tasks due at the given tick"""
+        tick_cpu = 0.0
+        for task in self._tasks:
+            if tick_number % task.every_ticks != 0:
+                continue
+
+            failed = False
+            task_start = time.perf_counter()
+            task_cpu_start = time.thread_time()
+            try:
+                task.run(snapshot)
+            except Exception:
+                failed = True
+                self._logger.exception(f"control task '{task.name}' failed")
+            cpu = time.thread_time() - task_cpu_start
+            duration = time.perf_counter() - task_start
+
+            with self._stats_lock:
+                task_stats = self._task_stats[task.name]
+                task_stats.runs += 1
+                task_stats.failures += int(failed)
+                task_stats.total_duration += duration
+                task_stats.max_duration = max(task_stats.max_duration, duration)
+                task_stats.total_cpu += cpu
+            tick_cpu += cpu
+
+        self.last_tick_cpu = tick_cpu
+
+    def statistics(self) -> RuntimeStatistics:
+        """copy of current tick statistics"""
+        with self._stats_lock:
+            stats = RuntimeStatistics(
+                tick_secs=self._stats.tick_secs,
+                ticks=self._stats.ticks,
+                overruns=self._stats.overruns,
+                skipped_ticks=self._stats.skipped_ticks,
+                last_duration=self._stats.last_duration,
+                mean_duration=self._stats.mean_duration,
+                max_duration=self._stats.max_duration,
+                mean_cpu=self._stats.mean_cpu,
+                p99_duration=percentiles.percentile(self._recent_durations, 0.99),
+                last_lateness=self._stats.last_lateness,
+                mean_lateness=self._stats.mean_lateness,
+                max_lateness=self._stats.max_lateness,
+                p99_lateness=percentiles.percentile(self._recent_lateness, 0.99),
+                tasks=[
+                    TaskStatistics(
+                        name=task.name,
+                        runs=task.runs,
+                        failures=task.failures,
+                        total_duration=task.total_duration,
+                        max_duration=task.max_duration,
+                        total_cpu=task.total_cpu,
+                    )
+                    for task in self._task_stats.values()
+                ],
+            )
+        return stats
+
+    def _record_tick(self, duration: float, lateness: float, cpu: float):
+        with self._stats_lock:
+            self._stats.ticks += 1
+            self._total_duration += duration
+            self._total_lateness += lateness
+            self._total_cpu += cpu
+            self._recent_durations.append(duration)
+            self._recent_lateness.append(lateness)
+
+            self._stats.last_duration = duration
+            self._stats.mean_duration = self._total_duration / self._stats.ticks
+            self._stats.max_duration = max(self._stats.max_duration, duration)
+            self._stats.mean_cpu = self._total_cpu / self._stats.ticks
+            self._stats.last_lateness = lateness
+            self._stats.mean_lateness = self._total_lateness / self._stats.ticks
+            self._stats.max_lateness = max(self._stats.max_lateness, lateness)
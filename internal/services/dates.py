@@ -117,9 +117,18 @@ class DateCycleTarget(dict[str, int]):
             super().__init__(dates)
 
     def humidity_for(self, from_date: datetime, to_date: datetime) -> None | int:
+        for key in self.keys_for(from_date, to_date):
+            if key in self:
+                return self[key]
+        return None
+
+    def keys_for(self, from_date: datetime, to_date: datetime) -> list[str]:
+        """single days are stored as 'YYYY-MM-DD', intervals as {'from': 'YYYY-MM-DD', 'to': 'YYYY-MM-DD'}"""
         date = {
             "from": f"{from_date.year:04}-{from_date.month:02}-{from_date.day:02}",
             "to": f"{to_date.year:04}-{to_date.month:02}-{to_date.day:02}",
         }
 
-        return self.get(str(date))
+        if from_date == to_date:
+            return [date["from"], str(date)]
+        return [str(date)]
@@ -1,201 +1,1331 @@
+import bisect
+import collections
+import heapq
+import itertools
+import json
 import logging
+import math
+import os
+import psutil
+import random
+import selectors
 import socket
+import struct
 import threading
 import time
-from dataclasses import dataclass
+import typing
+from dataclasses import dataclass, field, replace
 from . import configurations
+from . import dispatcher
+from . import readings
 from . import subscriber
 
 
+JITTER_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500)  # upper bounds, plus overflow
+LOSS_WINDOW = 100  # pings
+CLOCK_WINDOW = (
+    8  # pings, the clock offset of the one with the lowest round trip time is used
+)
+
+PROTOCOL_MAGIC = b"ec"
+PROTOCOL_VERSION = 1
+
+# message types
+PING = 1
+ACK = 2
+PING_REQ = 3  # asks the receiver to ping the target, and forward its ack
+SYNC = 4  # full membership list, answered with SYNC_REPLY
+SYNC_REPLY = 5
+HEARTBEAT = 6  # carries a readings snapshot
+ANNOUNCEMENT = 7  # node metadata, multicast to all nodes in the network
+
+# membership states. for the same incarnation number, the highest prevails
+ALIVE = 0
+SUSPECT = 1
+DEAD = 2
+STATE_NAMES = {ALIVE: "alive", SUSPECT: "suspect", DEAD: "dead"}
+
+# magic, version, message type, sequence number, sender incarnation, target ip, updates count
+HEADER = struct.Struct("!2sBBII4sB")
+# membership state, ip, incarnation
+UPDATE = struct.Struct("!B4sI")
+# unix times the ping was sent (originate), received and answered (transmit). after the updates
+# of PING (originate only) and ACK messages, for round trip times and NTP-style clock offsets
+CLOCK = struct.Struct("!ddd")
+# magic, version, message type, incarnation, api port, capabilities bits, sensors bits
+ANNOUNCEMENT_LAYOUT = struct.Struct("!2sBBIHHH")
+
+# one bit each in announcements, in this order
+CAPABILITIES = ("gossip", "heartbeats", "shadow_controller", "predictive_fans")
+SENSORS = ("co2", "humidity", "nh3", "temperature")
+
+
+@dataclass
+class Update:
+    """membership state of a node, as gossiped"""
+
+    state: int
+    ip: str
+    incarnation: int
+
+
+@dataclass
+class Message:
+    kind: int
+    sequence: int
+    incarnation: int  # of the sender
+    target: str  # node to probe (PING, PING_REQ) or probed (ACK)
+    updates: list[Update] = field(default_factory=list)
+    readings: None | bytes = (
+        None  # encoded snapshot (see readings.encode), after the updates
+    )
+    clock: None | tuple[float, float, float] = None  # see CLOCK
+
+
+def encode_message(message: Message) -> bytes:
+    data = bytearray(HEADER.size + UPDATE.size * len(message.updates))
+    HEADER.pack_into(
+        data,
+        0,
+        PROTOCOL_MAGIC,
+        PROTOCOL_VERSION,
+        message.kind,
+        message.sequence,
+        message.incarnation,
+        socket.inet_aton(message.target),
+        len(message.updates),
+    )
+    for i, update in enumerate(message.updates):
+        UPDATE.pack_into(
+            data,
+            HEADER.size + i * UPDATE.size,
+            update.state,
+            socket.inet_aton(update.ip),
+            update.incarnation,
+        )
+    if message.readings is not None:
+        data += message.readings
+    if message.clock is not None:
+        data += CLOCK.pack(*message.clock)
+    return bytes(data)
+
+
+def decode_message(data: bytes) -> None | Message:
+    """None if not a (valid) membership message"""
+    if len(data) < HEADER.size:
+        return None
+
+    magic, version, kind, sequence, incarnation, target, count = HEADER.unpack_from(
+        data
+    )
+    updates_end = HEADER.size + count * UPDATE.size
+    if (
+        magic != PROTOCOL_MAGIC
+        or version != PROTOCOL_VERSION
+        or len(data) < updates_end
+    ):
+        return None
+
+    updates = list()
+    for i in range(count):
+        state, ip, update_incarnation = UPDATE.unpack_from(
+            data, HEADER.size + i * UPDATE.size
+        )
+        updates.append(Update(state, socket.inet_ntoa(ip), update_incarnation))
+
+    trailer = data[updates_end:]
+    snapshot = None
+    clock = None
+    if kind in (PING, ACK) and len(trailer) == CLOCK.size:
+        clock = CLOCK.unpack(trailer)
+    elif len(trailer) == readings.SNAPSHOT.size:
+        snapshot = trailer
+    return Message(
+        kind, sequence, incarnation, socket.inet_ntoa(target), updates, snapshot, clock
+    )
+
+
+@dataclass
+class NodeMetadata:
+    """announced by each node"""
+
+    version: int  # protocol version
+    api_port: int
+    capabilities: list[str] = field(default_factory=list)
+    sensors: list[str] = field(default_factory=list)
+
+
+def encode_announcement(incarnation: int, metadata: NodeMetadata) -> bytes:
+    return ANNOUNCEMENT_LAYOUT.pack(
+        PROTOCOL_MAGIC,
+        metadata.version,
+        ANNOUNCEMENT,
+        incarnation,
+        metadata.api_port,
+        _to_bits(CAPABILITIES, metadata.capabilities),
+        _to_bits(SENSORS, metadata.sensors),
+    )
+
+
+def decode_announcement(data: bytes) -> None | tuple[int, NodeMetadata]:
+    """(incarnation, metadata), None if not an announcement"""
+    if len(data) < ANNOUNCEMENT_LAYOUT.size:
+        return None
+
+    (
+        magic,
+        version,
+        kind,
+        incarnation,
+        api_port,
+        capabilities,
+        sensors,
+    ) = ANNOUNCEMENT_LAYOUT.unpack_from(data)
+    if magic != PROTOCOL_MAGIC or kind != ANNOUNCEMENT:
+        return None
+
+    return incarnation, NodeMetadata(
+        version=version,
+        api_port=api_port,
+        capabilities=_from_bits(CAPABILITIES, capabilities),
+        sensors=_from_bits(SENSORS, sensors),
+    )
+
+
+def _to_bits(names: tuple[str, ...], selected: list[str]) -> int:
+    return sum(1 << i for i, name in enumerate(names) if name in selected)
+
+
+def _from_bits(names: tuple[str, ...], bits: int) -> list[str]:
+    return [name for i, name in enumerate(names) if bits & (1 << i)]
+
+
 @dataclass
 class Node:
     ip: str
-    failed_pings: int = 0
+    incarnation: int = 0
+    state: int = ALIVE
+
+
+@dataclass
+class PeerLink:
+    """ping statistics for a node"""
+
+    ip: str
+    sent: int = 0
+    received: int = 0
+    last_rtt: None | float = None  # seconds
+    srtt: None | float = None  # smoothed round trip time, seconds
+    rttvar: float = 0.0  # round trip time variation, seconds
+    # seconds the node's clock is ahead of this node's, and its maximum error
+    clock_offset: None | float = None
+    clock_offset_error: float = 0.0
+    # jitter (difference between consecutive RTTs) histogram, one count per JITTER_BUCKETS_MS bucket
+    jitter_histogram: list[int] = field(
+        default_factory=lambda: [0] * (len(JITTER_BUCKETS_MS) + 1)
+    )
+    _outcomes: collections.deque[bool] = field(
+        default_factory=lambda: collections.deque(maxlen=LOSS_WINDOW), repr=False
+    )
+    _clock_samples: collections.deque[tuple[float, float]] = field(
+        default_factory=lambda: collections.deque(maxlen=CLOCK_WINDOW), repr=False
+    )  # (round trip time, clock offset)
+
+    @property
+    def loss_rate(self) -> float:
+        """lost pings fraction, over the last LOSS_WINDOW pings"""
+        if len(self._outcomes) == 0:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    @property
+    def rto(self) -> None | float:
+        """retransmission timeout (RFC 6298), seconds. None until a response is received"""
+        if self.srtt is None:
+            return None
+        return self.srtt + max(0.001, 4 * self.rttvar)
 
-    def __hash__(self):
-        return hash(self.ip)
+    def add_response(self, rtt: float, clock_offset: None | float = None):
+        if self.last_rtt is not None:
+            jitter_ms = abs(rtt - self.last_rtt) * 1000
+            self.jitter_histogram[bisect.bisect_left(JITTER_BUCKETS_MS, jitter_ms)] += 1
 
-    def __eq__(self, __value) -> bool:
-        if isinstance(__value, Node):
-            return self.ip == __value.ip
-        return False
+        # RFC 6298 smoothing
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        # NTP clock filter: the fastest exchange is the least skewed by queueing delays
+        if clock_offset is not None:
+            self._clock_samples.append((rtt, clock_offset))
+            best_rtt, self.clock_offset = min(self._clock_samples)
+            self.clock_offset_error = best_rtt / 2
+
+        self.received += 1
+        self.last_rtt = rtt
+        self._outcomes.append(True)
+
+    def add_loss(self):
+        self._outcomes.append(False)
+
+
+@dataclass
+class _Probe:
+    target: str
+    sent: float
+    # (address, sequence number) of the node that asked for this probe (ping-req)
+    requester: None | tuple[tuple[str, int], int] = None
+
+
+@dataclass
+class _Gossip:
+    update: Update
+    transmissions: int = 0
 
 
 class Discovery:
-    """Handles discovery of other environmental control nodes in the network"""
+    """
+    Handles discovery of other environmental control nodes in the network.
+
+    Nodes announce themselves (and their metadata) to a multicast group every 'announce_interval'
+    seconds, and contact the 'seeds' (nodes in other subnets, comma separated ips). Then they
+    keep a membership list with a SWIM-style gossip protocol (ref: "SWIM: Scalable
+    Weakly-consistent Infection-style Process Group Membership Protocol", Das et al.):
+    - every probe interval, one member is pinged (round robin over the members, in random order)
+    - without an ack in time, 'indirect_probes' other members are asked to ping it (ping-req)
+    - without any ack by the end of the interval, the member is suspected. suspects are declared
+      dead unless they refute it in time, by gossiping a higher incarnation number
+    - membership changes are piggybacked on pings and acks, so each node sends a constant
+      number of packets per interval, no matter how many nodes there are
+    - the full membership list is sent to a random member every 'sync_interval' seconds,
+      and right away to nodes found through announcements
+    - every 'heartbeat_interval' seconds, this node's readings are sent to all members,
+      in a compact binary snapshot (see readings.encode)
+
+    Nodes running older versions (found through legacy broadcasts) are members too, but they
+    only answer plain text pings: they're probed with those, and never gossiped or synced,
+    so other nodes don't probe them with messages they can't answer.
+
+    Known peers are saved to 'peers_file' on membership changes. On startup, each saved peer is
+    pinged once (all at once), and rejoins as soon as it answers.
+
+    All discovery sockets are non-blocking and served by a single selector loop (run()),
+    with announcements, probes and network checks scheduled as timers.
+    """
 
     def __init__(self, configs: configurations.Configurations):
         self._logger = logging.getLogger("services." + self.__class__.__name__)
 
-        broadcast_port = configs["discovery"].getint("port")
+        discovery_configs = configs["discovery"]
+        broadcast_port = discovery_configs.getint("port")
+        # a single address (instead of all interfaces) allows several nodes in one host
+        self.bind_address = discovery_configs.get("bind_address")
+        # announcements. empty multicast_group to only contact the seeds
+        self.multicast_group = discovery_configs.get("multicast_group")
+        self.multicast_address = (self.multicast_group, broadcast_port)
+        self.multicast_ttl = 1  # raise to go through multicast routers
+        self.announce_interval = discovery_configs.getfloat("announce_interval")
+        self.seeds = [
+            seed.strip()
+            for seed in discovery_configs.get("seeds").split(",")
+            if seed.strip() != ""
+        ]
+        # legacy broadcasts, for nodes running older versions
         self.broadcast_address = ("255.255.255.255", broadcast_port)
-        self.is_broadcasting = False
-        self.is_broadcasting_lock = threading.Lock()
 
         self.ping_port = 9433
+        self.probe_interval = discovery_configs.getfloat("probe_interval")  # seconds
+        self.probe_timeout = discovery_configs.getfloat("probe_timeout")  # seconds
+        self.min_probe_timeout = 0.05  # seconds, adaptive timeouts don't go lower
+        self.indirect_probes = discovery_configs.getint("indirect_probes")
+        # suspects are dead after suspicion_multiplier * log10(nodes) * probe_interval
+        self.suspicion_multiplier = discovery_configs.getfloat("suspicion_multiplier")
+        # updates are piggybacked retransmit_multiplier * log10(nodes) times
+        self.retransmit_multiplier = discovery_configs.getint("retransmit_multiplier")
+        self.sync_interval = discovery_configs.getfloat("sync_interval")  # seconds
+        # seconds between readings sent to all members, 0 to disable
+        self.heartbeat_interval = discovery_configs.getfloat("heartbeat_interval")
+        self.max_packet_size = 1400  # bytes, fits an ethernet frame
+
+        self.metadata = NodeMetadata(
+            version=PROTOCOL_VERSION,
+            api_port=configs["api"].getint("port"),
+            capabilities=[
+                capability
+                for capability, enabled in (
+                    ("gossip", True),
+                    ("heartbeats", self.heartbeat_interval > 0),
+                    ("shadow_controller", configs["shadow"].getboolean("enabled")),
+                    ("predictive_fans", configs["fan"].getboolean("predictive")),
+                )
+                if enabled
+            ],
+            sensors=list(SENSORS),
+        )
+        self._metadata: dict[str, NodeMetadata] = dict()  # ip -> announced metadata
+
+        # known peers cache, for warm starts. empty peers_file to disable
+        self.peers_file = discovery_configs.get("peers_file")
+        self.peers_max_age = (
+            7 * 24 * 60 * 60
+        )  # seconds, older cached peers are forgotten
+        self._last_seen: dict[
+            str, float
+        ] = dict()  # ip -> time.time() of the last message
+        # rewrites the peers file at least this often, so members' last_seen stays recent
+        self.peers_refresh_interval = 24 * 60 * 60  # seconds
+        self._peers_saved_at = 0.0  # time.time()
+        self._peers_save_scheduled = False
+        self._peers_file_lock = threading.Lock()
 
         self.message = "environmental_control_node_broadcast"
         self.response = "environmental_control_node_ok"
+        # plain text pings, from nodes running older versions
         self.ping_message = "p!ng"
         self.ping_response = "p0ng"
         self.message_size = len(self.message.encode("utf8"))
         self.response_size = len(self.response.encode("utf8"))
-        self.ping_message_size = len(self.ping_message.encode("utf8"))
-        self.ping_response_size = len(self.ping_response.encode("utf8"))
 
-        self.nodes: set[Node] = set()
+        # incarnations start at the current time, so restarted nodes supersede their old state
+        self.incarnation = int(time.time())
+        self.nodes: dict[str, Node] = dict()  # ip -> alive or suspect node
+        # ips of self.nodes, replaced (never changed) on membership changes. read without locking
+        self.allowed_ips: frozenset[str] = frozenset()
         self.nodes_lock = threading.Lock()
+        self.links: dict[str, PeerLink] = dict()  # ip -> ping statistics
+        self._dead: dict[str, int] = dict()  # ip -> incarnation declared dead
+        self._gossip: dict[str, _Gossip] = dict()  # ip -> latest update to piggyback
+        self._probes: dict[int, _Probe] = dict()  # sequence number -> pending probe
+        self._probe_order: list[str] = list()
+        self._sequence = itertools.count(1)
+        # members that haven't sent a membership message (yet), ex: nodes running older versions
+        self._legacy: set[str] = set()
+
+        # traffic on the membership socket
+        self.sent_packets = 0
+        self.sent_bytes = 0
+        self.received_packets = 0
+        self.received_bytes = 0
+
+        # node added/removed events, delivered to subscribers on the dispatcher thread
+        self.dispatcher = dispatcher.EventDispatcher()
+        self._readings_source: None | typing.Callable[[], readings.Readings] = None
+        self._readings_listeners: list[
+            typing.Callable[[str, float, readings.Readings], None]
+        ] = list()
 
-        self.subscribers: set[subscriber.Subscriber] = set()
+        # own addresses, refreshed when the network configuration changes
+        self.network_check_interval = 10  # seconds
+        self._own_ip = "127.0.0.1"  # default route address
+        self._own_ips: frozenset[str] = frozenset()  # all interfaces
+
+        # event loop
+        self.max_burst = 512  # datagrams read from a socket before serving the others
+        self.receive_buffer_size = 1024 * 1024  # bytes, capped by the OS
+        self._selector = selectors.DefaultSelector()
+        self._timers: list[tuple[float, int, typing.Callable[[], None]]] = list()
+        self._timers_sequence = itertools.count()  # tie breaker for equal deadlines
+        self._callbacks: collections.deque[
+            typing.Callable[[], None]
+        ] = collections.deque()  # from other threads
+        self._stop = threading.Event()
 
         # IPv4 (AF_INET) UDP (SOCK_DGRAM) connections
         self.broadcast_listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.ping_listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.ping_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.know_self_ip_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # wakes the event loop up from other threads
+        self._wakeup_receive_socket, self._wakeup_socket = socket.socketpair()
 
         # listen for a connection from any host on the defined port
-        self.broadcast_listen_socket.bind(("", broadcast_port))
-        self.ping_listen_socket.bind(("", self.ping_port))
+        self.broadcast_listen_socket.bind((self.bind_address, broadcast_port))
+        self.broadcast_socket.bind((self.bind_address, 0))
+        self.ping_socket.bind((self.bind_address, self.ping_port))
 
         # allow socket to be reused (ex: on restart) and allow broadcast usage
         self.broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.broadcast_socket.setsockopt(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl
+        )
 
-        # set socket timeouts
-        self.broadcast_socket.settimeout(5)
-        self.ping_socket.settimeout(5)
+        for sock, handler in (
+            (self.broadcast_listen_socket, self._on_broadcast),
+            (self.broadcast_socket, self._on_broadcast_response),
+            (self.ping_socket, self._on_ping),
+        ):
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size
+            )
+            sock.setblocking(False)
+            self._selector.register(sock, selectors.EVENT_READ, handler)
+        self._wakeup_receive_socket.setblocking(False)
+        self._wakeup_socket.setblocking(False)
+        self._selector.register(
+            self._wakeup_receive_socket, selectors.EVENT_READ, self._on_wakeup
+        )
 
-    def broadcast_listen(self):
-        """listens for broadcasts (ref: https://github.com/jholtmann/ip_discovery)"""
-        self._logger.info("listening for broadcasts...")
+        self._refresh_own_ips()
+        self._join_multicast_group()
+        self._cached_peers = self._load_peers()
 
-        while True:
-            # blocks while waiting for broadcast
-            data, address = self.broadcast_listen_socket.recvfrom(self.message_size)
-            if data.decode("utf-8", "replace") == self.message:
-                ip = str(address[0])  # socket.AF_INET = (host, port)
-                if ip == self.own_ip():
-                    continue
+    def run(self):
+        """runs the discovery event loop until stopped. blocks"""
+        self._logger.info("listening for announcements and membership messages...")
+
+        self._call_later(0, self._revalidate_cached_peers)
+        self._call_later(0, self._announce_round)
+        self._call_later(0, self._probe_round)
+        self._call_later(self.sync_interval, self._sync_round)
+        if self.heartbeat_interval > 0:
+            self._call_later(self.heartbeat_interval, self._heartbeat_round)
+        self._call_later(self.network_check_interval, self._check_network)
+        dispatcher_thread = threading.Thread(target=self.dispatcher.run)
+        dispatcher_thread.start()
+
+        try:
+            while not self._stop.is_set():
+                timeout = None
+                if len(self._timers) > 0:
+                    timeout = max(0.0, self._timers[0][0] - time.monotonic())
+
+                for key, _ in self._selector.select(timeout):
+                    key.data()
+                self._run_timers()
+        finally:
+            self.dispatcher.stop()
+            dispatcher_thread.join()
+            self._selector.close()
+            for sock in (
+                self.broadcast_listen_socket,
+                self.broadcast_socket,
+                self.ping_socket,
+                self.know_self_ip_socket,
+                self._wakeup_receive_socket,
+                self._wakeup_socket,
+            ):
+                sock.close()
+            self._logger.info("discovery stopped")
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup()
+
+    def broadcast(self):
+        """
+        announces this node right away, and broadcasts once for nodes running older versions.
+        safe to call from any thread, doesn't block
+        """
+        self._callbacks.append(self._announce)
+        self._callbacks.append(
+            lambda: self._send(
+                self.broadcast_socket, self.message.encode(), self.broadcast_address
+            )
+        )
+        self._wakeup()
+
+    #
+    # event loop
+    #
+
+    def _call_later(self, delay: float, callback: typing.Callable[[], None]):
+        """schedules a callback on the event loop thread"""
+        heapq.heappush(
+            self._timers,
+            (time.monotonic() + delay, next(self._timers_sequence), callback),
+        )
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while len(self._timers) > 0 and self._timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self._timers)
+            try:
+                callback()
+            except Exception:
+                self._logger.exception("discovery timer failed")
+
+    def _wakeup(self):
+        try:
+            self._wakeup_socket.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # already woken up (or stopped)
+
+    def _on_wakeup(self):
+        try:
+            while self._wakeup_receive_socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while len(self._callbacks) > 0:
+            callback = self._callbacks.popleft()
+            try:
+                callback()
+            except Exception:
+                self._logger.exception("discovery callback failed")
+
+    def _receive(
+        self,
+        sock: socket.socket,
+        size: int,
+        handle: typing.Callable[[bytes, tuple[str, int], str], None],
+    ):
+        """
+        reads queued datagrams without blocking and calls handle(data, address, ip).
+        at most max_burst per call, so a burst on one socket doesn't starve the others
+        """
+        for _ in range(self.max_burst):
+            try:
+                data, address = sock.recvfrom(size)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # ex: ICMP errors from previous sends
+                self._logger.debug(f"discovery socket error: {e}")
+                continue
+
+            ip = str(address[0])  # socket.AF_INET = (host, port)
+            if self.is_own_ip(ip):
+                continue
+            try:
+                handle(data, address, ip)
+            except Exception:
+                self._logger.exception(f"failed to handle packet from {ip}")
+
+    def _send(self, sock: socket.socket, data: bytes, address: tuple[str, int]):
+        try:
+            sock.sendto(data, address)
+        except OSError as e:
+            # send buffer full or network unreachable. UDP may drop packets anyway
+            self._logger.debug(f"failed to send to {address[0]}: {e}")
+
+    #
+    # announcements and broadcasts
+    #
+
+    def _announce_round(self):
+        self._call_later(self.announce_interval, self._announce_round)
+        self._announce()
+
+        with self.nodes_lock:
+            unknown_seeds = [seed for seed in self.seeds if seed not in self.nodes]
+        for seed in unknown_seeds:
+            # seeds join once they answer
+            self._send_sync(SYNC, (seed, self.ping_port))
+
+    def _announce(self):
+        if self.multicast_group != "":
+            self._send(
+                self.broadcast_socket,
+                encode_announcement(self.incarnation, self.metadata),
+                self.multicast_address,
+            )
 
+    def _join_multicast_group(self):
+        if self.multicast_group == "":
+            return
+
+        membership = struct.pack(
+            "4s4s",
+            socket.inet_aton(self.multicast_group),
+            socket.inet_aton(self.bind_address or "0.0.0.0"),
+        )
+        try:
+            self.broadcast_listen_socket.setsockopt(
+                socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, membership
+            )
+        except OSError:
+            pass  # not joined yet
+        try:
+            self.broadcast_listen_socket.setsockopt(
+                socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership
+            )
+        except OSError as e:
+            # ex: no network yet. retried when the network configuration changes
+            self._logger.warning(
+                f"failed to join multicast group {self.multicast_group}: {e}"
+            )
+
+    def _on_broadcast(self):
+        """
+        announcements from other nodes, and broadcasts from nodes running older versions
+        (ref: https://github.com/jholtmann/ip_discovery)
+        """
+
+        def handle(data: bytes, address: tuple[str, int], ip: str):
+            announcement = decode_announcement(data)
+            if announcement is not None:
+                self._on_announcement(ip, *announcement)
+            elif data.decode("utf-8", "replace") == self.message:
                 self._logger.info(f"received broadcast from {ip}")
                 self.add_node(ip)
-                self.broadcast_listen_socket.sendto(self.response.encode(), address)
+                self._send(
+                    self.broadcast_listen_socket, self.response.encode(), address
+                )
 
-    def broadcast(self):
-        """sends broadcasts with 3 retries (ref: https://github.com/jholtmann/ip_discovery)"""
-        with self.is_broadcasting_lock:
-            if self.is_broadcasting:
+        self._receive(
+            self.broadcast_listen_socket,
+            max(self.message_size, ANNOUNCEMENT_LAYOUT.size),
+            handle,
+        )
+
+    def _on_announcement(self, ip: str, incarnation: int, metadata: NodeMetadata):
+        with self.nodes_lock:
+            changed = self._metadata.get(ip) != metadata
+            self._metadata[ip] = metadata
+            known = ip in self.nodes
+        if changed:
+            self._schedule_peers_save()
+
+        if not known:
+            self._logger.info(f"received announcement from {ip}")
+            self._apply(Update(ALIVE, ip, incarnation))
+            # answer with the membership list (the node answers with its own)
+            self._send_sync(SYNC, (ip, self.ping_port))
+
+    def _on_broadcast_response(self):
+        def handle(data: bytes, address: tuple[str, int], ip: str):
+            if data.decode("utf-8", "replace") == self.response:
+                self._logger.info(f"received response to broadcast from {ip}")
+                self.add_node(ip)
+
+        self._receive(self.broadcast_socket, self.response_size, handle)
+
+    #
+    # membership protocol
+    #
+
+    def _on_ping(self):
+        """membership messages from other nodes, and plain text pings from older versions"""
+
+        def handle(data: bytes, address: tuple[str, int], ip: str):
+            # per datagram: a burst takes long enough to skew round trips and clocks
+            received = time.monotonic()
+            received_at = time.time()
+            self.received_packets += 1
+            self.received_bytes += len(data)
+
+            message = decode_message(data)
+            if message is None:
+                text = data.decode("utf-8", "replace")
+                if text.startswith(self.ping_message):
+                    sequence = text[len(self.ping_message) :]
+                    self._send(
+                        self.ping_socket,
+                        (self.ping_response + sequence).encode(),
+                        address,
+                    )
+                elif text.startswith(self.ping_response):
+                    self._on_legacy_ack(ip, received)
                 return
-            self.is_broadcasting = True
 
-        tries = 3
-        for i in range(tries):
-            self._logger.info(f"broadcasting, {i+1}/{tries} tries...")
+            self._last_seen[ip] = received_at
+            self._legacy.discard(ip)
+            dead_incarnation = self._dead.get(ip)
+            if dead_incarnation is not None and dead_incarnation >= message.incarnation:
+                # tell the sender it was declared dead, so it can refute it
+                self._gossip[ip] = _Gossip(Update(DEAD, ip, dead_incarnation))
 
-            try:
-                self.broadcast_socket.sendto(
-                    self.message.encode(), self.broadcast_address
+            # any message is proof the sender is alive
+            self._apply(Update(ALIVE, ip, message.incarnation))
+            for update in message.updates:
+                self._apply(update)
+
+            if message.kind == PING:
+                clock = None
+                if message.clock is not None:
+                    clock = (message.clock[0], received_at, time.time())
+                self._send_message(
+                    ACK, address, message.sequence, message.target, clock
                 )
+            elif message.kind == PING_REQ:
+                self._probe(message.target, requester=(address, message.sequence))
+            elif message.kind == ACK:
+                self._on_ack(message, ip, received, received_at)
+            elif message.kind == SYNC:
+                self._send_sync(SYNC_REPLY, address)
+            elif message.kind == HEARTBEAT and message.readings is not None:
+                self._on_heartbeat(ip, message.readings)
+
+        self._receive(self.ping_socket, self.max_packet_size, handle)
 
-                while True:
-                    # blocks while waiting for response
-                    data, address = self.broadcast_socket.recvfrom(self.response_size)
-                    if data.decode("utf-8", "replace") == self.response:
-                        ip = str(address[0])  # socket.AF_INET = (host, port)
-                        if ip == self.own_ip():
-                            continue
+    def _probe_round(self):
+        """pings the next member. see the Discovery docstring"""
+        self._call_later(self.probe_interval, self._probe_round)
+
+        target = self._next_probe_target()
+        if target is None:
+            return
+
+        sequence = self._probe(target)
+        with self.nodes_lock:
+            self.links.setdefault(target, PeerLink(ip=target)).sent += 1
+        # sooner on links known to be fast, never later than probe_timeout
+        timeout = self.probe_timeout
+        rto = self.round_trip_timeout(target)
+        if rto is not None:
+            timeout = min(timeout, max(self.min_probe_timeout, 2 * rto))
+        self._call_later(timeout, lambda: self._probe_indirectly(sequence))
+        self._call_later(self.probe_interval, lambda: self._probe_expired(sequence))
+
+    def _next_probe_target(self) -> None | str:
+        """members in random order, each once per round (bounds the time to detect failures)"""
+        while True:
+            if len(self._probe_order) == 0:
+                with self.nodes_lock:
+                    self._probe_order = list(self.nodes)
+                random.shuffle(self._probe_order)
+                if len(self._probe_order) == 0:
+                    return None
+
+            target = self._probe_order.pop()
+            with self.nodes_lock:
+                if target in self.nodes:
+                    return target
 
-                        self._logger.info(
-                            f"received response to broadcast from {address[0]}"
-                        )
+    def _probe(
+        self,
+        target: str,
+        requester: None | tuple[tuple[str, int], int] = None,
+    ) -> int:
+        """pings target, on behalf of another node if requester is given. returns the sequence"""
+        sequence = next(self._sequence) % 2**32
+        self._probes[sequence] = _Probe(
+            target=target, sent=time.monotonic(), requester=requester
+        )
+        if target in self._legacy:
+            # older versions read the first 4 bytes only, and answer without the sequence
+            self._send(
+                self.ping_socket,
+                (self.ping_message + str(sequence)).encode(),
+                (target, self.ping_port),
+            )
+        else:
+            self._send_message(
+                PING,
+                (target, self.ping_port),
+                sequence,
+                target,
+                (time.time(), 0.0, 0.0),
+            )
 
-                        self.add_node(ip)
+        if requester is not None:
+            # the requester gives up by the end of its interval anyway
+            self._call_later(
+                self.probe_interval, lambda: self._probes.pop(sequence, None)
+            )
+        return sequence
 
-            except socket.timeout:
+    def _probe_indirectly(self, sequence: int):
+        """no ack in time, ask other members to ping the target"""
+        probe = self._probes.get(sequence)
+        if probe is None or probe.target in self._legacy:
+            return  # other members can't ping nodes running older versions either
+
+        with self.nodes_lock:
+            candidates = [
+                ip
+                for ip, node in self.nodes.items()
+                if ip != probe.target and node.state == ALIVE and ip not in self._legacy
+            ]
+        for ip in random.sample(candidates, min(self.indirect_probes, len(candidates))):
+            self._send_message(PING_REQ, (ip, self.ping_port), sequence, probe.target)
+
+    def _probe_expired(self, sequence: int):
+        """no ack, direct or indirect, by the end of the probe interval"""
+        probe = self._probes.pop(sequence, None)
+        if probe is None:
+            return
+
+        with self.nodes_lock:
+            node = self.nodes.get(probe.target)
+            if node is None:
+                return
+            self.links.setdefault(probe.target, PeerLink(ip=probe.target)).add_loss()
+            incarnation = node.incarnation
+
+        self._apply(Update(SUSPECT, probe.target, incarnation))
+
+    def _on_ack(self, message: Message, ip: str, received: float, received_at: float):
+        probe = self._probes.get(message.sequence)
+        if probe is None or probe.target != message.target:
+            return  # late, or for another probe
+        del self._probes[message.sequence]
+
+        if probe.requester is not None:
+            address, sequence = probe.requester
+            self._send_message(ACK, address, sequence, probe.target)
+        elif ip == probe.target:
+            rtt = received - probe.sent
+            clock_offset = None
+            if message.clock is not None:
+                originate, receive, transmit = message.clock
+                # the node's own processing time isn't part of the round trip
+                rtt = max(0.0, rtt - (transmit - receive))
+                clock_offset = ((receive - originate) + (transmit - received_at)) / 2
+            with self.nodes_lock:
+                if ip in self.nodes:
+                    self.links.setdefault(ip, PeerLink(ip=ip)).add_response(
+                        rtt, clock_offset
+                    )
+
+    def _on_legacy_ack(self, ip: str, received: float):
+        """plain text answer to a plain text ping. acks the pending probes of the node"""
+        for sequence, probe in list(self._probes.items()):
+            if probe.target != ip or probe.requester is not None:
                 continue
 
-        with self.is_broadcasting_lock:
-            self.is_broadcasting = False
+            del self._probes[sequence]
+            with self.nodes_lock:
+                if ip in self.nodes:
+                    self.links.setdefault(ip, PeerLink(ip=ip)).add_response(
+                        received - probe.sent
+                    )
 
-    def ping_listen(self):
-        """listens for pings"""
-        self._logger.info("listening for pings...")
+    def _sync_round(self):
+        """sends the full membership list to a random member"""
+        self._call_later(self.sync_interval, self._sync_round)
 
-        while True:
-            # blocks while waiting for pings
-            data, address = self.ping_listen_socket.recvfrom(self.ping_message_size)
-            if data.decode("utf-8", "replace") == self.ping_message:
-                ip = str(address[0])  # socket.AF_INET = (host, port)
-                if ip == self.own_ip():
-                    continue
+        with self.nodes_lock:
+            members = [ip for ip in self.nodes if ip not in self._legacy]
+        if len(members) > 0:
+            self._send_sync(SYNC, (random.choice(members), self.ping_port))
+
+        if time.time() - self._peers_saved_at > self.peers_refresh_interval:
+            self._schedule_peers_save()
+
+    def _heartbeat_round(self):
+        """sends this node's readings to all members"""
+        self._call_later(self.heartbeat_interval, self._heartbeat_round)
+        if self._readings_source is None:
+            return
+
+        with self.nodes_lock:
+            members = [
+                ip
+                for ip, node in self.nodes.items()
+                if node.state == ALIVE and ip not in self._legacy
+            ]
+        if len(members) == 0:
+            return
+
+        snapshot = readings.encode(self._readings_source(), time.time())
+        for ip in members:
+            self._send_raw(
+                Message(
+                    HEARTBEAT,
+                    0,
+                    self.incarnation,
+                    ip,
+                    self._piggyback(ip, reserved=len(snapshot)),
+                    snapshot,
+                ),
+                (ip, self.ping_port),
+            )
+
+    def _on_heartbeat(self, ip: str, snapshot: bytes):
+        decoded = readings.decode(snapshot)
+        if decoded is None:
+            return
 
-                self.ping_listen_socket.sendto(self.ping_response.encode(), address)
+        timestamp, node_readings = decoded
+        timestamp = self.to_local_time(ip, timestamp)
+        for listener in self._readings_listeners:
+            try:
+                listener(ip, timestamp, node_readings)
+            except Exception:
+                self._logger.exception(f"readings listener failed for node {ip}")
+
+    def set_readings_source(self, source: typing.Callable[[], readings.Readings]):
+        """readings sent to all members every 'heartbeat_interval' seconds"""
+        self._readings_source = source
 
-    def ping(self):
+    def add_readings_listener(
+        self, listener: typing.Callable[[str, float, readings.Readings], None]
+    ):
         """
-        pings known nodes.
-        Sends "ping" packets every 5 seconds.
-        A node is considered dead if it fails to respond to 3 consecutive pings"
+        registers a function to call with (ip, timestamp, readings) for each heartbeat received,
+        with the sender's timestamp in this node's clock (see to_local_time).
+        runs in the event loop thread, so it must not block
         """
-        self._logger.info("pinging known nodes...")
+        self._readings_listeners.append(listener)
 
-        while True:
-            current_nodes = []
+    def _send_sync(self, kind: int, address: tuple[str, int]):
+        """as many members as fit in a packet, picked at random if not all do"""
+        with self.nodes_lock:
+            updates = [
+                Update(node.state, node.ip, node.incarnation)
+                for node in self.nodes.values()
+                if node.ip not in self._legacy
+            ]
+
+        room = (self.max_packet_size - HEADER.size) // UPDATE.size
+        if len(updates) > room:
+            updates = random.sample(updates, room)
+        self._send_raw(
+            Message(kind, 0, self.incarnation, self.own_ip(), updates), address
+        )
+
+    def _send_message(
+        self,
+        kind: int,
+        address: tuple[str, int],
+        sequence: int,
+        target: str,
+        clock: None | tuple[float, float, float] = None,
+    ):
+        reserved = 0 if clock is None else CLOCK.size
+        self._send_raw(
+            Message(
+                kind,
+                sequence,
+                self.incarnation,
+                target,
+                self._piggyback(address[0], reserved),
+                clock=clock,
+            ),
+            address,
+        )
+
+    def _send_raw(self, message: Message, address: tuple[str, int]):
+        data = encode_message(message)
+        self.sent_packets += 1
+        self.sent_bytes += len(data)
+        self._send(self.ping_socket, data, address)
+
+    def _piggyback(self, to_ip: str, reserved: int = 0) -> list[Update]:
+        """
+        least gossiped updates first. an update about the receiver always goes, so it can refute it.
+        'reserved' bytes of the packet are left for other data
+        """
+        room = (self.max_packet_size - HEADER.size - reserved) // UPDATE.size
+        gossip = sorted(self._gossip.values(), key=lambda g: g.transmissions)[:room]
+        about_receiver = self._gossip.get(to_ip)
+        if about_receiver is not None and about_receiver not in gossip:
+            gossip = gossip[: room - 1] + [about_receiver]
+
+        with self.nodes_lock:
+            nodes = len(self.nodes) + 1
+        limit = self.retransmit_multiplier * math.ceil(math.log10(nodes + 1))
+
+        updates = list()
+        for g in gossip:
+            updates.append(g.update)
+            g.transmissions += 1
+            if g.transmissions >= limit:
+                del self._gossip[g.update.ip]
+        return updates
+
+    def _apply(self, update: Update):
+        """merges a membership update, gossiping it if it changes anything"""
+        if self.is_own_ip(update.ip):
+            if update.state != ALIVE and update.incarnation >= self.incarnation:
+                # refute suspicion (or death) of this node
+                self.incarnation = update.incarnation + 1
+                self._logger.info(
+                    f"refuting {STATE_NAMES[update.state]} state, "
+                    f"incarnation {self.incarnation}"
+                )
+                self._gossip[self.own_ip()] = _Gossip(
+                    Update(ALIVE, self.own_ip(), self.incarnation)
+                )
+            return
+
+        added = False
+        removed = False
+        with self.nodes_lock:
+            node = self.nodes.get(update.ip)
+            if node is None:
+                dead_incarnation = self._dead.get(update.ip)
+                if update.state != ALIVE or (
+                    dead_incarnation is not None
+                    and update.incarnation <= dead_incarnation
+                ):
+                    return  # unknown, or an old update about a dead node
+
+                self.nodes[update.ip] = Node(update.ip, update.incarnation)
+                self._dead.pop(update.ip, None)
+                self.allowed_ips = frozenset(self.nodes)
+                added = True
+            elif update.incarnation < node.incarnation or (
+                update.incarnation == node.incarnation and update.state <= node.state
+            ):
+                return  # nothing new
+            elif update.state == DEAD:
+                del self.nodes[update.ip]
+                self.links.pop(update.ip, None)
+                self._dead[update.ip] = update.incarnation
+                self.allowed_ips = frozenset(self.nodes)
+                removed = True
+            else:
+                node.state = update.state
+                node.incarnation = update.incarnation
+            nodes = len(self.nodes) + 1
+
+        if removed:
+            self._legacy.discard(update.ip)
+        if update.ip not in self._legacy:
+            self._gossip[update.ip] = _Gossip(update)
+        if added or removed:
+            self._schedule_peers_save()
+
+        if update.state == SUSPECT:
+            self._logger.info(f"suspecting node {update.ip}...")
+            suspicion_secs = (
+                self.suspicion_multiplier
+                * max(1.0, math.log10(nodes))
+                * self.probe_interval
+            )
+            self._call_later(
+                suspicion_secs,
+                lambda: self._suspicion_expired(update.ip, update.incarnation),
+            )
+        elif added:
+            self._logger.info(f"node {update.ip} joined")
+            # metadata for nodes out of multicast reach (ex: seeds)
+            self._send(
+                self.broadcast_socket,
+                encode_announcement(self.incarnation, self.metadata),
+                (update.ip, self.multicast_address[1]),
+            )
+            self.dispatcher.node_added(update.ip)
+        elif removed:
+            self._logger.info(f"node {update.ip} is dead. removing node...")
+            self.dispatcher.node_removed(update.ip)
+
+    def _suspicion_expired(self, ip: str, incarnation: int):
+        with self.nodes_lock:
+            node = self.nodes.get(ip)
+            if node is None or node.state != SUSPECT or node.incarnation != incarnation:
+                return  # refuted
+
+        self._apply(Update(DEAD, ip, incarnation))
+
+    #
+    # known peers cache
+    #
+
+    def _load_peers(self) -> list[str]:
+        """ips of cached peers seen in the last 'peers_max_age' seconds. restores their metadata"""
+        if self.peers_file == "" or not os.path.isfile(self.peers_file):
+            return list()
+
+        try:
+            with open(self.peers_file) as peers_file:
+                peers = json.load(peers_file)["peers"]
+            if not isinstance(peers, list):
+                raise ValueError("peers isn't a list")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self._logger.warning(f"ignoring peers file {self.peers_file}: {e}")
+            return list()
+
+        now = time.time()
+        cached = list()
+        for peer in peers:
+            try:
+                ip = str(peer["ip"])
+                last_seen = float(peer["last_seen"])
+                metadata = NodeMetadata(
+                    version=int(peer.get("version", 0)),
+                    api_port=int(peer["api_port"]),
+                    capabilities=list(peer.get("capabilities", list())),
+                    sensors=list(peer.get("sensors", list())),
+                )
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                self._logger.warning(
+                    f"ignoring invalid peer {peer!r} in {self.peers_file}: {e!r}"
+                )
+                continue
+            if now - last_seen > self.peers_max_age or self.is_own_ip(ip):
+                continue
+
+            cached.append(ip)
+            self._last_seen[ip] = last_seen
+            self._metadata[ip] = metadata
+        self._logger.info(f"{len(cached)} cached peers")
+        return cached
+
+    def _revalidate_cached_peers(self):
+        """one ping to each cached peer, all at once. peers that answer rejoin right away"""
+        for ip in self._cached_peers:
+            sequence = self._probe(ip)
             with self.nodes_lock:
-                current_nodes = list(self.nodes)
-
-            if len(current_nodes) > 0:
-                for node in current_nodes:
-                    try:
-                        self.ping_socket.sendto(
-                            self.ping_message.encode(), (node.ip, self.ping_port)
-                        )
-
-                        # blocks while waiting for response
-                        data, address = self.ping_socket.recvfrom(
-                            self.ping_response_size
-                        )
-                        if data.decode("utf-8", "replace") == self.ping_response:
-                            ip = str(address[0])  # socket.AF_INET = (host, port)
-                            if ip == self.own_ip():
-                                continue
-
-                            # node is alive, reset its ping counter
-                            with self.nodes_lock:
-                                if node in self.nodes:
-                                    # replace existing node with the updated one
-                                    self.nodes.discard(node)
-                                    node.failed_pings = 0
-                                    self.nodes.add(node)
-
-                    except socket.timeout:
-                        # no response from node, increment counter
-                        with self.nodes_lock:
-                            if node in self.nodes:
-                                # replace existing node with the updated one
-                                self.nodes.discard(node)
-                                node.failed_pings += 1
-                                self.nodes.add(node)
-
-                        # more than 3 consecutive response failures leads to removal of node
-                        if node.failed_pings >= 3:
-                            self._logger.info(
-                                f"node {node.ip} failed 3 consecutive ping attempts. removing node..."
-                            )
-                            self.remove_node(node.ip)
-
-            time.sleep(5)
+                self.links.setdefault(ip, PeerLink(ip=ip)).sent += 1
+            self._call_later(
+                self.probe_interval,
+                lambda sequence=sequence: self._probes.pop(sequence, None),
+            )
+        self._cached_peers = list()
+
+    def _schedule_peers_save(self):
+        """saves known peers a second from now, once for bursts of changes"""
+        if self.peers_file == "" or self._peers_save_scheduled:
+            return
+        self._peers_save_scheduled = True
+        self._call_later(1, self._save_peers)
+
+    def _save_peers(self):
+        """members, plus peers seen in the last 'peers_max_age' seconds"""
+        self._peers_save_scheduled = False
+
+        now = time.time()
+        self._peers_saved_at = now
+        peers = list()
+        with self.nodes_lock:
+            for ip in set(self.nodes) | set(self._last_seen):
+                last_seen = self._last_seen.get(ip, now)
+                if ip not in self.nodes and now - last_seen > self.peers_max_age:
+                    continue
+
+                metadata = self._metadata.get(
+                    ip, NodeMetadata(0, self.metadata.api_port)
+                )
+                peers.append(
+                    {
+                        "ip": ip,
+                        "last_seen": last_seen,
+                        "api_port": metadata.api_port,
+                        "version": metadata.version,
+                        "capabilities": metadata.capabilities,
+                        "sensors": metadata.sensors,
+                    }
+                )
+
+        # file writes can be slow (ex: SD cards), out of the event loop
+        threading.Thread(target=self._write_peers, args=(peers,)).start()
+
+    def _write_peers(self, peers: list[dict]):
+        """replaces the peers file atomically, so a crash never leaves it half written"""
+        with self._peers_file_lock:
+            temporary_file = self.peers_file + ".tmp"
+            try:
+                with open(temporary_file, "w") as peers_file:
+                    json.dump({"peers": peers}, peers_file, indent=2)
+                    peers_file.flush()
+                    os.fsync(peers_file.fileno())
+                os.replace(temporary_file, self.peers_file)
+            except OSError as e:
+                self._logger.error(f"failed to save peers to {self.peers_file}: {e}")
+
+    def link_stats(self) -> list[PeerLink]:
+        """copy of ping statistics of known nodes"""
+        with self.nodes_lock:
+            return [self._copy_link(link) for link in self.links.values()]
+
+    def link(self, ip: str) -> None | PeerLink:
+        """copy of ping statistics of the node, None if never pinged"""
+        with self.nodes_lock:
+            link = self.links.get(ip)
+            return None if link is None else self._copy_link(link)
+
+    def round_trip_timeout(self, ip: str) -> None | float:
+        """seconds to wait for an answer from the node, None if unknown"""
+        with self.nodes_lock:
+            link = self.links.get(ip)
+            return None if link is None else link.rto
+
+    def api_port(self, ip: str) -> None | int:
+        """port the node announced its API on, None if not announced yet"""
+        with self.nodes_lock:
+            metadata = self._metadata.get(ip)
+            return None if metadata is None else metadata.api_port
+
+    def to_local_time(self, ip: str, timestamp: float) -> float:
+        """node's unix time to this node's clock (ex: heartbeat timestamps)"""
+        with self.nodes_lock:
+            link = self.links.get(ip)
+            if link is None or link.clock_offset is None:
+                return timestamp
+            return timestamp - link.clock_offset
+
+    def _copy_link(self, link: PeerLink) -> PeerLink:
+        return replace(
+            link,
+            jitter_histogram=list(link.jitter_histogram),
+            _outcomes=collections.deque(link._outcomes, maxlen=LOSS_WINDOW),
+            _clock_samples=collections.deque(link._clock_samples, maxlen=CLOCK_WINDOW),
+        )
+
+    def members(self) -> list[Node]:
+        """copy of the membership list, without this node"""
+        with self.nodes_lock:
+            return [Node(n.ip, n.incarnation, n.state) for n in self.nodes.values()]
+
+    def node_metadata(self, ip: str) -> None | NodeMetadata:
+        """metadata announced by the node, None if not received yet"""
+        with self.nodes_lock:
+            metadata = self._metadata.get(ip)
+            if metadata is None:
+                return None
+            return NodeMetadata(
+                metadata.version,
+                metadata.api_port,
+                list(metadata.capabilities),
+                list(metadata.sensors),
+            )
+
+    def _check_network(self):
+        """refreshes own addresses when interfaces or the default route change"""
+        self._call_later(self.network_check_interval, self._check_network)
+        if self._refresh_own_ips():
+            self._join_multicast_group()
 
     def own_ip(self) -> str:
-        # connect() for UDP doesn't send packets
-        self.know_self_ip_socket.connect(("8.8.8.8", 1))
-        return self.know_self_ip_socket.getsockname()[0]
+        """address of the default route interface"""
+        return self._own_ip
+
+    def own_ips(self) -> frozenset[str]:
+        """IPv4 addresses of all interfaces"""
+        return self._own_ips
+
+    def is_own_ip(self, ip: str) -> bool:
+        return ip in self._own_ips
+
+    def _refresh_own_ips(self) -> bool:
+        """true if own addresses changed"""
+        if self.bind_address != "":
+            own_ip = self.bind_address
+            own_ips = {self.bind_address}
+        else:
+            own_ips = {
+                address.address
+                for addresses in psutil.net_if_addrs().values()
+                for address in addresses
+                if address.family == socket.AF_INET
+            }
+
+            own_ip = self._default_route_ip()
+            if own_ip is None:
+                # no default route, prefer any address other than loopback
+                own_ip = min(
+                    (ip for ip in own_ips if not ip.startswith("127.")),
+                    default="127.0.0.1",
+                )
+            own_ips.add(own_ip)
+
+        changed = own_ip != self._own_ip or own_ips != self._own_ips
+        if changed:
+            self._logger.info(f"own ip is {own_ip}, all own ips {sorted(own_ips)}")
+        # single assignments, readers always see a complete set
+        self._own_ips = frozenset(own_ips)
+        self._own_ip = own_ip
+        return changed
+
+    def _default_route_ip(self) -> None | str:
+        try:
+            # connect() for UDP doesn't send packets
+            self.know_self_ip_socket.connect(("8.8.8.8", 1))
+            return self.know_self_ip_socket.getsockname()[0]
+        except OSError:
+            return None
 
     def known_nodes(self) -> list[str]:
         with self.nodes_lock:
-            return [node.ip for node in self.nodes]
+            return list(self.nodes)
 
     #
     # subscription methods
@@ -203,40 +1333,31 @@ class Discovery:
 
     def subscribe(self, *subscribers: subscriber.Subscriber):
         """add subscribers"""
-        self.subscribers.update(subscribers)
-
-    def _notify_new_ip(self, ip: str):
-        """notify subscribers of new node ip"""
-        for sub in self.subscribers:
-            sub.add_ip(ip)
-
-    def _notify_remove_ip(self, ip: str):
-        """notify subscribers of removed node ip"""
-        for sub in self.subscribers:
-            sub.remove_ip(ip)
+        self.dispatcher.subscribers.update(subscribers)
 
     def add_node(self, ip: str):
-        """adds node ip to known node ips list"""
-        notify = False
+        """
+        adds node ip to known node ips list, after direct contact (ex: legacy broadcasts).
+        the node is sent the membership list, and answers with its own. until it does, it's
+        probed with plain text pings, like nodes running older versions (that never answer).
+        call from the event loop thread, or before run()
+        """
+        if self.is_own_ip(ip):
+            return
 
-        node = Node(ip=ip)
         with self.nodes_lock:
-            if node not in self.nodes:
-                self.nodes.add(node)
-                notify = True
-
-        if notify:
-            threading.Thread(target=self._notify_new_ip, args=(ip,)).start()
+            known = ip in self.nodes
+        if not known:
+            self._legacy.add(ip)
+            # its real incarnation comes with its answer
+            self._apply(Update(ALIVE, ip, self._dead.get(ip, -1) + 1))
+        self._send_sync(SYNC, (ip, self.ping_port))
 
     def remove_node(self, ip: str):
         """removes node ip from known node ips list"""
-        notify = False
-
-        node = Node(ip=ip)
         with self.nodes_lock:
-            if node in self.nodes:
-                self.nodes.discard(node)
-                notify = True
+            node = self.nodes.get(ip)
+            incarnation = node.incarnation if node is not None else None
 
-        if notify:
-            threading.Thread(target=self._notify_remove_ip, args=(ip,)).start()
+        if incarnation is not None:
+            self._apply(Update(DEAD, ip, incarnation))
@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from . import subscriber
+
+
+@dataclass
+class DispatcherStatistics:
+    """latencies in seconds, from the first queued event of an ip to its delivery"""
+
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    queued: int = 0
+    dispatched: int = 0
+    coalesced: int = 0  # events that never reached subscribers
+    failures: int = 0
+    last_latency: float = 0.0
+    mean_latency: float = 0.0
+    max_latency: float = 0.0
+
+
+@dataclass
+class _Pending:
+    added: bool  # latest state, True for added and False for removed
+    queued_at: float  # time.monotonic() of the first queued event
+    events: int
+
+
+class EventDispatcher:
+    """
+    Delivers node added/removed events to subscribers, in order, from a single thread.
+
+    Events for an ip still waiting in the queue are merged into its latest state, and events
+    that leave subscribers where they were (ex: added then removed) are dropped.
+    The queue holds at most one entry per ip.
+    """
+
+    def __init__(self):
+        self._logger = logging.getLogger("services." + self.__class__.__name__)
+        self.subscribers: set[subscriber.Subscriber] = set()
+
+        self._condition = threading.Condition()
+        self._pending: dict[str, _Pending] = dict()  # ip -> queued state, in order
+        self._delivered: set[str] = set()  # ips subscribers were last told were added
+        self._stop = False
+
+        self._stats = DispatcherStatistics()
+        self._total_latency = 0.0
+
+    def run(self):
+        """delivers queued events until stopped. blocks"""
+        while True:
+            with self._condition:
+                while len(self._pending) == 0 and not self._stop:
+                    self._condition.wait()
+                if self._stop:
+                    return
+
+                ip = next(iter(self._pending))
+                pending = self._pending.pop(ip)
+                self._stats.queue_depth = len(self._pending)
+
+            self._deliver(ip, pending)
+
+    def stop(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+
+    def node_added(self, ip: str):
+        self._queue(ip, added=True)
+
+    def node_removed(self, ip: str):
+        self._queue(ip, added=False)
+
+    def statistics(self) -> DispatcherStatistics:
+        with self._condition:
+            return DispatcherStatistics(**vars(self._stats))
+
+    def _queue(self, ip: str, added: bool):
+        """thread safe, doesn't block"""
+        with self._condition:
+            self._stats.queued += 1
+            pending = self._pending.get(ip)
+            if pending is not None:
+                # keeps its place in the queue
+                pending.added = added
+                pending.events += 1
+                return
+
+            self._pending[ip] = _Pending(added, time.monotonic(), 1)
+            self._stats.queue_depth = len(self._pending)
+            self._stats.max_queue_depth = max(
+                self._stats.max_queue_depth, self._stats.queue_depth
+            )
+            self._condition.notify()
+
+    def _deliver(self, ip: str, pending: _Pending):
+        if pending.added == (ip in self._delivered):
+            with self._condition:
+                self._stats.coalesced += pending.events
+            return
+
+        failed = False
+        for sub in self.subscribers:
+            try:
+                if pending.added:
+                    sub.add_ip(ip)
+                else:
+                    sub.remove_ip(ip)
+            except Exception:
+                failed = True
+                self._logger.exception(f"subscriber failed handling {ip}")
+
+        if pending.added:
+            self._delivered.add(ip)
+        else:
+            self._delivered.discard(ip)
+
+        latency = time.monotonic() - pending.queued_at
+        with self._condition:
+            stats = self._stats
+            stats.dispatched += 1
+            stats.coalesced += pending.events - 1
+            stats.failures += int(failed)
+            self._total_latency += latency
+            stats.last_latency = latency
+            stats.mean_latency = self._total_latency / stats.dispatched
+            stats.max_latency = max(stats.max_latency, latency)
@@ -1,6 +1,5 @@
 import logging
 import threading
-import requests
 from dataclasses import dataclass
 from typing import Any
 from nicegui import ui
@@ -271,6 +270,7 @@ class Frontend(subscriber.Subscriber):
         configs: configurations.Configurations,
         actuator_controller: actuators_controller.ActuatorsController,
         api_client: api_client.APIClient,
+        async_api_client: api_client.AsyncAPIClient,
         discovery: discovery.Discovery,
         poller_manager: poller.PollerManager,
         electrovalves: interfaces.ActuatorOnOff,
@@ -289,6 +289,7 @@ class Frontend(subscriber.Subscriber):
         self._configs = configs
         self._actuator_controller = actuator_controller
         self._api_client = api_client
+        self._async_api_client = async_api_client
         self._discovery = discovery
         self._poller_manager = poller_manager
         self._electrovalves = electrovalves
@@ -303,6 +304,9 @@ class Frontend(subscriber.Subscriber):
         self._sensor_temperature = sensor_temperature
 
         self.port = configs["api"].getint("port")
+        if configs["api"].getboolean("separate_server"):
+            # the api has the port to itself
+            self.port = configs["api"].getint("dashboard_port")
         self.node_cards: dict[str, ui.card] = dict()  # ip -> node card
 
         self._update_local_configs_lock = threading.Lock()
@@ -827,6 +831,14 @@ class Frontend(subscriber.Subscriber):
             with ui.image("./assets/raspberry-pi.png").classes("object-top scale-50"):
                 ui.label(poller.ip).classes("absolute-bottom text-center")
 
+            link_label = ui.label(self._link_summary(poller.ip)).classes(
+                "self-center text-xs"
+            )
+            ui.timer(
+                self._configs["poller"].getint("update_interval"),
+                lambda: link_label.set_text(self._link_summary(poller.ip)),
+            )
+
             ui.label("node info").classes("self-center")
             with ui.row():
                 with ui.card():
@@ -1033,9 +1045,20 @@ class Frontend(subscriber.Subscriber):
 
         return node_card
 
+    def _link_summary(self, ip: str) -> str:
+        """round trip time, loss and clock offset, from discovery pings"""
+        link = self._discovery.link(ip)
+        if link is None or link.srtt is None:
+            return "link: no answered pings yet"
+
+        summary = f"rtt {link.srtt * 1000:.1f} ± {link.rttvar * 1000:.1f} ms, loss {link.loss_rate:.0%}"
+        if link.clock_offset is not None:
+            summary += f", clock {link.clock_offset * 1000:+.1f} ms"
+        return summary
+
     def search_for_nodes(self):
         ui.notify(f"searching for new nodes...")
-        threading.Thread(target=self._discovery.broadcast).start()
+        self._discovery.broadcast()
 
     def update_local_configs(self):
         ui.notify(f"updating configs for current node...")
@@ -1147,18 +1170,19 @@ class Frontend(subscriber.Subscriber):
                     nh3_full_speed=str(self.nh3_fan_speeds.full_speed),
                 ),
             )
-            for node_ip in self._discovery.known_nodes():
-                try:
-                    self._api_client.set_configs(node_ip, configs_for_nodes)
-                except (requests.HTTPError, requests.exceptions.ConnectionError) as e:
-                    status_code = None
-                    reason = None
-                    if e.response is not None:
-                        status_code = e.response.status_code
-                        reason = e.response.reason
-
+            # sent to all nodes at once
+            results = self._async_api_client.gather(
+                self._discovery.known_nodes(),
+                lambda ip: self._async_api_client.set_configs(ip, configs_for_nodes),
+            )
+            for result in results:
+                if result.error is not None:
                     self._logger.error(
-                        f"error updating configs for node {node_ip}: status code {status_code}, reason {reason}",
+                        f"error updating configs for node {result.ip}: {result.error}",
+                    )
+                else:
+                    self._logger.debug(
+                        f"updated configs for node {result.ip} in {result.duration * 1000:.1f} ms"
                     )
 
     def _update_chart(self, chart: ui.chart, values: list[int] | list[float]):
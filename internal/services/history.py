@@ -0,0 +1,161 @@
+import itertools
+import threading
+import typing
+from array import array
+from dataclasses import fields
+from . import configurations
+from . import readings
+
+
+METRICS = tuple(f.name for f in fields(readings.Readings))
+AGGREGATES: dict[str, typing.Callable[[list[float]], float]] = {
+    "mean": lambda values: sum(values) / len(values),
+    "min": min,
+    "max": max,
+    "last": lambda values: values[-1],
+}
+
+
+class History:
+    """
+    Last 'history_size' samples of each reading (see readings.Readings), for time range queries.
+    Samples are kept in fixed size arrays, 8 bytes per sample and reading (plus the timestamp).
+    Electrovalves are 1.0 when opened.
+    """
+
+    def __init__(self, configs: configurations.Configurations):
+        self._capacity = configs["readings"].getint("history_size")
+        self._lock = threading.Lock()
+        self._timestamps = array("d", bytes(8 * self._capacity))
+        self._values = {
+            metric: array("d", bytes(8 * self._capacity)) for metric in METRICS
+        }
+        self._next = 0  # next ring position
+        self._count = 0
+
+    def record(self, sample: readings.Readings, timestamp: float):
+        with self._lock:
+            self._timestamps[self._next] = timestamp
+            for metric, values in self._values.items():
+                values[self._next] = float(getattr(sample, metric))
+            self._next = (self._next + 1) % self._capacity
+            self._count = min(self._count + 1, self._capacity)
+
+    def query(
+        self,
+        metric: str,
+        start: float,
+        end: float,
+        step: float = 0.0,
+        aggregate: str = "mean",
+        points: None | int = None,
+    ) -> list[tuple[float, float]]:
+        """
+        (timestamp, value) samples of metric between start and end (unix seconds), oldest first.
+        with a step (seconds), samples are aggregated (see AGGREGATES) into one per step.
+        with points, they're then reduced to that many points, keeping the shape of the series
+        """
+        timestamps, values = self._between(metric, start, end)
+        if step > 0:
+            timestamps, values = _aggregate(
+                timestamps, values, start, step, AGGREGATES[aggregate]
+            )
+        if points is not None:
+            timestamps, values = lttb(timestamps, values, points)
+        return list(zip(timestamps, values))
+
+    def _between(self, metric: str, start: float, end: float) -> tuple[array, array]:
+        """copies of the timestamps and values between start and end"""
+        with self._lock:
+            oldest = (self._next - self._count) % self._capacity
+            first = self._bisect(oldest, start)
+            last = self._bisect(oldest, end, right=True)
+            if first >= last:
+                return array("d"), array("d")
+
+            # the range may wrap around the end of the ring
+            position = (oldest + first) % self._capacity
+            length = last - first
+            timestamps = self._timestamps[position : position + length]
+            values = self._values[metric][position : position + length]
+            if len(timestamps) < length:
+                rest = length - len(timestamps)
+                timestamps += self._timestamps[:rest]
+                values += self._values[metric][:rest]
+            return timestamps, values
+
+    def _bisect(self, oldest: int, timestamp: float, right: bool = False) -> int:
+        """first sample (counted from the oldest) after timestamp, or at it unless 'right'"""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            sample = self._timestamps[(oldest + middle) % self._capacity]
+            if sample < timestamp or (right and sample == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+def _aggregate(
+    timestamps: typing.Sequence[float],
+    values: typing.Sequence[float],
+    start: float,
+    step: float,
+    aggregate: typing.Callable[[list[float]], float],
+) -> tuple[list[float], list[float]]:
+    """one sample per step, timestamped at the start of the step"""
+    aggregated_timestamps = list()
+    aggregated_values = list()
+    for bucket, samples in itertools.groupby(
+        zip(timestamps, values), key=lambda sample: int((sample[0] - start) // step)
+    ):
+        aggregated_timestamps.append(start + bucket * step)
+        aggregated_values.append(aggregate([value for _, value in samples]))
+    return aggregated_timestamps, aggregated_values
+
+
+def lttb(
+    timestamps: typing.Sequence[float], values: typing.Sequence[float], points: int
+) -> tuple[typing.Sequence[float], typing.Sequence[float]]:
+    """
+    Largest-Triangle-Three-Buckets downsampling (ref: "Downsampling Time Series for Visual
+    Representation", Steinarsson). keeps the first and last samples, and from each bucket in
+    between, the sample forming the largest triangle with the previous one and the next bucket
+    """
+    count = len(timestamps)
+    if points >= count or points < 3:
+        return timestamps, values
+
+    sampled_timestamps = [timestamps[0]]
+    sampled_values = [values[0]]
+    bucket_size = (count - 2) / (points - 2)
+    previous = 0
+    for i in range(points - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, count)
+
+        # average of the next bucket (the last sample, for the last bucket)
+        if end < next_end:
+            next_timestamp = sum(timestamps[end:next_end]) / (next_end - end)
+            next_value = sum(values[end:next_end]) / (next_end - end)
+        else:
+            next_timestamp = timestamps[-1]
+            next_value = values[-1]
+
+        previous_timestamp = timestamps[previous]
+        previous_value = values[previous]
+        previous = max(
+            range(start, end),
+            key=lambda j: abs(
+                (previous_timestamp - next_timestamp) * (values[j] - previous_value)
+                - (previous_timestamp - timestamps[j]) * (next_value - previous_value)
+            ),
+        )
+        sampled_timestamps.append(timestamps[previous])
+        sampled_values.append(values[previous])
+
+    sampled_timestamps.append(timestamps[-1])
+    sampled_values.append(values[-1])
+    return sampled_timestamps, sampled_values
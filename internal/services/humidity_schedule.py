@@ -0,0 +1,156 @@
+import bisect
+import logging
+import threading
+from datetime import datetime, timedelta
+from . import configurations
+from .dates import Dates, DateCycleTarget
+
+
+class HumiditySchedule:
+    """
+    Target relative humidity trajectory across all configured humidity cycles.
+
+    Each cycle ramps the target linearly, from the target in effect when the cycle starts
+    (midnight of its first day) until the cycle target (midnight after its last day).
+    The trajectory is precomputed as a list of knots and only depends on the configs,
+    so it can be evaluated at any moment and stays the same across restarts.
+    """
+
+    def __init__(self, configs: configurations.Configurations):
+        self._logger = logging.getLogger("services." + self.__class__.__name__)
+        self._configs = configs
+
+        self._lock = threading.Lock()
+        self._knots_key: None | tuple[str, str, str] = None
+        self._times: list[float] = list()  # knot timestamps, sorted
+        self._targets: list[float] = list()  # knot targets
+        self._base_target = 0.0
+
+    def target_at(self, when: datetime) -> float:
+        """target relative humidity at the given moment (linear interpolation between knots)"""
+        times, targets, base_target = self._knots()
+        return self._interpolate(times, targets, base_target, when.timestamp())
+
+    def trajectory(
+        self, start: datetime, end: datetime, step_secs: float
+    ) -> list[tuple[float, float]]:
+        """(timestamp, target) samples every step_secs between start and end, including knots in between"""
+        times, targets, base_target = self._knots()
+        start_ts = start.timestamp()
+        end_ts = end.timestamp()
+
+        timestamps = set(t for t in times if start_ts <= t <= end_ts)
+        timestamp = start_ts
+        while timestamp < end_ts:
+            timestamps.add(timestamp)
+            timestamp += step_secs
+        timestamps.add(end_ts)
+
+        return [
+            (t, self._interpolate(times, targets, base_target, t))
+            for t in sorted(timestamps)
+        ]
+
+    def completed(self, when: datetime) -> None | tuple[float, Dates, DateCycleTarget]:
+        """
+        folds cycles that ended before the given moment.
+        returns the new base target and the remaining cycles and cycle targets,
+        or None if no cycle has ended yet
+        """
+        cycles = self._configs["electrovalve"].get("humidity_cycle")
+        cycle_targets = self._configs["electrovalve"].get("humidity_cycle_targets")
+
+        date_intervals = Dates(cycles)
+        remaining = Dates("")
+        remaining.extend(
+            (date_from, date_to)
+            for date_from, date_to in date_intervals
+            if self._cycle_end(date_to) > when
+        )
+        if len(remaining) == len(date_intervals):
+            return None
+
+        last_cycle_end = max(
+            self._cycle_end(date_to)
+            for _, date_to in date_intervals
+            if self._cycle_end(date_to) <= when
+        )
+
+        date_targets = DateCycleTarget(cycle_targets)
+        remaining_targets = DateCycleTarget("")
+        for date_from, date_to in remaining:
+            for key in date_targets.keys_for(date_from, date_to):
+                if key in date_targets:
+                    remaining_targets[key] = date_targets[key]
+
+        return self.target_at(last_cycle_end), remaining, remaining_targets
+
+    def _knots(self) -> tuple[list[float], list[float], float]:
+        """rebuilds knots only if the underlying configs changed"""
+        with self._lock:
+            target = self._configs["electrovalve"].get("humidity_target")
+            cycles = self._configs["electrovalve"].get("humidity_cycle")
+            cycle_targets = self._configs["electrovalve"].get("humidity_cycle_targets")
+
+            key = (target, cycles, cycle_targets)
+            if key != self._knots_key:
+                self._build_knots(float(target), cycles, cycle_targets)
+                self._knots_key = key
+
+            return self._times, self._targets, self._base_target
+
+    def _build_knots(self, base_target: float, cycles: str, cycle_targets: str):
+        self._logger.debug("rebuilding humidity target trajectory...")
+
+        date_targets = DateCycleTarget(cycle_targets)
+        times: list[float] = list()
+        targets: list[float] = list()
+
+        current_target = base_target
+        for date_from, date_to in sorted(Dates(cycles)):
+            start = date_from.timestamp()
+            end = self._cycle_end(date_to).timestamp()
+
+            # overlapping cycles start where the previous one ended
+            if len(times) > 0 and start < times[-1]:
+                start = times[-1]
+            if end <= start:
+                continue
+
+            target_for_date_interval = date_targets.humidity_for(date_from, date_to)
+            if target_for_date_interval is None:
+                target_for_date_interval = current_target
+
+            times.extend((start, end))
+            targets.extend((current_target, float(target_for_date_interval)))
+            current_target = float(target_for_date_interval)
+
+        self._times = times
+        self._targets = targets
+        self._base_target = base_target
+
+    def _cycle_end(self, date_to: datetime) -> datetime:
+        """cycles last until the end of their last day"""
+        return date_to + timedelta(days=1)
+
+    def _interpolate(
+        self,
+        times: list[float],
+        targets: list[float],
+        base_target: float,
+        timestamp: float,
+    ) -> float:
+        if len(times) == 0 or timestamp < times[0]:
+            return base_target
+
+        if timestamp >= times[-1]:
+            return targets[-1]
+
+        i = bisect.bisect_right(times, timestamp)  # times[i-1] <= timestamp < times[i]
+        time_from, time_to = times[i - 1], times[i]
+        target_from, target_to = targets[i - 1], targets[i]
+        if time_to == time_from:
+            return target_to
+
+        progress = (timestamp - time_from) / (time_to - time_from)
+        return target_from + (target_to - target_from) * progress
@@ -0,0 +1,9 @@
+import typing
+
+
+def percentile(values: typing.Iterable[float], fraction: float) -> float:
+    """nearest rank percentile (ex: 0.99 for p99), 0.0 without values"""
+    ordered = sorted(values)
+    if len(ordered) == 0:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
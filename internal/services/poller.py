@@ -1,24 +1,11 @@
-from dataclasses import dataclass
 import logging
 import threading
 import time
+from http import HTTPStatus
 import requests
 from . import api_client
 from . import configurations
-
-
-@dataclass
-class Readings:
-    electrovalves: bool = False
-    fans: float = 0.0
-    host_cpu: float = 0.0
-    host_disk: float = 0.0
-    host_ram: float = 0.0
-    host_temperature: float = 0.0
-    co2: float = 0.0
-    humidity: float = 0.0
-    nh3: float = 0.0
-    sensor_temperature: float = 0.0
+from . import readings
 
 
 class PollerManager:
@@ -33,6 +20,17 @@ class PollerManager:
         self._logger = logging.getLogger("services." + self.__class__.__name__)
         self._api_client = api_client
         self._update_interval = configs["poller"].getint("update_interval")
+        # follow the readings stream of each node that doesn't send heartbeats, polling only
+        # when it's unavailable
+        self._stream = configs["poller"].getboolean("stream")
+        # seconds between attempts to follow the stream of a node that refused it, doubled
+        # each time it's refused again
+        self._min_stream_backoff = self._update_interval
+        self._max_stream_backoff = 5 * 60
+        # nodes that sent readings through discovery heartbeats recently aren't polled
+        self._heartbeat_timeout = 2 * configs["discovery"].getfloat(
+            "heartbeat_interval"
+        )
         self._pollers: dict[str, "Poller"] = dict()  # ip -> Poller for that node ip
 
     def new_poller(self, ip: str) -> "Poller":
@@ -45,9 +43,15 @@ class PollerManager:
             self._pollers[ip].stop()
             del self._pollers[ip]
 
+    def on_heartbeat(self, ip: str, timestamp: float, node_readings: readings.Readings):
+        """readings received through a discovery heartbeat"""
+        poller = self._pollers.get(ip)
+        if poller is not None:
+            poller.update_from_heartbeat(timestamp, node_readings)
+
 
 class Poller:
-    """polls another node for data, given a node ip"""
+    """polls another node for data (or follows its readings stream), given a node ip"""
 
     def __init__(
         self,
@@ -59,7 +63,13 @@ class Poller:
         self._manager = manager
         self.ip = ip
         self.on = True
-        self.readings = Readings()
+        self.readings = readings.Readings()
+        # when the latest heartbeat readings were taken, in this node's clock
+        self._heartbeat_timestamp = 0.0
+        self._stream_supported = True  # False for nodes running older versions
+        self._streaming = False
+        self._stream_backoff = 0.0  # seconds
+        self._stream_retry_at = 0.0  # time.monotonic()
 
         threading.Thread(target=self._poll_api).start()
 
@@ -67,27 +77,38 @@ class Poller:
         """stops polling node API at the given ip"""
         self.on = False
 
+    def update_from_heartbeat(self, timestamp: float, node_readings: readings.Readings):
+        if timestamp <= self._heartbeat_timestamp:
+            return  # reordered, older than the current readings
+
+        self._heartbeat_timestamp = timestamp
+        if not self._streaming:  # else the stream is more recent, and ends soon
+            self.readings.update(node_readings)
+
     def _poll_api(self):
-        """polls node API at the given ip at defined intervals"""
+        """
+        polls node API at the given ip at defined intervals, while neither heartbeats
+        nor its stream keep the readings up to date
+        """
         while True:
+            if self._should_stream():
+                self._follow_stream()
+
             time.sleep(self._manager._update_interval)
 
             if not self.on:
                 return
 
+            if self._heartbeats_fresh():
+                continue  # up to date from heartbeats
+
             try:
-                readings = self._manager._api_client.get_all_readings(self.ip)
-                self.readings.electrovalves = readings.electrovalves.opened
-                self.readings.fans = readings.fans.percent
-                self.readings.host_cpu = readings.host_cpu.percent
-                self.readings.host_disk = readings.host_disk.percent
-                self.readings.host_ram = readings.host_ram.percent
-                self.readings.host_temperature = readings.host_temperature.degrees
-                self.readings.co2 = readings.co2.ppm
-                self.readings.humidity = readings.humidity.percent
-                self.readings.nh3 = readings.nh3.ppm
-                self.readings.sensor_temperature = readings.sensor_temperature.degrees
-            except (requests.HTTPError, requests.exceptions.ConnectionError) as e:
+                self.readings.update(self._manager._api_client.get_readings(self.ip))
+            except (
+                requests.HTTPError,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
                 status_code = None
                 reason = None
                 if e.response is not None:
@@ -97,3 +118,83 @@ class Poller:
                 self._manager._logger.error(
                     f"error getting all readings for node {self.ip}: status code {status_code}, reason {reason}",
                 )
+
+    def _heartbeats_fresh(self) -> bool:
+        return (
+            time.time() - self._heartbeat_timestamp < self._manager._heartbeat_timeout
+        )
+
+    def _should_stream(self) -> bool:
+        """heartbeats are cheaper: streams only stand in for them"""
+        return (
+            self.on
+            and self._manager._stream
+            and self._stream_supported
+            and not self._heartbeats_fresh()
+            and time.monotonic() >= self._stream_retry_at
+        )
+
+    def _follow_stream(self):
+        """
+        applies readings pushed by the node, until the connection ends, the poller stops
+        or heartbeats from the node arrive again
+        """
+        try:
+            for changed in self._manager._api_client.stream_readings(self.ip):
+                if not self.on:
+                    return
+
+                self._streaming = True
+                self._stream_backoff = 0.0
+                for name, value in changed.items():
+                    if hasattr(self.readings, name):
+                        setattr(self.readings, name, value)
+
+                if self._heartbeats_fresh():
+                    self._manager._logger.info(
+                        f"receiving heartbeats from node {self.ip}, leaving its readings stream"
+                    )
+                    return
+        except requests.HTTPError as e:
+            status_code = None if e.response is None else e.response.status_code
+            if status_code == HTTPStatus.NOT_FOUND:
+                self._manager._logger.info(
+                    f"node {self.ip} has no readings stream, polling instead"
+                )
+                self._stream_supported = False
+            elif status_code in (
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                HTTPStatus.TOO_MANY_REQUESTS,
+            ):
+                # too many subscribers, or rate limited: back off, polling meanwhile
+                self._stream_backoff = min(
+                    self._manager._max_stream_backoff,
+                    max(self._manager._min_stream_backoff, 2 * self._stream_backoff),
+                )
+                delay = max(self._stream_backoff, _retry_after(e.response))
+                self._stream_retry_at = time.monotonic() + delay
+                self._manager._logger.info(
+                    f"node {self.ip} refused its readings stream ({status_code}), polling for {delay:.0f}s"
+                )
+            else:
+                self._manager._logger.error(
+                    f"error following readings stream of node {self.ip}: {e}"
+                )
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ) as e:
+            self._manager._logger.error(
+                f"readings stream of node {self.ip} interrupted: {e}"
+            )
+        finally:
+            self._streaming = False
+
+
+def _retry_after(response: requests.Response) -> float:
+    """seconds in the Retry-After header, 0 if missing (or an HTTP date)"""
+    try:
+        return max(0.0, float(response.headers.get("Retry-After", "0")))
+    except ValueError:
+        return 0.0
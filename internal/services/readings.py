@@ -0,0 +1,205 @@
+import collections
+import itertools
+import logging
+import struct
+import threading
+import time
+import typing
+from dataclasses import asdict, dataclass, fields
+from . import configurations
+from ..adapters import interfaces
+
+
+# version, timestamp (unix seconds), flags (bit 0: electrovalves opened), then one float32 for
+# fans, host_cpu, host_disk, host_ram, host_temperature, co2, humidity, nh3, sensor_temperature
+SNAPSHOT = struct.Struct("!BdB9f")
+SNAPSHOT_VERSION = 1
+ELECTROVALVES_OPENED = 0b1
+# content type of snapshots served by the API
+MEDIA_TYPE = "application/vnd.environmental-control.readings"
+
+
+@dataclass
+class Readings:
+    electrovalves: bool = False
+    fans: float = 0.0
+    host_cpu: float = 0.0
+    host_disk: float = 0.0
+    host_ram: float = 0.0
+    host_temperature: float = 0.0
+    co2: float = 0.0
+    humidity: float = 0.0
+    nh3: float = 0.0
+    sensor_temperature: float = 0.0
+
+    def update(self, other: "Readings"):
+        """copies all readings from other, in place (keeps frontend bindings)"""
+        for f in fields(self):
+            setattr(self, f.name, getattr(other, f.name))
+
+
+def encode(readings: Readings, timestamp: float) -> bytes:
+    """fixed layout binary snapshot, SNAPSHOT.size bytes"""
+    return SNAPSHOT.pack(
+        SNAPSHOT_VERSION,
+        timestamp,
+        ELECTROVALVES_OPENED if readings.electrovalves else 0,
+        readings.fans,
+        readings.host_cpu,
+        readings.host_disk,
+        readings.host_ram,
+        readings.host_temperature,
+        readings.co2,
+        readings.humidity,
+        readings.nh3,
+        readings.sensor_temperature,
+    )
+
+
+def decode(data: bytes) -> None | tuple[float, Readings]:
+    """(timestamp, readings), None if not a snapshot"""
+    if len(data) != SNAPSHOT.size or data[0] != SNAPSHOT_VERSION:
+        return None
+
+    _, timestamp, flags, *values = SNAPSHOT.unpack(data)
+    return timestamp, Readings(bool(flags & ELECTROVALVES_OPENED), *values)
+
+
+class LocalReadings:
+    """readings of this node's actuators, host and sensors"""
+
+    def __init__(
+        self,
+        electrovalves: interfaces.ActuatorOnOff,
+        fans: interfaces.ActuatorPercentage,
+        host_cpu: interfaces.HostInfo,
+        host_disk: interfaces.HostInfo,
+        host_ram: interfaces.HostInfo,
+        host_temperature: interfaces.HostInfo,
+        sensor_co2: interfaces.Sensor,
+        sensor_humidity: interfaces.Sensor,
+        sensor_nh3: interfaces.Sensor,
+        sensor_temperature: interfaces.Sensor,
+    ):
+        self._electrovalves = electrovalves
+        self._fans = fans
+        self._host_cpu = host_cpu
+        self._host_disk = host_disk
+        self._host_ram = host_ram
+        self._host_temperature = host_temperature
+        self._sensor_co2 = sensor_co2
+        self._sensor_humidity = sensor_humidity
+        self._sensor_nh3 = sensor_nh3
+        self._sensor_temperature = sensor_temperature
+
+    def read(self) -> Readings:
+        return Readings(
+            electrovalves=self._electrovalves.is_on(),
+            fans=self._fans.get(),
+            host_cpu=self._host_cpu.get(),
+            host_disk=self._host_disk.get(),
+            host_ram=self._host_ram.get(),
+            host_temperature=self._host_temperature.get(),
+            co2=self._sensor_co2.read(),
+            humidity=self._sensor_humidity.read(),
+            nh3=self._sensor_nh3.read(),
+            sensor_temperature=self._sensor_temperature.read(),
+        )
+
+
+@dataclass
+class Change:
+    sequence: int
+    timestamp: float  # unix seconds
+    readings: dict[str, typing.Any]  # only the readings that changed (see Readings)
+
+
+class ReadingsChanges:
+    """
+    Ring buffer of changes to this node's readings, sampled every 'sample_interval' seconds.
+    Each change holds only the readings that changed, with a sequence number, so nodes that
+    lost track (ex: Wi-Fi drops) can ask for the changes after the last one they got.
+
+    Sequence numbers start at the start time in milliseconds (like incarnations), so sequence
+    numbers from before a restart are always older than the ring.
+    """
+
+    def __init__(
+        self, configs: configurations.Configurations, local_readings: LocalReadings
+    ):
+        self._logger = logging.getLogger("services." + self.__class__.__name__)
+        self._local_readings = local_readings
+        self.sample_interval = configs["readings"].getfloat("sample_interval")
+        self.max_changes = 1000  # per request
+
+        self._lock = threading.Lock()
+        self._ring: collections.deque[Change] = collections.deque(
+            maxlen=configs["readings"].getint("changes_ring_size")
+        )
+        self._current: dict[str, typing.Any] = dict()  # all readings, as of sequence
+        self.sequence = int(time.time() * 1000)
+        self._sample_listeners: list[typing.Callable[[Readings, float], None]] = list()
+        self._stop = threading.Event()
+
+    def add_sample_listener(self, listener: typing.Callable[[Readings, float], None]):
+        """registers a function to call with each sample (readings and timestamp)"""
+        self._sample_listeners.append(listener)
+
+    def run(self):
+        """samples readings until stopped. blocks"""
+        self._logger.info(
+            f"recording readings changes every {self.sample_interval}s..."
+        )
+        while not self._stop.is_set():
+            sample = self._local_readings.read()
+            timestamp = time.time()
+            self.record(sample, timestamp)
+            for listener in self._sample_listeners:
+                try:
+                    listener(sample, timestamp)
+                except Exception:
+                    self._logger.exception("readings sample listener failed")
+
+            self._stop.wait(self.sample_interval)
+
+    def stop(self):
+        self._stop.set()
+
+    def record(self, readings: Readings, timestamp: float):
+        current = asdict(readings)
+        with self._lock:
+            changed = {
+                name: value
+                for name, value in current.items()
+                if name not in self._current or self._current[name] != value
+            }
+            if len(changed) == 0:
+                return
+
+            self.sequence += 1
+            self._ring.append(Change(self.sequence, timestamp, changed))
+            self._current = current
+
+    def since(self, sequence: int, limit: int) -> tuple[bool, bool, list[Change]]:
+        """
+        (reset, more, changes) after 'sequence', oldest first, up to 'limit' (and max_changes).
+        reset if 'sequence' isn't in the ring anymore (or never was): the only change then
+        holds all current readings. more if there are changes left after the returned ones
+        """
+        limit = max(1, min(limit, self.max_changes))
+        with self._lock:
+            if len(self._ring) == 0:
+                return True, False, list()
+
+            oldest = self._ring[0].sequence
+            if sequence < oldest - 1 or sequence > self.sequence:
+                latest = self._ring[-1]
+                return (
+                    True,
+                    False,
+                    [Change(latest.sequence, latest.timestamp, dict(self._current))],
+                )
+
+            start = sequence - oldest + 1
+            changes = list(itertools.islice(self._ring, start, start + limit))
+            return False, start + len(changes) < len(self._ring), changes
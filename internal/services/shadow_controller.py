@@ -0,0 +1,201 @@
+import logging
+import struct
+import threading
+from dataclasses import dataclass
+from . import actuators_controller
+from . import configurations
+from . import control_runtime
+from . import humidity_schedule
+from ..adapters import interfaces
+
+
+@dataclass
+class Decision:
+    """live and candidate decisions for one control tick"""
+
+    timestamp: float
+    live_fan_speed: float
+    candidate_fan_speed: float
+    live_electrovalves: bool
+    candidate_electrovalves: bool
+    live_cpu: float  # seconds
+    candidate_cpu: float  # seconds
+
+
+@dataclass
+class ShadowStatistics:
+    ticks: int = 0
+    fan_divergent_ticks: int = 0
+    fan_mean_abs_difference: float = 0.0
+    fan_max_abs_difference: float = 0.0
+    candidate_faster_fan_ticks: int = 0
+    electrovalves_divergent_ticks: int = 0
+    live_mean_cpu: float = 0.0  # seconds per tick
+    candidate_mean_cpu: float = 0.0  # seconds per tick
+    candidate_max_cpu: float = 0.0
+
+
+class ShadowFan(interfaces.ActuatorPercentage):
+    """fan that only remembers the requested speed"""
+
+    def __init__(self):
+        self.value = 0.0
+
+    def get(self) -> float:
+        return self.value
+
+    def set(self, percent: float):
+        self.value = percent
+
+
+class ShadowElectrovalve(interfaces.ActuatorOnOff):
+    """electrovalve that only remembers the requested state"""
+
+    def __init__(self):
+        self.value = False
+
+    def on(self):
+        self.value = True
+
+    def off(self):
+        self.value = False
+
+    def is_on(self) -> bool:
+        return self.value
+
+
+class ShadowController:
+    """
+    Runs a candidate controller next to the live one, on the same sensor snapshots.
+    Candidate decisions never reach the actuators. Both decisions are kept in a ring buffer.
+
+    The candidate is the live controller with the config overrides in the [shadow] section,
+    'overrides = section.option=value, ...' (ex: 'overrides = fan.predictive=true').
+    """
+
+    # timestamp, fan speeds (live, candidate), electrovalves (live, candidate), cpu (live, candidate)
+    _record = struct.Struct("<dff??ff")
+
+    def __init__(
+        self,
+        configs: configurations.Configurations,
+        live_runtime: control_runtime.ControlRuntime,
+        live_controller: actuators_controller.ActuatorsController,
+    ):
+        self._logger = logging.getLogger("services." + self.__class__.__name__)
+        self._configs = configs
+        self._live_runtime = live_runtime
+        self._live_controller = live_controller
+        self._overrides = configurations.parse_overrides(
+            configs["shadow"].get("overrides").split(",")
+        )
+
+        # copy of the live configs, with the overrides
+        self._candidate_configs = configurations.InMemoryConfigurations()
+        self._refresh_candidate_configs()
+        self._candidate_runtime = control_runtime.ControlRuntime(
+            self._candidate_configs
+        )
+        self._candidate = actuators_controller.ActuatorsController(
+            self._candidate_configs,
+            self._candidate_runtime,
+            humidity_schedule.HumiditySchedule(self._candidate_configs),
+            ShadowElectrovalve(),
+            ShadowFan(),
+            # sensors are never read, the candidate gets the live snapshots
+            None,
+            None,
+            None,
+            None,
+        )
+        self._candidate.add_control_tasks()
+
+        self._lock = threading.Lock()
+        self._capacity = configs["shadow"].getint("ring_size")
+        self._ring = bytearray(self._record.size * self._capacity)
+        self._next = 0  # next ring position
+        self._stats = ShadowStatistics()
+        self._fan_total_abs_difference = 0.0
+        self._live_total_cpu = 0.0
+        self._candidate_total_cpu = 0.0
+
+        live_runtime.add_tick_listener(self.tick)
+        self._logger.info(f"running candidate controller with {self._overrides}")
+
+    def tick(self, snapshot: control_runtime.SensorSnapshot, tick_number: int):
+        """runs the candidate on the snapshot the live controller just acted on"""
+        self._refresh_candidate_configs()
+        self._candidate_runtime.tick(snapshot, tick_number)
+
+        self._add(
+            Decision(
+                timestamp=snapshot.taken_at.timestamp(),
+                live_fan_speed=self._live_controller.fan_speed_decision,
+                candidate_fan_speed=self._candidate.fan_speed_decision,
+                live_electrovalves=self._live_controller.electrovalves_decision,
+                candidate_electrovalves=self._candidate.electrovalves_decision,
+                live_cpu=self._live_runtime.last_tick_cpu,
+                candidate_cpu=self._candidate_runtime.last_tick_cpu,
+            )
+        )
+
+    def statistics(self) -> ShadowStatistics:
+        with self._lock:
+            return ShadowStatistics(**vars(self._stats))
+
+    def decisions(self, last: int) -> list[Decision]:
+        """up to the 'last' most recent decisions, oldest first"""
+        with self._lock:
+            count = min(last, self._stats.ticks, self._capacity)
+            positions = [
+                (self._next - count + i) % self._capacity for i in range(count)
+            ]
+            return [
+                Decision(*self._record.unpack_from(self._ring, p * self._record.size))
+                for p in positions
+            ]
+
+    def _add(self, decision: Decision):
+        fan_difference = abs(decision.candidate_fan_speed - decision.live_fan_speed)
+
+        with self._lock:
+            self._record.pack_into(
+                self._ring,
+                self._next * self._record.size,
+                decision.timestamp,
+                decision.live_fan_speed,
+                decision.candidate_fan_speed,
+                decision.live_electrovalves,
+                decision.candidate_electrovalves,
+                decision.live_cpu,
+                decision.candidate_cpu,
+            )
+            self._next = (self._next + 1) % self._capacity
+
+            stats = self._stats
+            stats.ticks += 1
+            stats.fan_divergent_ticks += int(fan_difference > 0)
+            stats.candidate_faster_fan_ticks += int(
+                decision.candidate_fan_speed > decision.live_fan_speed
+            )
+            stats.electrovalves_divergent_ticks += int(
+                decision.candidate_electrovalves != decision.live_electrovalves
+            )
+            self._fan_total_abs_difference += fan_difference
+            stats.fan_mean_abs_difference = self._fan_total_abs_difference / stats.ticks
+            stats.fan_max_abs_difference = max(
+                stats.fan_max_abs_difference, fan_difference
+            )
+
+            self._live_total_cpu += decision.live_cpu
+            self._candidate_total_cpu += decision.candidate_cpu
+            stats.live_mean_cpu = self._live_total_cpu / stats.ticks
+            stats.candidate_mean_cpu = self._candidate_total_cpu / stats.ticks
+            stats.candidate_max_cpu = max(
+                stats.candidate_max_cpu, decision.candidate_cpu
+            )
+
+    def _refresh_candidate_configs(self):
+        """live configs may change at any time"""
+        self._candidate_configs.read_dict(self._configs)
+        self._candidate_configs.read_dict(self._overrides)
@@ -0,0 +1,113 @@
+import math
+import time
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from . import configurations
+from ..adapters import interfaces
+
+
+CONTROL = "control"  # never throttled
+READINGS = "readings"
+CONFIGS = "configs"
+OTHER = "other"
+LIMITED_CLASSES = (READINGS, CONFIGS, OTHER)
+SHED_RETRY_AFTER_SECS = 1  # host cpu usage is updated every second
+
+
+@dataclass
+class ClassStatistics:
+    name: str
+    admitted: int = 0
+    limited: int = 0  # over the client's rate limit
+    shed: int = 0  # rejected under high host cpu usage
+
+
+@dataclass
+class ThrottlingStatistics:
+    cpu_percent: float = 0.0
+    shedding: bool = False
+    clients: int = 0
+    classes: list[ClassStatistics] = field(default_factory=list)
+
+
+@dataclass
+class _Bucket:
+    tokens: float
+    updated_at: float  # time.monotonic()
+
+
+class Throttling:
+    """
+    Token bucket rate limits per client ip and endpoint class (see endpoint_class), and load
+    shedding: while host cpu usage is at 'shed_cpu_percent' or above, only control requests
+    are served. Limits are "<requests per second>, <burst>", in the [rate_limits] section.
+    """
+
+    def __init__(
+        self, configs: configurations.Configurations, host_cpu: interfaces.HostInfo
+    ):
+        self._host_cpu = host_cpu
+        self._shed_cpu_percent = configs["rate_limits"].getfloat("shed_cpu_percent")
+        self._limits: dict[str, tuple[float, float]] = dict()  # class -> (rate, burst)
+        for name in LIMITED_CLASSES:
+            rate, burst = configs["rate_limits"].get(name).split(",")
+            self._limits[name] = (float(rate), float(burst))
+
+        self._buckets: dict[tuple[str, str], _Bucket] = dict()  # (ip, class) -> bucket
+        self._stats = {
+            name: ClassStatistics(name) for name in (CONTROL,) + LIMITED_CLASSES
+        }
+
+    def endpoint_class(self, method: str, endpoint: str) -> str:
+        """
+        actuator commands and health checks are control requests. the rest, config changes
+        included (each one rewrites the configs file), is grouped by what it costs to serve
+        """
+        if endpoint == "_/health" or (
+            method != "GET" and endpoint.startswith("actuators/")
+        ):
+            return CONTROL
+        if endpoint.startswith("configs"):
+            return CONFIGS
+        if method != "GET":
+            return OTHER
+        if endpoint == "all-readings" or endpoint.startswith(
+            ("readings/", "history/", "actuators/", "host/", "sensors/")
+        ):
+            return READINGS
+        return OTHER
+
+    def admit(self, client: str, endpoint_class: str) -> None | tuple[HTTPStatus, int]:
+        """None to serve the request, or its status and seconds to retry after"""
+        stats = self._stats[endpoint_class]
+        if endpoint_class == CONTROL:
+            stats.admitted += 1
+            return None
+
+        if self._host_cpu.get() >= self._shed_cpu_percent:
+            stats.shed += 1
+            return HTTPStatus.SERVICE_UNAVAILABLE, SHED_RETRY_AFTER_SECS
+
+        rate, burst = self._limits[endpoint_class]
+        now = time.monotonic()
+        bucket = self._buckets.get((client, endpoint_class))
+        if bucket is None:
+            bucket = self._buckets[(client, endpoint_class)] = _Bucket(burst, now)
+        bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated_at) * rate)
+        bucket.updated_at = now
+
+        if bucket.tokens < 1:
+            stats.limited += 1
+            return HTTPStatus.TOO_MANY_REQUESTS, math.ceil((1 - bucket.tokens) / rate)
+        bucket.tokens -= 1
+        stats.admitted += 1
+        return None
+
+    def statistics(self) -> ThrottlingStatistics:
+        cpu_percent = self._host_cpu.get()
+        return ThrottlingStatistics(
+            cpu_percent=cpu_percent,
+            shedding=cpu_percent >= self._shed_cpu_percent,
+            clients=len({client for client, _ in self._buckets}),
+            classes=[ClassStatistics(**vars(stats)) for stats in self._stats.values()],
+        )
@@ -0,0 +1,47 @@
+import collections
+
+
+class Trend:
+    """sliding time window of readings, fitted with a least squares line"""
+
+    def __init__(self, window_secs: float, min_samples: int = 3):
+        self.window_secs = window_secs
+        self.min_samples = min_samples
+        self._samples: collections.deque[tuple[float, float]] = collections.deque()
+
+    def add(self, timestamp: float, value: float):
+        """adds a reading, dropping readings older than the window"""
+        self._samples.append((timestamp, value))
+        while timestamp - self._samples[0][0] > self.window_secs:
+            self._samples.popleft()
+
+    def predict(self, horizon_secs: float) -> None | float:
+        """expected value 'horizon_secs' after the last reading, or None if there aren't enough readings yet"""
+        fit = self._fit()
+        if fit is None:
+            return None
+
+        slope, value_at_last_sample = fit
+        return value_at_last_sample + slope * horizon_secs
+
+    def _fit(self) -> None | tuple[float, float]:
+        """(slope, fitted value at the last reading)"""
+        n = len(self._samples)
+        if n < self.min_samples:
+            return None
+
+        # centered on the means, to keep precision with epoch timestamps
+        mean_t = sum(t for t, _ in self._samples) / n
+        mean_v = sum(v for _, v in self._samples) / n
+        covariance = 0.0
+        variance = 0.0
+        for t, v in self._samples:
+            covariance += (t - mean_t) * (v - mean_v)
+            variance += (t - mean_t) ** 2
+
+        if variance == 0.0:
+            return None
+
+        slope = covariance / variance
+        last_t = self._samples[-1][0]
+        return slope, mean_v + slope * (last_t - mean_t)
@@ -14,10 +14,15 @@ import internal.adapters.sensors.temperature as sensor_temperature
 import internal.services.api as service_api
 import internal.services.api_client as service_api_client
 import internal.services.configurations as service_configs
+import internal.services.control_runtime as service_control_runtime
 import internal.services.discovery as service_discovery
+import internal.services.history as service_history
+import internal.services.humidity_schedule as service_humidity_schedule
 import internal.services.actuators_controller as service_actuators_controller
 import internal.services.frontend as service_frontend
 import internal.services.poller as service_poller
+import internal.services.readings as service_readings
+import internal.services.shadow_controller as service_shadow_controller
 
 
 # cli
@@ -64,8 +69,12 @@ temperature_sensor = sensor_temperature.Temperature()
 
 # services
 logger.info("init services...")
+control_runtime = service_control_runtime.ControlRuntime(configs)
+humidity_schedule = service_humidity_schedule.HumiditySchedule(configs)
 actuators_controller = service_actuators_controller.ActuatorsController(
     configs,
+    control_runtime,
+    humidity_schedule,
     electrovalves,
     fans,
     co2,
@@ -73,10 +82,37 @@ actuators_controller = service_actuators_controller.ActuatorsController(
     nh3,
     temperature_sensor,
 )
+shadow_controller = None
+if configs["shadow"].getboolean("enabled"):
+    shadow_controller = service_shadow_controller.ShadowController(
+        configs, control_runtime, actuators_controller
+    )
+local_readings = service_readings.LocalReadings(
+    electrovalves,
+    fans,
+    cpu,
+    disk,
+    ram,
+    temperature_host,
+    co2,
+    humidity,
+    nh3,
+    temperature_sensor,
+)
+readings_changes = service_readings.ReadingsChanges(configs, local_readings)
+history = service_history.History(configs)
+readings_changes.add_sample_listener(history.record)
 discovery = service_discovery.Discovery(configs)
+discovery.set_readings_source(local_readings.read)
 api = service_api.API(
     configs,
+    control_runtime,
     discovery,
+    history,
+    humidity_schedule,
+    local_readings,
+    readings_changes,
+    shadow_controller,
     electrovalves,
     fans,
     cpu,
@@ -89,11 +125,17 @@ api = service_api.API(
     temperature_sensor,
 )
 api_client = service_api_client.APIClient(configs)
+api_client.set_round_trip_timeouts(discovery.round_trip_timeout)
+api_client.set_api_ports(discovery.api_port)
+async_api_client = service_api_client.AsyncAPIClient(configs)
+async_api_client.set_round_trip_timeouts(discovery.round_trip_timeout)
+async_api_client.set_api_ports(discovery.api_port)
 poller_manager = service_poller.PollerManager(configs, api_client)
 frontend = service_frontend.Frontend(
     configs,
     actuators_controller,
     api_client,
+    async_api_client,
     discovery,
     poller_manager,
     electrovalves,
@@ -109,12 +151,14 @@ frontend = service_frontend.Frontend(
 )
 
 discovery.subscribe(frontend)
+discovery.add_readings_listener(poller_manager.on_heartbeat)
 
 # run
 with concurrent.futures.ThreadPoolExecutor() as executor:
-    executor.submit(discovery.broadcast_listen)
-    executor.submit(discovery.broadcast)
-    executor.submit(discovery.ping_listen)
-    executor.submit(discovery.ping)
+    executor.submit(discovery.run)
+    executor.submit(readings_changes.run)
+    executor.submit(async_api_client.run)
     executor.submit(actuators_controller.start)
+    if api.separate_server:
+        executor.submit(api.serve)
     executor.submit(frontend.run)